@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# Measure how bcf setup scales without a fabric. Every run gets a
+# synthetic inventory and a PATH whose ssh, sshpass, scp and fuel
+# run shim.py, which simulates latency, bandwidth and failures of
+# the nodes. Each run is a separate process, its per-phase
+# timings come from the telemetry of setup.py.
+#
+#   python benchmark/benchmark.py --nodes 10 100 1000 --fuel
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import inventory
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BCF3_DIR      = os.path.dirname(BENCHMARK_DIR)
+SHIMS         = ['ssh', 'sshpass', 'scp', 'fuel']
+FUEL_CLUSTER  = '1'
+
+
+def fake_controller(url, prefix='', method='GET', data='', hashPath=None,
+                    host='', cookie=None, timeout=None):
+    """
+    Answer RestLib requests as an active controller with an
+    empty os-mgmt tenant.
+    """
+    if method == 'POST':
+        return (200, 'OK', json.dumps({'session_cookie' : 'bench'}), None)
+    if method == 'GET' and url == 'core/controller/role':
+        return (200, 'OK', json.dumps([{'role' : 'active'}]), None)
+    if method == 'GET':
+        return (200, 'OK', '[]', None)
+    return (204, 'No Content', '', None)
+
+
+def run_once(workdir, fuel, force, engine):
+    """
+    Deploy the inventory in workdir, in this process.
+    """
+    sys.path.insert(0, BCF3_DIR)
+    import setup
+    from lib import constants as const
+    from lib.helper import Helper
+    from lib.rest import RestLib
+
+    const.LOG_FILE = os.path.join(workdir, 'bcf_setup.log')
+    const.TELEMETRY_FILE = os.path.join(workdir, 'timing.jsonl')
+    const.JOURNAL_FILE = os.path.join(workdir, 'journal.jsonl')
+    const.ARTIFACT_CACHE_DIR = os.path.join(workdir, 'cache')
+    const.HORIZON_PATCH_URL = {'juno' : os.path.join(workdir, 'pkgs', inventory.HORIZON_PATCH)}
+    Helper.get_setup_node_ip = staticmethod(lambda: '127.0.0.1')
+    RestLib.request = staticmethod(fake_controller)
+
+    with open(os.path.join(workdir, 'config.json')) as config_file:
+        config = json.load(config_file)
+    start = time.time()
+    setup.deploy_bcf(config, FUEL_CLUSTER if fuel else None, force, engine)
+    Helper.close_console()
+    with open(os.path.join(workdir, 'result.json'), 'w') as result_file:
+        json.dump({'seconds' : time.time() - start}, result_file)
+
+
+def prepare(count, fuel, args):
+    workdir = tempfile.mkdtemp(prefix='bcf_bench_%d_' % count)
+    bin_dir = os.path.join(workdir, 'bin')
+    os.mkdir(bin_dir)
+    for shim in SHIMS:
+        path = os.path.join(bin_dir, shim)
+        with open(path, 'w') as shim_file:
+            shim_file.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' %
+                            (sys.executable, os.path.join(BENCHMARK_DIR, 'shim.py'), shim))
+        os.chmod(path, 0755)
+    # setup.py reads templates and the fact probe from its cwd
+    for name in ['t6', 'fact_probe.py']:
+        os.symlink(os.path.join(BCF3_DIR, name), os.path.join(workdir, name))
+    pkg_dir = os.path.join(workdir, 'pkgs')
+    os.mkdir(pkg_dir)
+    inventory.generate_packages(pkg_dir, args.pkg_size)
+    with open(os.path.join(workdir, 'config.json'), 'w') as config_file:
+        json.dump(inventory.generate_config(count, fuel, pkg_dir), config_file)
+    if fuel:
+        inventory.generate_fuel_inventory(count, workdir)
+
+    env = dict(os.environ)
+    env.update({'PATH'                   : bin_dir + os.pathsep + env.get('PATH', ''),
+                'HOME'                   : workdir,
+                'BCF_BENCH_STATE'        : workdir,
+                'BCF_BENCH_LATENCY'      : str(args.latency),
+                'BCF_BENCH_BANDWIDTH'    : str(args.bandwidth),
+                'BCF_BENCH_FAILURE_RATE' : str(args.failure_rate),
+                'BCF_BENCH_SCRIPT_TIME'  : str(args.script_time)})
+    return workdir, env
+
+
+def percentile(values, percent):
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def report(count, workdir):
+    with open(os.path.join(workdir, 'result.json')) as result_file:
+        seconds = json.load(result_file)['seconds']
+    phases = {}
+    with open(os.path.join(workdir, 'timing.jsonl')) as timing_file:
+        for line in timing_file:
+            event = json.loads(line)
+            phases.setdefault(event['phase'], []).append(event)
+
+    lines = ['%d nodes: %.1fs end to end, %.2f nodes/s' %
+             (count, seconds, count / seconds),
+             '  %-10s %6s %8s %8s %8s %9s %9s %6s' %
+             ('phase', 'count', 'p50(s)', 'p95(s)', 'max(s)', 'ops/s', 'MB/s', 'failed')]
+    for phase, events in sorted(phases.items()):
+        durations = sorted([event['duration'] for event in events])
+        # wall time the phase was running on any node
+        window = max(max([event['start'] + event['duration'] for event in events]) -
+                     min([event['start'] for event in events]), 0.001)
+        lines.append('  %-10s %6d %8.2f %8.2f %8.2f %9.1f %9.1f %6d' %
+                     (phase, len(events),
+                      percentile(durations, 50),
+                      percentile(durations, 95),
+                      durations[-1],
+                      len(events) / window,
+                      sum([event['bytes'] for event in events]) / window / 1024 / 1024,
+                      len([event for event in events if event['exit_code']])))
+    return '\n'.join(lines) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 100, 1000],
+                        help="inventory sizes to benchmark")
+    parser.add_argument('--fuel', action='store_true', default=False,
+                        help="discover nodes through 'fuel nodes' and astute.yaml")
+    parser.add_argument('--force', action='store_true', default=False,
+                        help="pass --force to setup")
+    parser.add_argument('--engine', choices=['thread', 'event'], default='thread',
+                        help="deployment engine of setup")
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds added to every ssh and scp")
+    parser.add_argument('--bandwidth', type=float, default=100,
+                        help="MB/s of every single transfer")
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help="share of ssh and scp runs which fail")
+    parser.add_argument('--script-time', type=float, default=1,
+                        help="seconds a node spends running its scripts")
+    parser.add_argument('--pkg-size', type=float, default=5,
+                        help="MB of every ivs package")
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="keep the work directories")
+    parser.add_argument('--run-in', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_in:
+        run_once(args.run_in, args.fuel, args.force, args.engine)
+        return
+
+    for count in args.nodes:
+        workdir, env = prepare(count, args.fuel, args)
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-in', workdir,
+               '--engine', args.engine]
+        if args.fuel:
+            cmd.append('--fuel')
+        if args.force:
+            cmd.append('--force')
+        with open(os.path.join(workdir, 'console.log'), 'w') as console:
+            code = subprocess.call(cmd, cwd=workdir, env=env,
+                                   stdout=console, stderr=subprocess.STDOUT)
+        if code != 0:
+            sys.stdout.write('%d nodes: setup failed, see %s\n' %
+                             (count, os.path.join(workdir, 'console.log')))
+            continue
+        sys.stdout.write(report(count, workdir))
+        sys.stdout.flush()
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
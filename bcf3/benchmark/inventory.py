@@ -0,0 +1,112 @@
+import os
+import json
+
+# first address of the synthetic nodes, node i gets BASE_IP + i
+BASE_IP = (10, 100, 0, 1)
+
+IVS_PACKAGES = ['ivs-0.5-1.el7.centos.x86_64.rpm',
+                'ivs-debuginfo-0.5-1.el7.centos.x86_64.rpm']
+HORIZON_PATCH = 'juno.tar.gz'
+
+
+def generate_packages(pkg_dir, size):
+    """
+    Write sparse ivs packages and horizon patch of size MB
+    to pkg_dir, return their paths.
+    """
+    paths = []
+    for name in IVS_PACKAGES + [HORIZON_PATCH]:
+        path = os.path.join(pkg_dir, name)
+        with open(path, 'wb') as pkg_file:
+            pkg_file.truncate(int(size * 1024 * 1024))
+        paths.append(path)
+    return paths
+
+
+def node_ip(i):
+    value = (BASE_IP[0] << 24) + (BASE_IP[1] << 16) + (BASE_IP[2] << 8) + BASE_IP[3] + i
+    return '.'.join([str((value >> shift) & 0xff) for shift in (24, 16, 8, 0)])
+
+
+def node_role(i):
+    # one neutron server in every 50 nodes
+    if i % 50 == 0:
+        return 'controller'
+    return 'compute'
+
+
+def generate_config(count, fuel, pkg_dir):
+    """
+    Return a bcf setup config of count nodes. With fuel the
+    nodes come from 'fuel nodes', so only defaults are set.
+    """
+    config = {
+        'openstack_release'           : 'juno',
+        'default_deploy_mode'         : 't6',
+        'default_skip'                : False,
+        'default_install_bsnstacklib' : True,
+        'default_install_ivs'         : True,
+        'default_install_all'         : True,
+        'ivs_packages'                : [os.path.join(pkg_dir, name) for name in IVS_PACKAGES],
+        'bcf_controllers'             : ['10.99.0.1:8000', '10.99.0.2:8000'],
+        'bcf_controller_user'         : 'admin',
+        'bcf_controller_passwd'       : 'adminadmin',
+        'default_user'                : 'root',
+        'default_passwd'              : 'r00tme',
+        'default_os'                  : 'centos',
+        'default_os_version'          : '7',
+        'network_vlan_ranges'         : 'physnet1:500:2000',
+        'default_role'                : 'compute',
+        'default_uplink_interfaces'   : ['eth1', 'eth2'],
+        'nodes'                       : []}
+    if not fuel:
+        config['nodes'] = [{'hostname' : node_ip(i), 'role' : node_role(i)}
+                           for i in range(count)]
+    return config
+
+
+def generate_astute(i):
+    """
+    Return the part of a fuel astute.yaml bcf setup reads.
+    """
+    return {
+        'quantum_settings' : {'L2' : {'phys_nets' : {'physnet1' : {'vlan_range' : '1000:1030'}}}},
+        'network_scheme'   : {
+            'roles'           : {'private'    : 'br-prv',
+                                 'management' : 'br-mgmt',
+                                 'storage'    : 'br-storage',
+                                 'ex'         : 'br-ex',
+                                 'fw-admin'   : 'br-fw-admin'},
+            'transformations' : [
+                {'action' : 'add-br', 'name' : 'br-prv'},
+                {'action' : 'add-patch', 'bridges' : ['br-prv', 'br-bond0']},
+                {'action' : 'add-bond', 'bridge' : 'br-bond0', 'name' : 'bond0',
+                 'interfaces' : ['eth1', 'eth2']},
+                {'action' : 'add-patch', 'bridges' : ['br-mgmt', 'br-bond0'],
+                 'tags' : [101, 0], 'vlan_ids' : [101, 0]},
+                {'action' : 'add-patch', 'bridges' : ['br-storage', 'br-bond0'],
+                 'tags' : [102, 0], 'vlan_ids' : [102, 0]}],
+            'endpoints'       : {
+                'br-mgmt'     : {'IP' : ['192.168.%d.%d/16' % (i / 250, i % 250 + 2)]},
+                'br-storage'  : {'IP' : ['192.169.%d.%d/16' % (i / 250, i % 250 + 2)]},
+                'br-ex'       : {'IP' : 'none'},
+                'br-fw-admin' : {'IP' : ['10.20.0.%d/24' % (i % 250 + 2)]},
+                'br-prv'      : {'IP' : 'none'}}}}
+
+
+def generate_fuel_inventory(count, state_dir):
+    """
+    Write the 'fuel nodes' table and an astute.yaml of every
+    node to state_dir, where shim.py serves them.
+    """
+    lines = ['id | status | name | cluster | ip | mac | roles | pending_roles | online | group_id',
+             '---|--------|------|---------|----|-----|-------|---------------|--------|---------']
+    for i in range(count):
+        ip = node_ip(i)
+        lines.append('%d | ready | node-%d | 1 | %s | 52:54:00:00:%02x:%02x | %s | | True | 1' %
+                     (i + 1, i + 1, ip, (i >> 8) & 0xff, i & 0xff, node_role(i)))
+        # json is valid yaml
+        with open(os.path.join(state_dir, '%s.astute.yaml' % ip), 'w') as astute_file:
+            json.dump(generate_astute(i), astute_file, indent=2)
+    with open(os.path.join(state_dir, 'fuel_nodes.txt'), 'w') as nodes_file:
+        nodes_file.write('\n'.join(lines) + '\n')
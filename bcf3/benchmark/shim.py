@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# Local stand-in for ssh, sshpass, scp and fuel used by
+# benchmark.py. The command to emulate is the first argument.
+# Nodes are simulated with these variables:
+#   BCF_BENCH_STATE        directory with the generated inventory
+#   BCF_BENCH_LATENCY      seconds added to every ssh or scp
+#   BCF_BENCH_BANDWIDTH    MB/s of every single transfer
+#   BCF_BENCH_FAILURE_RATE share of ssh or scp runs which fail
+#   BCF_BENCH_SCRIPT_TIME  seconds a node spends in its scripts
+import os
+import re
+import sys
+import json
+import time
+import random
+
+STATE_DIR    = os.environ.get('BCF_BENCH_STATE', '/tmp')
+LATENCY      = float(os.environ.get('BCF_BENCH_LATENCY', '0.05'))
+BANDWIDTH    = float(os.environ.get('BCF_BENCH_BANDWIDTH', '100'))
+FAILURE_RATE = float(os.environ.get('BCF_BENCH_FAILURE_RATE', '0'))
+SCRIPT_TIME  = float(os.environ.get('BCF_BENCH_SCRIPT_TIME', '1'))
+
+# ssh options which take an argument
+SSH_ARG_OPTIONS = 'bcDEeFIiJLlmOopQRSWw'
+
+PLATFORM = 'Linux-3.10.0-327.el7.x86_64-x86_64-with-centos-7.2.1511-Core'
+IVS_VERSION = '0.5'
+
+FINGERPRINT = re.compile(r'echo ([0-9a-f]{64}) > (\S+)')
+
+
+def read_stdin():
+    size = 0
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    for chunk in iter(lambda: stdin.read(1024 * 1024), b''):
+        size += len(chunk)
+    return size
+
+
+def transfer(size):
+    time.sleep(LATENCY + size / (BANDWIDTH * 1024 * 1024))
+
+
+def fail():
+    return random.random() < FAILURE_RATE
+
+
+def host_file(hostname, suffix):
+    return os.path.join(STATE_DIR, '%s.%s' % (hostname, suffix))
+
+
+def run_remote(hostname, command):
+    """
+    Emulate command on hostname, return the exit code.
+    """
+    if 'python -' in command:
+        read_stdin()
+        astute = None
+        if os.path.isfile(host_file(hostname, 'astute.yaml')):
+            with open(host_file(hostname, 'astute.yaml')) as astute_file:
+                astute = astute_file.read()
+        sys.stdout.write(json.dumps({'platform'    : PLATFORM,
+                                     'astute'      : astute,
+                                     'ivs_version' : IVS_VERSION,
+                                     'ivs_error'   : None}) + '\n')
+        return 0
+    if 'tar -xpf -' in command:
+        transfer(read_stdin())
+        return 0
+    if 'cat ' in command and 'fingerprint' in command:
+        if os.path.isfile(host_file(hostname, 'fingerprint')):
+            with open(host_file(hostname, 'fingerprint')) as fingerprint_file:
+                sys.stdout.write(fingerprint_file.read())
+        return 0
+    if '_ospurge.sh' in command:
+        time.sleep(SCRIPT_TIME / 10)
+        return 0
+    if '.sh' in command:
+        time.sleep(SCRIPT_TIME)
+        match = FINGERPRINT.search(command)
+        if match:
+            with open(host_file(hostname, 'fingerprint'), 'w') as fingerprint_file:
+                fingerprint_file.write(match.group(1) + '\n')
+        return 0
+    return 0
+
+
+def ssh(args):
+    i = 0
+    control = None
+    while i < len(args) and args[i].startswith('-'):
+        option = args[i]
+        if option[1] in SSH_ARG_OPTIONS:
+            value = option[2:] or args[i + 1]
+            if option[1] == 'O':
+                control = value
+            i += 1 if option[2:] else 2
+        else:
+            i += 1
+    if control:
+        # pretend the master connection is always up
+        return 0
+    if i >= len(args):
+        return 255
+    hostname = args[i].split('@')[-1]
+    command = ' '.join(args[i + 1:])
+    time.sleep(LATENCY)
+    if fail():
+        return 255
+    if not command:
+        return 0
+    return run_remote(hostname, command)
+
+
+def sshpass(args):
+    # sshpass -p password command ...
+    if len(args) < 3:
+        return 1
+    name = os.path.basename(args[2])
+    return COMMANDS.get(name, lambda a: 0)(args[3:])
+
+
+def scp(args):
+    files = [arg for arg in args if not arg.startswith('-')]
+    if len(files) < 2:
+        return 1
+    size = 0
+    for src in files[:-1]:
+        if os.path.isfile(src):
+            size += os.path.getsize(src)
+    transfer(size)
+    if fail():
+        return 1
+    return 0
+
+
+def fuel(args):
+    if 'settings' in args:
+        path = os.path.join(STATE_DIR, 'settings.json')
+        with open(path, 'w') as settings_file:
+            settings_file.write('{}')
+        sys.stdout.write('Settings configuration downloaded to %s\n' % path)
+        return 0
+    if 'nodes' in args:
+        with open(os.path.join(STATE_DIR, 'fuel_nodes.txt')) as nodes_file:
+            sys.stdout.write(nodes_file.read())
+        return 0
+    return 1
+
+
+COMMANDS = {'ssh'     : ssh,
+            'sshpass' : sshpass,
+            'scp'     : scp,
+            'fuel'    : fuel}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
+        sys.stderr.write('usage: shim.py %s args...\n' % '|'.join(sorted(COMMANDS)))
+        sys.exit(1)
+    sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Gather the facts bcf setup needs from a node and print them
+# as one json document. The setup node pipes this script to
+# 'python -' over ssh, so it must only use the standard library
+# and run on both python 2 and python 3.
+import json
+import platform
+import subprocess
+
+ASTUTE_YAML = '/etc/astute.yaml'
+
+
+def get_astute():
+    try:
+        with open(ASTUTE_YAML, 'r') as astute_file:
+            return astute_file.read()
+    except IOError:
+        return None
+
+
+def get_ivs_version():
+    try:
+        p = subprocess.Popen(['ivs', '--version'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    except OSError:
+        # ivs is not installed
+        return None, None
+    output, error = p.communicate()
+    output = output.decode('utf-8', 'replace')
+    if p.returncode != 0 or len(output.split()) < 2:
+        return None, error.decode('utf-8', 'replace') or output
+    return output.split()[1], None
+
+
+if __name__ == '__main__':
+    ivs_version, ivs_error = get_ivs_version()
+    print(json.dumps({
+        'platform'    : platform.platform(),
+        'astute'      : get_astute(),
+        'ivs_version' : ivs_version,
+        'ivs_error'   : ivs_error,
+    }))
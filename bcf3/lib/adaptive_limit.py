@@ -0,0 +1,89 @@
+import time
+import threading
+
+
+class AdaptiveLimit(object):
+    """
+    Concurrency limit of one deployment stage. Tasks acquire a
+    slot before running and report the outcome when releasing it.
+    The limit grows by one after a full round of successes and is
+    halved on failure. For transfers, it stops growing when the
+    setup node bandwidth is used up or when the throughput of each
+    transfer drops as more of them run.
+    """
+
+    # weight of the latest sample in the throughput average
+    __alpha = 0.3
+
+    def __init__(self, name, initial, minimum, maximum, bandwidth=None):
+        self.name      = name
+        self.limit     = max(minimum, min(initial, maximum))
+        self.minimum   = minimum
+        self.maximum   = maximum
+        # bytes per second, None if unknown
+        self.bandwidth = bandwidth
+        self.running   = 0
+        self.successes = 0
+        self.failures  = 0
+        # average throughput of a single task, bytes per second,
+        # and its value when the limit was last raised
+        self.rate      = None
+        self.base_rate = None
+        self.condition = threading.Condition()
+
+
+    def __str__(self):
+        return (r'''%(name)s limit %(limit)d, %(running)d running, %(successes)d succeeded, %(failures)d failed''' %
+               {'name'      : self.name,
+                'limit'     : self.limit,
+                'running'   : self.running,
+                'successes' : self.successes,
+                'failures'  : self.failures})
+
+
+    def acquire(self):
+        with self.condition:
+            while self.running >= self.limit:
+                self.condition.wait()
+            self.running += 1
+        return time.time()
+
+
+    def __can_grow__(self):
+        if self.limit >= self.maximum:
+            return False
+        if self.rate is None:
+            return True
+        if self.bandwidth and self.rate * (self.limit + 1) > self.bandwidth:
+            return False
+        return True
+
+
+    def release(self, start, ok, nbytes=0):
+        """
+        Release the slot acquired at start and adapt the limit.
+        """
+        seconds = max(time.time() - start, 0.001)
+        with self.condition:
+            self.running -= 1
+            if not ok:
+                self.failures += 1
+                self.limit = max(self.minimum, self.limit / 2)
+                self.base_rate = None
+            else:
+                self.successes += 1
+                if nbytes:
+                    sample = nbytes / seconds
+                    if self.rate is None:
+                        self.rate = sample
+                    else:
+                        self.rate = self.__alpha * sample + (1 - self.__alpha) * self.rate
+                    # more transfers made each one slower, step back
+                    if self.base_rate and self.rate < self.base_rate * 0.5:
+                        self.limit = max(self.minimum, self.limit - 1)
+                        self.base_rate = self.rate
+                if self.successes % self.limit == 0 and self.__can_grow__():
+                    self.limit += 1
+                    if self.base_rate is None:
+                        self.base_rate = self.rate
+            self.condition.notify_all()
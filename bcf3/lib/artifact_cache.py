@@ -0,0 +1,153 @@
+import os
+import ssl
+import json
+import shutil
+import hashlib
+import urllib2
+import tempfile
+import threading
+import constants as const
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ArtifactCache(object):
+    """
+    Downloads kept across runs on the setup node. Content is
+    stored once under its sha256, the index maps each url to
+    the content and to the ETag/Last-Modified it was served
+    with, so later runs only revalidate it.
+    """
+
+    __index = None
+    __index_lock = threading.Lock()
+
+    @staticmethod
+    def __object_path__(sha):
+        return os.path.join(const.ARTIFACT_CACHE_DIR, 'objects', sha)
+
+
+    @staticmethod
+    def __index_path__():
+        return os.path.join(const.ARTIFACT_CACHE_DIR, 'index.json')
+
+
+    @staticmethod
+    def __load_index__():
+        if ArtifactCache.__index is None:
+            try:
+                with open(ArtifactCache.__index_path__(), 'r') as index_file:
+                    ArtifactCache.__index = json.load(index_file)
+            except (IOError, ValueError):
+                ArtifactCache.__index = {}
+        return ArtifactCache.__index
+
+
+    @staticmethod
+    def __get_entry__(url):
+        with ArtifactCache.__index_lock:
+            entry = ArtifactCache.__load_index__().get(url)
+        if entry and os.path.isfile(ArtifactCache.__object_path__(entry['sha256'])):
+            return entry
+        return None
+
+
+    @staticmethod
+    def __set_entry__(url, entry):
+        with ArtifactCache.__index_lock:
+            index = ArtifactCache.__load_index__()
+            index[url] = entry
+            # write and rename, so a crash never leaves half an index
+            fd, tmp_path = tempfile.mkstemp(dir=const.ARTIFACT_CACHE_DIR)
+            with os.fdopen(fd, 'w') as index_file:
+                json.dump(index, index_file, indent=2)
+            os.rename(tmp_path, ArtifactCache.__index_path__())
+
+
+    @staticmethod
+    def __download__(url, entry):
+        """
+        Return the cache entry of url, downloading the content
+        unless the server says the cached one is still valid.
+        """
+        request = urllib2.Request(url)
+        if entry:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+        # same as wget --no-check-certificate
+        kwargs = {'timeout' : const.ARTIFACT_TIMEOUT}
+        if hasattr(ssl, '_create_unverified_context'):
+            kwargs['context'] = ssl._create_unverified_context()
+        try:
+            response = urllib2.urlopen(request, **kwargs)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and entry:
+                return entry
+            raise
+
+        sha = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=const.ARTIFACT_CACHE_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in iter(lambda: response.read(1024 * 1024), b''):
+                    sha.update(chunk)
+                    tmp_file.write(chunk)
+            os.rename(tmp_path, ArtifactCache.__object_path__(sha.hexdigest()))
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        finally:
+            response.close()
+
+        entry = {'sha256'        : sha.hexdigest(),
+                 'etag'          : response.info().getheader('ETag'),
+                 'last_modified' : response.info().getheader('Last-Modified')}
+        ArtifactCache.__set_entry__(url, entry)
+        return entry
+
+
+    @staticmethod
+    def __link__(src, dst):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            # cache on another file system
+            shutil.copyfile(src, dst)
+
+
+    @staticmethod
+    def fetch(url, dst_dir):
+        """
+        Make the content of url available as dst_dir/basename(url).
+        A cached copy is used if the server can not be reached.
+        Return (success, error message or None).
+        """
+        message = None
+        entry = ArtifactCache.__get_entry__(url)
+        try:
+            entry = ArtifactCache.__download__(url, entry)
+        except Exception as e:
+            if not entry:
+                return False, ("Failed to download %(url)s: %(e)s" %
+                              {'url' : url, 'e' : e})
+            message = ("Failed to revalidate %(url)s, use cached copy: %(e)s" %
+                      {'url' : url, 'e' : e})
+        ArtifactCache.__link__(ArtifactCache.__object_path__(entry['sha256']),
+                               os.path.join(dst_dir, os.path.basename(url)))
+        return True, message
+
+
+    @staticmethod
+    def fetch_all(urls, dst_dir):
+        """
+        Fetch urls in parallel, return {url : (success, message)}.
+        """
+        if not os.path.isdir(os.path.join(const.ARTIFACT_CACHE_DIR, 'objects')):
+            os.makedirs(os.path.join(const.ARTIFACT_CACHE_DIR, 'objects'))
+        with ThreadPoolExecutor(max_workers=max(len(urls), 1)) as executor:
+            results = list(executor.map(lambda url: ArtifactCache.fetch(url, dst_dir), urls))
+        return dict(zip(urls, results))
+
@@ -2,9 +2,48 @@
 # max number of threads, each thread sets up one node
 MAX_WORKERS = 20
 
+# deployment runs in two stages, copying packages and scripts,
+# then running the scripts. Each stage adapts its concurrency,
+# starting from TRANSFER_WORKERS and MAX_WORKERS respectively.
+TRANSFER_WORKERS     = 10
+MIN_STAGE_WORKERS    = 2
+MAX_TRANSFER_WORKERS = 40
+MAX_EXECUTE_WORKERS  = 100
+# upload bandwidth of setup node in MB/s, None if unknown
+SETUP_NODE_BANDWIDTH = None
+
+# max number of threads to discover nodes, and the time
+# limit of each discovery command on a node
+MAX_DISCOVERY_WORKERS = 50
+DISCOVERY_TIMEOUT     = 120
+
+# max number of concurrent hostname lookups, and the time
+# a lookup may take before its node is skipped
+MAX_RESOLVE_WORKERS = 50
+RESOLVE_TIMEOUT     = 10
+
+# max number of concurrent requests to bcf controller
+MAX_REST_WORKERS = 8
+
+# deployment engines, a pool of threads per stage, or one
+# event loop driving the commands of all the nodes. The event
+# engine limits the nodes in each stage by slots, and every
+# command it runs by EVENT_COMMAND_TIMEOUT seconds.
+ENGINE_THREAD         = 'thread'
+ENGINE_EVENT          = 'event'
+EVENT_TRANSFER_SLOTS  = 100
+EVENT_EXECUTE_SLOTS   = 500
+EVENT_COMMAND_TIMEOUT = 1800
+
 # root access to all the nodes is required
 DEFAULT_USER = 'root'
 
+# ssh connection multiplexing, one master connection per node.
+# %r, %h and %p are expanded by ssh to remote user, host and port.
+SSH_CONTROL_PATH    = '/tmp/bcf_ssh_%r@%h:%p'
+SSH_CONTROL_PERSIST = 1800
+SSH_CONNECT_TIMEOUT = 30
+
 # key words to specify node role in yaml config
 ROLE_NEUTRON_SERVER = 'controller'
 ROLE_COMPUTE        = 'compute'
@@ -19,6 +58,27 @@ OS_RELEASE_TO_BSN_LIB = { 'juno' : '2015.1',
     'liberty': '2016.1',
 }
 
+# downloads are kept here across runs, addressed by sha256,
+# and revalidated with the server before being reused
+ARTIFACT_CACHE_DIR = '/var/cache/bcf_setup'
+ARTIFACT_TIMEOUT   = 60
+
+# fingerprint of the last successful deployment on a node
+DEPLOY_FINGERPRINT_FILE = '/etc/bcf_setup.fingerprint'
+
+# ivs package fan-out, nodes holding a verified copy serve
+# it over http to FANOUT_DEGREE more nodes in the next wave
+IVS_FANOUT      = False
+FANOUT_DEGREE   = 4
+FANOUT_PORT     = 8787
+FANOUT_DIR      = '/tmp/bcf_fanout'
+FANOUT_TIMEOUT  = 600
+# pid of the http server started by the fan-out on a node
+FANOUT_PID_FILE = '/tmp/bcf_fanout.pid'
+
+# copy all packages and scripts to a node in one tar stream
+BUNDLE_ARTIFACTS = True
+
 # horizon patch
 DEPLOY_HORIZON_PATCH = True
 HORIZON_PATCH_URL = {
@@ -31,6 +91,7 @@ HORIZON_BASE_DIR = '/usr/share/openstack-dashboard'
 
 # constant file, directory names for each node
 PRE_REQUEST_BASH     = 'pre_request.sh'
+FACT_PROBE           = 'fact_probe.py'
 DST_DIR              = '/tmp'
 GENERATED_SCRIPT_DIR = 'generated_script'
 BASH_TEMPLATE_DIR    = 'bash_template'
@@ -39,6 +100,14 @@ SELINUX_TEMPLATE_DIR = 'selinux_template'
 OSPURGE_TEMPLATE_DIR = 'ospurge_template'
 LOG_FILE             = "/var/log/bcf_setup.log"
 
+# json lines of deployment timing events, and number of
+# slowest nodes listed in the timing summary
+TELEMETRY_FILE          = "/var/log/bcf_setup_timing.jsonl"
+TELEMETRY_SLOWEST_NODES = 10
+
+# phases completed by each node, read by --resume
+JOURNAL_FILE = "/var/log/bcf_setup_journal.jsonl"
+
 # constants for ivs config
 INBAND_VLAN     = 4092
 IVS_DAEMON_ARGS = (r'''DAEMON_ARGS=\"--syslog --inband-vlan %(inband_vlan)d%(uplink_interfaces)s%(internal_ports)s\"''')
@@ -67,6 +136,7 @@ PACKSTACK_OPENRC       = '/root/keystonerc_admin'
 
 
 # fuel constants
+FUEL_ASTUTE_YAML       = '/etc/astute.yaml'
 NONE_IP                = 'none'
 BR_KEY_PRIVATE         = 'private'
 BR_NAME_PRIVATE        = 'br-prv'
@@ -80,6 +150,12 @@ TO_BE_CLEANED_BR_NAME  = [BR_NAME_INT, BR_NAME_PRIVATE]
 OS_MGMT_TENANT         = 'os-mgmt'
 HASH_HEADER            = 'BCF-SETUP'
 BCF_CONTROLLER_PORT    = 8443
+# time limit of each request when electing the active controller,
+# and how long the elected controller and cookie are reused
+BCF_PROBE_TIMEOUT      = 5
+BCF_ELECTION_TTL       = 600
+# number of controller requests buffered before writing to LOG_FILE
+REST_LOG_BUFFER        = 64
 ANY                    = 'any'
 
 # this map is not used in the script, but is
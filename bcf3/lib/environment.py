@@ -1,10 +1,22 @@
 import os
 import re
 import socket
+import json
+import collections
 import constants as const
 from helper import Helper
 from rest import RestLib
 
+# environment shared by all nodes, one immutable copy per run
+NodeEnv = collections.namedtuple('NodeEnv', [
+    'dst_dir', 'log', 'openstack_release', 'bsnstacklib_version',
+    'bcf_controllers', 'bcf_controller_ips', 'bcf_controller_user',
+    'bcf_controller_passwd', 'bcf_master', 'setup_node_ip', 'setup_node_dir',
+    'selinux_mode', 'fuel_cluster_id', 'deploy_horizon_patch',
+    'horizon_patch_url', 'horizon_patch', 'horizon_patch_dir',
+    'horizon_base_dir', 'ivs_pkg_map', 'bundle_artifacts'])
+
+
 class Environment(object):
     def __init__(self, config, fuel_cluster_id):
         # fuel cluster id
@@ -79,6 +91,15 @@ class Environment(object):
                 self.ivs_url_map['debug_deb'] = ivs_url
                 self.ivs_pkg_map['debug_deb'] = ivs_pkg
 
+        # let nodes serve the ivs packages to each other
+        self.ivs_fanout = config.get('ivs_fanout', const.IVS_FANOUT)
+
+        # copy packages and scripts to each node in one tar stream
+        self.bundle_artifacts = config.get('bundle_artifacts', const.BUNDLE_ARTIFACTS)
+
+        # upload bandwidth of setup node in MB/s, caps concurrent transfers
+        self.setup_node_bandwidth = config.get('setup_node_bandwidth', const.SETUP_NODE_BANDWIDTH)
+
         # information will be passed on to nodes
         self.skip = False
         if 'default_skip' in config:
@@ -108,6 +129,45 @@ class Environment(object):
             if (not self.bcf_master) or (not self.bcf_cookie):
                 raise Exception("Failed to connect to master BCF controller, quit setup.")
 
+        # one immutable copy of the settings all nodes share
+        self.node_env = NodeEnv(
+            dst_dir               = const.DST_DIR,
+            log                   = const.LOG_FILE,
+            openstack_release     = self.openstack_release,
+            bsnstacklib_version   = self.bsnstacklib_version,
+            bcf_controllers       = tuple(self.bcf_controllers),
+            bcf_controller_ips    = tuple(self.bcf_controller_ips),
+            bcf_controller_user   = self.bcf_controller_user,
+            bcf_controller_passwd = self.bcf_controller_passwd,
+            bcf_master            = self.bcf_master,
+            setup_node_ip         = self.setup_node_ip,
+            setup_node_dir        = self.setup_node_dir,
+            selinux_mode          = self.selinux_mode,
+            fuel_cluster_id       = self.fuel_cluster_id,
+            deploy_horizon_patch  = self.deploy_horizon_patch,
+            horizon_patch_url     = self.horizon_patch_url,
+            horizon_patch         = self.horizon_patch,
+            horizon_patch_dir     = self.horizon_patch_dir,
+            horizon_base_dir      = self.horizon_base_dir,
+            ivs_pkg_map           = tuple(sorted(self.ivs_pkg_map.iteritems())),
+            bundle_artifacts      = self.bundle_artifacts)
+
+
+    def get_node_env(self):
+        """
+        Return the NodeEnv all nodes refer to.
+        """
+        return self.node_env
+
+
+    def get_node_env_log(self):
+        """
+        Shared node fields as one json line, for the log.
+        """
+        fields = self.get_node_env()._asdict()
+        del fields['bcf_controller_passwd']
+        return json.dumps(fields, sort_keys=True)
+
 
     def set_physnet(self, physnet):
         self.physnet = physnet
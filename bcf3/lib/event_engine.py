@@ -0,0 +1,161 @@
+import Queue
+import collections
+from process_supervisor import ProcessSupervisor
+
+
+class Command(object):
+    """
+    Yielded by a task to run a local shell command. The task
+    is resumed with (returncode, output, error, timed_out).
+    """
+    def __init__(self, command, timeout=None, on_line=None):
+        self.command = command
+        self.timeout = timeout
+        self.on_line = on_line
+
+
+class Acquire(object):
+    """
+    Yielded by a task to take one slot of slots.
+    """
+    def __init__(self, slots):
+        self.slots = slots
+
+
+class Release(object):
+    """
+    Yielded by a task to give back one slot of slots.
+    """
+    def __init__(self, slots):
+        self.slots = slots
+
+
+class Slots(object):
+    """
+    Counting semaphore of tasks run by an EventEngine.
+    """
+    def __init__(self, name, count):
+        self.name    = name
+        self.free    = count
+        self.waiters = collections.deque()
+
+    def acquire(self):
+        return Acquire(self)
+
+    def release(self):
+        return Release(self)
+
+
+class EventEngine(object):
+    """
+    Run tasks, which are generators yielding Command, Acquire
+    and Release, from the calling thread. Commands are started
+    through ProcessSupervisor and the task is resumed once its
+    command exits, so a task costs no thread while it waits.
+    Ctrl-C cancels all tasks and kills their commands.
+    """
+
+    # seconds to wait for a command before checking for Ctrl-C
+    __poll_interval = 0.5
+
+    def __init__(self, on_error=None):
+        self.on_error = on_error
+        # task -> slots it holds
+        self.tasks    = {}
+        # task -> its running job
+        self.jobs     = {}
+        # (task, value) to be resumed
+        self.ready    = collections.deque()
+        # (task, job) of exited commands, put by the supervisor
+        self.events   = Queue.Queue()
+
+
+    def spawn(self, task):
+        self.tasks[task] = []
+        self.ready.append((task, None))
+
+
+    def __finish__(self, task):
+        for slots in self.tasks.pop(task):
+            self.__release__(slots)
+
+
+    def __release__(self, slots):
+        if slots.waiters:
+            task = slots.waiters.popleft()
+            self.tasks[task].append(slots)
+            self.ready.append((task, None))
+        else:
+            slots.free += 1
+
+
+    def __step__(self, task, value):
+        try:
+            request = task.send(value)
+        except StopIteration:
+            self.__finish__(task)
+            return
+        except Exception as e:
+            self.__finish__(task)
+            if self.on_error:
+                self.on_error(e)
+            return
+
+        if isinstance(request, Command):
+            self.jobs[task] = ProcessSupervisor.submit(
+                request.command, request.timeout, request.on_line,
+                lambda job: self.events.put((task, job)))
+        elif isinstance(request, Acquire):
+            if request.slots.free > 0:
+                request.slots.free -= 1
+                self.tasks[task].append(request.slots)
+                self.ready.append((task, None))
+            else:
+                request.slots.waiters.append(task)
+        elif isinstance(request, Release):
+            self.tasks[task].remove(request.slots)
+            self.__release__(request.slots)
+            self.ready.append((task, None))
+        else:
+            raise Exception("Task yielded unknown request %(request)r" %
+                            {'request' : request})
+
+
+    def run(self):
+        """
+        Run all spawned tasks to the end. Return False if they
+        were cancelled by Ctrl-C.
+        """
+        try:
+            while self.tasks:
+                while self.ready:
+                    task, value = self.ready.popleft()
+                    self.__step__(task, value)
+                if not self.jobs:
+                    if self.tasks:
+                        raise Exception("Tasks wait for slots nobody holds")
+                    break
+                try:
+                    task, job = self.events.get(timeout=EventEngine.__poll_interval)
+                except Queue.Empty:
+                    continue
+                del self.jobs[task]
+                self.__step__(task, (job.proc.returncode, job.output,
+                                     job.error, job.timed_out))
+        except KeyboardInterrupt:
+            self.cancel()
+            return False
+        return True
+
+
+    def cancel(self):
+        """
+        Kill running commands and close all tasks.
+        """
+        for job in self.jobs.values():
+            ProcessSupervisor.cancel(job)
+        for task in self.tasks.keys():
+            task.close()
+        self.tasks.clear()
+        self.jobs.clear()
+        self.ready.clear()
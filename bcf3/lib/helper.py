@@ -1,47 +1,55 @@
 import os
 import sys
 import time
+import Queue
+import atexit
+import re
 import json
 import yaml
 import socket
+import hashlib
 import string
 import netaddr
 import threading
 import constants as const
 import subprocess32 as subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from node import Node
 from rest import RestLib
 from bridge import Bridge
 from threading import Lock
 from membership_rule import MembershipRule
+from telemetry import Telemetry
+from artifact_cache import ArtifactCache
+from template_registry import TemplateRegistry
+from process_supervisor import ProcessSupervisor
 
 
 class Helper(object):
 
-    # lock to serialize stdout of different threads
-    __print_lock = Lock()
+    # messages of all threads go through one queue to the
+    # console writer thread, see safe_print
+    __print_queue = Queue.Queue()
+    __print_writer = None
+    __print_writer_lock = Lock()
 
-    @staticmethod
-    def __read_output__(pipe, func):
-        """
-        Read from a pipe, remove unknown spaces.
-        """
-        for lines in iter(pipe.readline, ''):
-            for line in lines.splitlines(True):
-                l = ''.join(filter(lambda x: 32 <= ord(x) <= 126, line.strip()))
-                if len(l):
-                    func(l + '\n')
-        pipe.close()
+    # hostname -> (ip, error) of the lookups done in this run
+    __resolved = {}
+    __resolved_lock = Lock()
 
+    # (hostname, user) of every ssh master opened in this run,
+    # including nodes which failed discovery afterwards
+    __ssh_sessions = set()
+    __ssh_sessions_lock = Lock()
 
     @staticmethod
-    def __kill_on_timeout__(command, event, timeout, proc):
+    def print_output_line(line):
         """
-        Kill a thread when timeout expires.
+        Print a line of command output, remove unknown spaces.
         """
-        if not event.wait(timeout):
-            Helper.safe_print('Timeout when running %s' % command)
-            proc.kill()
+        l = ''.join(filter(lambda x: 32 <= ord(x) <= 126, line.strip()))
+        if len(l):
+            Helper.safe_print(l + '\n')
 
 
     @staticmethod
@@ -55,71 +63,183 @@ class Helper(object):
 
 
     @staticmethod
-    def run_command_on_local_without_timeout(command):
-        output, error = subprocess.Popen(command,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE,
-            shell=True).communicate()
+    def get_ssh_mux_options():
+        """
+        ssh options to reuse the master connection of a node.
+        ssh falls back to a direct connection if there is
+        no master.
+        """
+        return (r'''-o ControlMaster=no -o ControlPath=%(control_path)s''' %
+               {'control_path' : const.SSH_CONTROL_PATH})
+
+
+    @staticmethod
+    def get_ssh_session_commands(hostname, user=None, passwd=None):
+        """
+        Return the commands to check for the ssh master connection
+        to a node and to open it. The master is detached from
+        stdio so it doesn't hold the pipes of the caller.
+        """
+        target = hostname
+        if user:
+            target = (r'''%(user)s@%(hostname)s''' %
+                     {'user' : user, 'hostname' : hostname})
+        check_cmd = (r'''ssh -o ControlPath=%(control_path)s -O check %(target)s > /dev/null 2>&1''' %
+                    {'control_path' : const.SSH_CONTROL_PATH,
+                     'target'       : target})
+        master_cmd = (r'''ssh -oStrictHostKeyChecking=no -o LogLevel=quiet -o ConnectTimeout=%(connect_timeout)d -o ControlMaster=yes -o ControlPath=%(control_path)s -o ControlPersist=%(control_persist)d -fN %(target)s < /dev/null > /dev/null 2>&1''' %
+                     {'connect_timeout' : const.SSH_CONNECT_TIMEOUT,
+                      'control_path'    : const.SSH_CONTROL_PATH,
+                      'control_persist' : const.SSH_CONTROL_PERSIST,
+                      'target'          : target})
+        if passwd:
+            master_cmd = (r'''sshpass -p %(pwd)s %(master_cmd)s''' %
+                         {'pwd' : passwd, 'master_cmd' : master_cmd})
+        with Helper.__ssh_sessions_lock:
+            Helper.__ssh_sessions.add((hostname, user))
+        return check_cmd, master_cmd
+
+
+    @staticmethod
+    def open_ssh_session(hostname, user=None, passwd=None):
+        """
+        Open the ssh master connection to a node if there is
+        not one yet.
+        """
+        check_cmd, master_cmd = Helper.get_ssh_session_commands(hostname, user, passwd)
+        if subprocess.call(check_cmd, shell=True) == 0:
+            return
+        subprocess.call(master_cmd, shell=True)
+
+
+    @staticmethod
+    def close_ssh_session(hostname, user=None):
+        """
+        Tear down the ssh master connection to a node.
+        """
+        target = hostname
+        if user:
+            target = (r'''%(user)s@%(hostname)s''' %
+                     {'user' : user, 'hostname' : hostname})
+        cmd = (r'''ssh -o ControlPath=%(control_path)s -O exit %(target)s > /dev/null 2>&1''' %
+              {'control_path' : const.SSH_CONTROL_PATH,
+               'target'       : target})
+        subprocess.call(cmd, shell=True)
+
+
+    @staticmethod
+    def run_command_on_local_without_timeout(command, timeout=None):
+        """
+        Run a shell command on local node and return its output.
+        If timeout is given, the whole process group is killed
+        when it expires and the error tells so.
+        """
+        code, output, error, timed_out = ProcessSupervisor.run(command, timeout)
+        if timed_out:
+            return '', ('Timeout when running %(command)s' % {'command' : command})
         return output, error
 
 
     @staticmethod
-    def run_command_on_remote_with_key_without_timeout(node_ip, command):
+    def get_remote_command_with_key_without_log(node_ip, command):
+        return (r'''ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(hostname)s "%(remote_cmd)s"''' %
+               {'mux_opts'   : Helper.get_ssh_mux_options(),
+                'hostname'   : node_ip,
+                'remote_cmd' : command,
+               })
+
+
+    @staticmethod
+    def run_command_on_remote_with_key_without_timeout(node_ip, command, timeout=None):
         """
         Run cmd on remote node.
         """
-        local_cmd = (r'''ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(hostname)s "%(remote_cmd)s"''' %
-                    {'hostname'   : node_ip,
-                     'remote_cmd' : command,
-                    })
-        return Helper.run_command_on_local_without_timeout(local_cmd)
+        local_cmd = Helper.get_remote_command_with_key_without_log(node_ip, command)
+        return Helper.run_command_on_local_without_timeout(local_cmd, timeout)
 
 
     @staticmethod
     def run_command_on_local(command, timeout=1800):
         """
-        Use subprocess to run a shell command on local node.
-        A watcher threading stops the subprocess when it expires.
-        stdout and stderr are captured.
+        Run a shell command on local node through the process
+        supervisor, which kills it when timeout expires.
+        stdout and stderr are printed. Return the exit code.
         """
-        # TODO: fix it in python 2.6
-        event = threading.Event()
-        p = subprocess.Popen(
-            command, shell=True, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, close_fds=True, bufsize=1)
+        code, output, error, timed_out = ProcessSupervisor.run(
+            command, timeout, Helper.print_output_line)
+        if timed_out:
+            Helper.safe_print('Timeout when running %s\n' % command)
+        return code
 
-        tout = threading.Thread(
-            target=Helper.__read_output__, args=(p.stdout, Helper.safe_print))
-        terr = threading.Thread(
-            target=Helper.__read_output__, args=(p.stderr, Helper.safe_print))
-        for t in (tout, terr):
-            t.daemon = True
-            t.start()
 
-        watcher = threading.Thread(
-            target=Helper.__kill_on_timeout__, args=(command, event, timeout, p))
-        watcher.daemon = True
-        watcher.start()
+    @staticmethod
+    def __write_console__():
+        """
+        Console writer thread. Batch whatever is queued into
+        one write. None in the queue stops the writer.
+        """
+        while True:
+            messages = [Helper.__print_queue.get()]
+            while messages[-1] is not None:
+                try:
+                    messages.append(Helper.__print_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = messages[-1] is None
+            if stop:
+                messages.pop()
+            sys.stdout.write(''.join(messages))
+            sys.stdout.flush()
+            if stop:
+                return
 
-        p.wait()
-        event.set()
-        for t in (tout, terr):
-            t.join()
+
+    @staticmethod
+    def close_console():
+        """
+        Flush pending messages, stop the writer thread and
+        clean up the terminal.
+        """
+        with Helper.__print_writer_lock:
+            if not Helper.__print_writer:
+                return
+            Helper.__print_queue.put(None)
+            Helper.__print_writer.join()
+            Helper.__print_writer = None
+            subprocess.call('stty sane', shell=True)
 
 
     @staticmethod
     def safe_print(message):
         """
-        Grab the lock and print to stdout.
-        The lock is to serialize messages from
-        different thread. 'stty sane' is to
-        clean up any hiden space.
+        Queue message to the console writer thread.
+        One writer keeps messages from different threads
+        apart and in order without a lock per message.
+        'stty sane' is to clean up any hiden space, it runs
+        only when the writer starts and stops.
         """
-        with Helper.__print_lock:
-            subprocess.call('stty sane', shell=True)
-            sys.stdout.write(message)
-            sys.stdout.flush()
-            subprocess.call('stty sane', shell=True)
+        if not Helper.__print_writer:
+            with Helper.__print_writer_lock:
+                if not Helper.__print_writer:
+                    subprocess.call('stty sane', shell=True)
+                    writer = threading.Thread(target=Helper.__write_console__)
+                    writer.daemon = True
+                    writer.start()
+                    Helper.__print_writer = writer
+                    atexit.register(Helper.close_console)
+        Helper.__print_queue.put(message)
+
+
+    @staticmethod
+    def get_remote_command_with_passwd(node, command):
+        return (r'''sshpass -p %(pwd)s ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(user)s@%(hostname)s >> %(log)s 2>&1 "echo %(pwd)s | sudo -S %(remote_cmd)s"''' %
+               {'mux_opts'   : Helper.get_ssh_mux_options(),
+                'user'       : node.user,
+                'hostname'   : node.hostname,
+                'pwd'        : node.passwd,
+                'log'        : node.log,
+                'remote_cmd' : command,
+               })
 
 
     @staticmethod
@@ -127,53 +247,51 @@ class Helper(object):
         """
         Run cmd on remote node.
         """
-        local_cmd = (r'''sshpass -p %(pwd)s ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(user)s@%(hostname)s >> %(log)s 2>&1 "echo %(pwd)s | sudo -S %(remote_cmd)s"''' %
-                   {'user'       : node.user,
-                    'hostname'   : node.hostname,
-                    'pwd'        : node.passwd,
-                    'log'        : node.log,
-                    'remote_cmd' : command,
-                   })
-        Helper.run_command_on_local(local_cmd)
+        return Helper.run_command_on_local(
+            Helper.get_remote_command_with_passwd(node, command))
 
 
     @staticmethod
-    def run_command_on_remote_with_passwd_without_timeout(hostname, user, passwd, command):
-        local_cmd = (r'''sshpass -p %(pwd)s ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(user)s@%(hostname)s "echo %(pwd)s | sudo -S %(remote_cmd)s"''' %
-                   {'user'       : user,
-                    'hostname'   : hostname,
-                    'pwd'        : passwd,
-                    'log'        : const.LOG_FILE,
-                    'remote_cmd' : command,
-                   })
-        return Helper.run_command_on_local_without_timeout(local_cmd)
+    def get_remote_command_with_passwd_without_log(hostname, user, passwd, command):
+        return (r'''sshpass -p %(pwd)s ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(user)s@%(hostname)s "echo %(pwd)s | sudo -S %(remote_cmd)s"''' %
+               {'mux_opts'   : Helper.get_ssh_mux_options(),
+                'user'       : user,
+                'hostname'   : hostname,
+                'pwd'        : passwd,
+                'log'        : const.LOG_FILE,
+                'remote_cmd' : command,
+               })
 
 
     @staticmethod
-    def copy_file_to_remote_with_passwd(node, src_file, dst_dir, dst_file, mode=777):
-        """
-        Copy file from local node to remote node,
-        create directory if remote directory doesn't exist,
-        change the file mode as well.
-        """
-        mkdir_cmd = (r'''mkdir -p %(dst_dir)s''' % {'dst_dir' : dst_dir})
-        Helper.run_command_on_remote_with_passwd(node, mkdir_cmd)
-        scp_cmd = (r'''sshpass -p %(pwd)s scp %(src_file)s  %(user)s@%(hostname)s:%(dst_dir)s/%(dst_file)s >> %(log)s 2>&1''' %
-                  {'user'       : node.user,
-                   'hostname'   : node.hostname,
-                   'pwd'        : node.passwd,
-                   'log'        : node.log,
-                   'src_file'   : src_file,
-                   'dst_dir'    : dst_dir,
-                   'dst_file'   : dst_file
-                  })
-        Helper.run_command_on_local(scp_cmd)
-        chmod_cmd = (r'''chmod -R %(mode)d %(dst_dir)s/%(dst_file)s''' %
-                    {'mode'     : mode,
-                     'dst_dir'  : dst_dir,
-                     'dst_file' : dst_file
-                    })
-        Helper.run_command_on_remote_with_passwd(node, chmod_cmd)
+    def run_command_on_remote_with_passwd_without_timeout(hostname, user, passwd, command, timeout=None):
+        local_cmd = Helper.get_remote_command_with_passwd_without_log(
+            hostname, user, passwd, command)
+        return Helper.run_command_on_local_without_timeout(local_cmd, timeout)
+
+
+    @staticmethod
+    def get_scp_command_with_passwd(node, src_file, dst_dir, dst_file):
+        return (r'''sshpass -p %(pwd)s scp %(mux_opts)s %(src_file)s  %(user)s@%(hostname)s:%(dst_dir)s/%(dst_file)s >> %(log)s 2>&1''' %
+               {'mux_opts'   : Helper.get_ssh_mux_options(),
+                'user'       : node.user,
+                'hostname'   : node.hostname,
+                'pwd'        : node.passwd,
+                'log'        : node.log,
+                'src_file'   : src_file,
+                'dst_dir'    : dst_dir,
+                'dst_file'   : dst_file
+               })
+
+
+    @staticmethod
+    def get_remote_command_with_key(node, command):
+        return (r'''ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(hostname)s >> %(log)s 2>&1 "%(remote_cmd)s"''' %
+               {'mux_opts'   : Helper.get_ssh_mux_options(),
+                'hostname'   : node.hostname,
+                'log'        : node.log,
+                'remote_cmd' : command
+               })
 
 
     @staticmethod
@@ -181,227 +299,221 @@ class Helper(object):
         """
         Run cmd on remote node.
         """
-        local_cmd = (r'''ssh -t -oStrictHostKeyChecking=no -o LogLevel=quiet %(hostname)s >> %(log)s 2>&1 "%(remote_cmd)s"''' %
-                   {'hostname'   : node.hostname,
-                    'log'        : node.log,
-                    'remote_cmd' : command
-                   })
-        Helper.run_command_on_local(local_cmd)
+        return Helper.run_command_on_local(
+            Helper.get_remote_command_with_key(node, command))
+
+
+    @staticmethod
+    def get_scp_command_with_key(node, src_file, dst_dir, dst_file):
+        return (r'''scp %(mux_opts)s %(src_file)s %(hostname)s:%(dst_dir)s/%(dst_file)s >> %(log)s 2>&1''' %
+               {'mux_opts'   : Helper.get_ssh_mux_options(),
+                'hostname'   : node.hostname,
+                'log'        : node.log,
+                'src_file'   : src_file,
+                'dst_dir'    : dst_dir,
+                'dst_file'   : dst_file
+               })
 
 
     @staticmethod
-    def copy_file_to_remote_with_key(node, src_file, dst_dir, dst_file, mode=777):
+    def __get_template_path__(node, template_dir, template):
+        return (r'''%(setup_node_dir)s/%(deploy_mode)s/%(template_dir)s/%(template)s''' %
+               {'setup_node_dir' : node.setup_node_dir,
+                'deploy_mode'    : node.deploy_mode,
+                'template_dir'   : template_dir,
+                'template'       : template})
+
+
+    @staticmethod
+    def __get_template_paths__(node):
         """
-        Copy file from local node to remote node,
-        create directory if remote directory doesn't exist,
-        change the file mode as well.
+        Return {script kind : template path} of all templates node needs.
         """
-        mkdir_cmd = (r'''mkdir -p %(dst_dir)s''' % {'dst_dir' : dst_dir})
-        Helper.run_command_on_remote_with_key(node, mkdir_cmd)
-        scp_cmd = (r'''scp %(src_file)s %(hostname)s:%(dst_dir)s/%(dst_file)s >> %(log)s 2>&1''' %
-                  {'hostname'   : node.hostname,
-                   'log'        : node.log,
-                   'src_file'   : src_file,
-                   'dst_dir'    : dst_dir,
-                   'dst_file'   : dst_file
-                  })
-        Helper.run_command_on_local(scp_cmd)
-        chmod_cmd = (r'''chmod -R %(mode)d %(dst_dir)s/%(dst_file)s''' %
-                    {'mode'     : mode,
-                     'dst_dir'  : dst_dir,
-                     'dst_file' : dst_file
-                    })
-        Helper.run_command_on_remote_with_key(node, chmod_cmd)
+        paths = {
+            'bash'   : Helper.__get_template_path__(node, const.BASH_TEMPLATE_DIR,
+                           r'''%(os)s_%(os_version)s.sh''' %
+                           {'os' : node.os, 'os_version' : node.os_version}),
+            'puppet' : Helper.__get_template_path__(node, const.PUPPET_TEMPLATE_DIR,
+                           r'''%(os)s_%(role)s.pp''' %
+                           {'os' : node.os, 'role' : node.role})}
+        if node.os == const.CENTOS:
+            paths['selinux'] = Helper.__get_template_path__(node, const.SELINUX_TEMPLATE_DIR,
+                                   r'''%(os)s.te''' % {'os' : node.os})
+        if node.role == const.ROLE_NEUTRON_SERVER:
+            paths['ospurge'] = Helper.__get_template_path__(node, const.OSPURGE_TEMPLATE_DIR,
+                                   r'''%(os)s.sh''' % {'os' : node.os})
+        return paths
 
 
     @staticmethod
-    def generate_scripts_for_ubuntu(node):
-        # generate bash script
-        with open((r'''%(setup_node_dir)s/%(deploy_mode)s/%(bash_template_dir)s/%(bash_template)s_%(os_version)s.sh''' %
-                  {'setup_node_dir'    : node.setup_node_dir,
-                   'deploy_mode'       : node.deploy_mode,
-                   'bash_template_dir' : const.BASH_TEMPLATE_DIR,
-                   'bash_template'     : const.UBUNTU,
-                   'os_version'        : node.os_version}), "r") as bash_template_file:
-            bash_template = bash_template_file.read()
-            is_controller = False
-            if node.role == const.ROLE_NEUTRON_SERVER:
-                is_controller = True
-            bash = (bash_template %
-                   {'install_ivs'         : str(node.install_ivs).lower(),
-                    'install_bsnstacklib' : str(node.install_bsnstacklib).lower(),
-                    'install_all'         : str(node.install_all).lower(),
-                    'is_controller'       : str(is_controller).lower(),
-                    'deploy_horizon_patch': str(node.deploy_horizon_patch).lower(),
-                    'ivs_version'         : node.ivs_version,
-                    'bsnstacklib_version' : node.bsnstacklib_version,
-                    'dst_dir'             : node.dst_dir,
-                    'hostname'            : node.hostname,
-                    'ivs_pkg'             : node.ivs_pkg,
-                    'horizon_patch'       : node.horizon_patch,
-                    'horizon_patch_dir'   : node.horizon_patch_dir,
-                    'horizon_base_dir'    : node.horizon_base_dir,
-                    'ivs_debug_pkg'       : node.ivs_debug_pkg,
-                    'ovs_br'              : node.get_all_ovs_brs(),
-                    'br-int'              : const.BR_NAME_INT})
-        bash_script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s.sh''' %
-                           {'setup_node_dir'       : node.setup_node_dir,
-                            'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
-                            'hostname'             : node.hostname})
-        with open(bash_script_path, "w") as bash_file:
-            bash_file.write(bash)
-        node.set_bash_script_path(bash_script_path)
+    def __write_script__(node, suffix, content):
+        script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s%(suffix)s''' %
+                      {'setup_node_dir'       : node.setup_node_dir,
+                       'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
+                       'hostname'             : node.hostname,
+                       'suffix'               : suffix})
+        with open(script_path, "w") as script_file:
+            script_file.write(content)
+        return script_path
 
-        # generate puppet script
-        ivs_daemon_args = (const.IVS_DAEMON_ARGS %
-                          {'inband_vlan'       : const.INBAND_VLAN,
-                           'internal_ports'    : node.get_ivs_internal_ports(),
-                           'uplink_interfaces' : node.get_uplink_intfs_for_ivs()})
-        with open((r'''%(setup_node_dir)s/%(deploy_mode)s/%(puppet_template_dir)s/%(puppet_template)s_%(role)s.pp''' %
-                  {'setup_node_dir'      : node.setup_node_dir,
-                   'deploy_mode'         : node.deploy_mode,
-                   'puppet_template_dir' : const.PUPPET_TEMPLATE_DIR,
-                   'puppet_template'     : const.UBUNTU,
-                   'role'                : node.role}), "r") as puppet_template_file:
-            puppet_template = puppet_template_file.read()
-            puppet = (puppet_template %
-                     {'ivs_daemon_args'       : ivs_daemon_args,
-                      'network_vlan_ranges'   : node.get_network_vlan_ranges(),
-                      'bcf_controllers'       : node.get_controllers_for_neutron(),
-                      'bcf_controller_user'   : node.bcf_controller_user,
-                      'bcf_controller_passwd' : node.bcf_controller_passwd,
-                      'port_ips'              : node.get_ivs_internal_port_ips()})
-        puppet_script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s.pp''' %
-                             {'setup_node_dir'       : node.setup_node_dir,
-                              'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
-                              'hostname'             : node.hostname})
-        with open(puppet_script_path, "w") as puppet_file:
-            puppet_file.write(puppet)
-        node.set_puppet_script_path(puppet_script_path)
 
-        # generate ospurge script
-        if node.role != const.ROLE_NEUTRON_SERVER:
+    @staticmethod
+    def load_templates(nodes):
+        """
+        Load and validate the templates of all nodes before
+        rendering any of them.
+        """
+        for node in nodes:
+            if node.os not in [const.CENTOS, const.UBUNTU]:
+                continue
+            for kind, path in Helper.__get_template_paths__(node).iteritems():
+                TemplateRegistry.get(path)
+
+
+    @staticmethod
+    def generate_scripts(node):
+        """
+        Render the bash, puppet, selinux (centos only) and
+        ospurge (neutron server only) scripts of node.
+        """
+        if node.os not in [const.CENTOS, const.UBUNTU]:
             return
-        openrc = const.PACKSTACK_OPENRC
-        if node.fuel_cluster_id:
-            openrc = const.FUEL_OPENRC
-        with open((r'''%(setup_node_dir)s/%(deploy_mode)s/%(ospurge_template_dir)s/%(ospurge_template)s.sh''' %
-                  {'setup_node_dir'       : node.setup_node_dir,
-                   'deploy_mode'          : node.deploy_mode,
-                   'ospurge_template_dir' : const.OSPURGE_TEMPLATE_DIR,
-                   'ospurge_template'     : const.UBUNTU}), "r") as ospurge_template_file:
-            ospurge_template = ospurge_template_file.read()
-            ospurge = (ospurge_template % {'openrc' : openrc})
-        ospurge_script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s_ospurge.sh''' %
-                              {'setup_node_dir'       : node.setup_node_dir,
-                               'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
-                               'hostname'             : node.hostname})
-        with open(ospurge_script_path, "w") as ospurge_file:
-            ospurge_file.write(ospurge)
-        node.set_ospurge_script_path(ospurge_script_path)
-
-
-    @staticmethod
-    def generate_scripts_for_centos(node):
+        start = time.time()
+        paths = Helper.__get_template_paths__(node)
 
         # generate bash script
-        with open((r'''%(setup_node_dir)s/%(deploy_mode)s/%(bash_template_dir)s/%(bash_template)s_%(os_version)s.sh''' %
-                  {'setup_node_dir'    : node.setup_node_dir,
-                   'deploy_mode'       : node.deploy_mode,
-                   'bash_template_dir' : const.BASH_TEMPLATE_DIR,
-                   'bash_template'     : const.CENTOS,
-                   'os_version'        : node.os_version}), "r") as bash_template_file:
-            bash_template = bash_template_file.read()
-            is_controller = False
-            if node.role == const.ROLE_NEUTRON_SERVER:
-                is_controller = True
-            bash = (bash_template %
-                   {'install_ivs'         : str(node.install_ivs).lower(),
-                    'install_bsnstacklib' : str(node.install_bsnstacklib).lower(),
-                    'install_all'         : str(node.install_all).lower(),
-                    'is_controller'       : str(is_controller).lower(),
-                    'deploy_horizon_patch': str(node.deploy_horizon_patch).lower(),
-                    'ivs_version'         : node.ivs_version,
-                    'bsnstacklib_version' : node.bsnstacklib_version,
-                    'dst_dir'             : node.dst_dir,
-                    'hostname'            : node.hostname,
-                    'ivs_pkg'             : node.ivs_pkg,
-                    'horizon_patch'       : node.horizon_patch,
-                    'horizon_patch_dir'   : node.horizon_patch_dir,
-                    'horizon_base_dir'    : node.horizon_base_dir,
-                    'ivs_debug_pkg'       : node.ivs_debug_pkg,
-                    'ovs_br'              : node.get_all_ovs_brs(),
-                    'br-int'              : const.BR_NAME_INT})
-        bash_script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s.sh''' %
-                           {'setup_node_dir'       : node.setup_node_dir,
-                            'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
-                            'hostname'             : node.hostname})
-        with open(bash_script_path, "w") as bash_file:
-            bash_file.write(bash)
-        node.set_bash_script_path(bash_script_path)
+        is_controller = False
+        if node.role == const.ROLE_NEUTRON_SERVER:
+            is_controller = True
+        bash = TemplateRegistry.render(paths['bash'],
+               {'install_ivs'         : str(node.install_ivs).lower(),
+                'install_bsnstacklib' : str(node.install_bsnstacklib).lower(),
+                'install_all'         : str(node.install_all).lower(),
+                'is_controller'       : str(is_controller).lower(),
+                'deploy_horizon_patch': str(node.deploy_horizon_patch).lower(),
+                'ivs_version'         : node.ivs_version,
+                'bsnstacklib_version' : node.bsnstacklib_version,
+                'dst_dir'             : node.dst_dir,
+                'hostname'            : node.hostname,
+                'ivs_pkg'             : node.ivs_pkg,
+                'horizon_patch'       : node.horizon_patch,
+                'horizon_patch_dir'   : node.horizon_patch_dir,
+                'horizon_base_dir'    : node.horizon_base_dir,
+                'ivs_debug_pkg'       : node.ivs_debug_pkg,
+                'ovs_br'              : node.get_all_ovs_brs(),
+                'br-int'              : const.BR_NAME_INT})
+        node.set_bash_script_path(Helper.__write_script__(node, '.sh', bash))
 
         # generate puppet script
         ivs_daemon_args = (const.IVS_DAEMON_ARGS %
                           {'inband_vlan'       : const.INBAND_VLAN,
                            'internal_ports'    : node.get_ivs_internal_ports(),
                            'uplink_interfaces' : node.get_uplink_intfs_for_ivs()})
-        with open((r'''%(setup_node_dir)s/%(deploy_mode)s/%(puppet_template_dir)s/%(puppet_template)s_%(role)s.pp''' %
-                  {'setup_node_dir'      : node.setup_node_dir,
-                   'deploy_mode'         : node.deploy_mode,
-                   'puppet_template_dir' : const.PUPPET_TEMPLATE_DIR,
-                   'puppet_template'     : const.CENTOS,
-                   'role'                : node.role}), "r") as puppet_template_file:
-            puppet_template = puppet_template_file.read()
-            puppet = (puppet_template %
-                     {'ivs_daemon_args'       : ivs_daemon_args,
-                      'network_vlan_ranges'   : node.get_network_vlan_ranges(),
-                      'bcf_controllers'       : node.get_controllers_for_neutron(),
-                      'bcf_controller_user'   : node.bcf_controller_user,
-                      'bcf_controller_passwd' : node.bcf_controller_passwd,
-                      'selinux_mode'          : node.selinux_mode,
-                      'port_ips'              : node.get_ivs_internal_port_ips()})
-        puppet_script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s.pp''' %
-                             {'setup_node_dir'       : node.setup_node_dir,
-                              'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
-                              'hostname'             : node.hostname})
-        with open(puppet_script_path, "w") as puppet_file:
-            puppet_file.write(puppet)
-        node.set_puppet_script_path(puppet_script_path)
-
-        # generate selinux script
-        selinux_script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s.te''' %
-                              {'setup_node_dir'       : node.setup_node_dir,
-                               'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
-                               'hostname'             : node.hostname})
-        subprocess.call(r'''cp %(setup_node_dir)s/%(deploy_mode)s/%(selinux_template_dir)s/%(selinux_template)s.te %(selinux_script_path)s''' %
-                       {'setup_node_dir'       : node.setup_node_dir,
-                        'deploy_mode'          : node.deploy_mode,
-                        'selinux_template_dir' : const.SELINUX_TEMPLATE_DIR,
-                        'selinux_template'     : const.CENTOS,
-                        'selinux_script_path'  : selinux_script_path}, shell=True)
-        node.set_selinux_script_path(selinux_script_path)
+        puppet = TemplateRegistry.render(paths['puppet'],
+                 {'ivs_daemon_args'       : ivs_daemon_args,
+                  'network_vlan_ranges'   : node.get_network_vlan_ranges(),
+                  'bcf_controllers'       : node.get_controllers_for_neutron(),
+                  'bcf_controller_user'   : node.bcf_controller_user,
+                  'bcf_controller_passwd' : node.bcf_controller_passwd,
+                  'selinux_mode'          : node.selinux_mode,
+                  'port_ips'              : node.get_ivs_internal_port_ips()})
+        node.set_puppet_script_path(Helper.__write_script__(node, '.pp', puppet))
+
+        # generate selinux script, which is copied as it is
+        if 'selinux' in paths:
+            selinux, placeholders = TemplateRegistry.get(paths['selinux'])
+            node.set_selinux_script_path(Helper.__write_script__(node, '.te', selinux))
 
         # generate ospurge script
-        if node.role != const.ROLE_NEUTRON_SERVER:
-            return
-        openrc = const.PACKSTACK_OPENRC
-        if node.fuel_cluster_id:
-            openrc = const.FUEL_OPENRC
-        with open((r'''%(setup_node_dir)s/%(deploy_mode)s/%(ospurge_template_dir)s/%(ospurge_template)s.sh''' %
-                  {'setup_node_dir'       : node.setup_node_dir,
-                   'deploy_mode'          : node.deploy_mode,
-                   'ospurge_template_dir' : const.OSPURGE_TEMPLATE_DIR,
-                   'ospurge_template'     : const.CENTOS}), "r") as ospurge_template_file:
-            ospurge_template = ospurge_template_file.read()
-            ospurge = (ospurge_template % {'openrc' : openrc})
-        ospurge_script_path = (r'''%(setup_node_dir)s/%(generated_script_dir)s/%(hostname)s_ospurge.sh''' %
-                              {'setup_node_dir'       : node.setup_node_dir,
-                               'generated_script_dir' : const.GENERATED_SCRIPT_DIR,
-                               'hostname'             : node.hostname})
-        with open(ospurge_script_path, "w") as ospurge_file:
-            ospurge_file.write(ospurge)
-        node.set_ospurge_script_path(ospurge_script_path)
-        
+        if 'ospurge' in paths:
+            openrc = const.PACKSTACK_OPENRC
+            if node.fuel_cluster_id:
+                openrc = const.FUEL_OPENRC
+            ospurge = TemplateRegistry.render(paths['ospurge'], {'openrc' : openrc})
+            node.set_ospurge_script_path(Helper.__write_script__(node, '_ospurge.sh', ospurge))
+        Telemetry.record(node.hostname, 'generate', start)
+
+
+    @staticmethod
+    def compute_fingerprint(node):
+        """
+        Digest the rendered scripts of node together with the
+        fields which decide what gets installed.
+        """
+        sha = hashlib.sha256()
+        for field in [node.hostname, node.role, node.os, node.os_version,
+                      node.deploy_mode, node.ivs_pkg, node.ivs_debug_pkg,
+                      node.ivs_version, node.bsnstacklib_version,
+                      node.install_ivs, node.install_bsnstacklib, node.install_all,
+                      node.deploy_horizon_patch, node.horizon_patch]:
+            sha.update(str(field) + '\0')
+        for path in [node.bash_script_path, node.puppet_script_path,
+                     node.selinux_script_path, node.ospurge_script_path]:
+            if path:
+                with open(path, 'rb') as script_file:
+                    sha.update(script_file.read())
+            sha.update('\0')
+        node.set_fingerprint(sha.hexdigest())
+
+
+    @staticmethod
+    def get_fingerprint_check_command(node):
+        """
+        Return the remote command which prints the fingerprint
+        node was deployed with last time.
+        """
+        return (r'''cat %(fingerprint_file)s''' %
+               {'fingerprint_file' : const.DEPLOY_FINGERPRINT_FILE})
+
+
+    @staticmethod
+    def has_fingerprint(node, output):
+        return node.fingerprint in re.findall(r'[0-9a-f]{64}', output or '')
+
+
+    @staticmethod
+    def is_node_unchanged(node):
+        """
+        Check if node was deployed successfully with
+        the same fingerprint before.
+        """
+        output, errors = Helper.run_command_on_remote_with_output(node,
+            Helper.get_fingerprint_check_command(node), const.DISCOVERY_TIMEOUT)
+        return Helper.has_fingerprint(node, output)
+
+
+    @staticmethod
+    def get_node_facts(hostname, user=None, passwd=None):
+        """
+        Run the fact probe on a node and return (facts, errors).
+        The probe is piped to the remote python, so a node costs
+        one ssh session no matter how many facts are gathered.
+        """
+        probe = (r'''%(setup_node_dir)s/%(fact_probe)s''' %
+                {'setup_node_dir' : os.getcwd(),
+                 'fact_probe'     : const.FACT_PROBE})
+        if passwd:
+            cmd = (r'''sshpass -p %(pwd)s ssh -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(user)s@%(hostname)s "python -" < %(probe)s''' %
+                  {'mux_opts' : Helper.get_ssh_mux_options(),
+                   'pwd'      : passwd,
+                   'user'     : user,
+                   'hostname' : hostname,
+                   'probe'    : probe})
+        else:
+            cmd = (r'''ssh -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(hostname)s "python -" < %(probe)s''' %
+                  {'mux_opts' : Helper.get_ssh_mux_options(),
+                   'hostname' : hostname,
+                   'probe'    : probe})
+        start = time.time()
+        output, errors = Helper.run_command_on_local_without_timeout(cmd, const.DISCOVERY_TIMEOUT)
+        Telemetry.record(hostname, 'discovery', start, int(bool(errors or not output)))
+        if errors or not output:
+            return None, errors or 'no output from fact probe'
+        try:
+            return json.loads(output), None
+        except ValueError as e:
+            return None, ('Error parsing fact probe output: %(e)s\n%(output)s' %
+                         {'e' : e, 'output' : output})
 
 
     @staticmethod
@@ -428,36 +540,55 @@ class Helper(object):
             node_config['install_bsnstacklib'] = env.install_bsnstacklib
         if 'install_all' not in node_config:
             node_config['install_all'] = env.install_all
+        if 'physnet' not in node_config:
+            node_config['physnet'] = env.physnet
+        if 'lower_vlan' not in node_config:
+            node_config['lower_vlan'] = env.lower_vlan
+        if 'upper_vlan' not in node_config:
+            node_config['upper_vlan'] = env.upper_vlan
         return node_config
 
 
+    @staticmethod
+    def __load_yaml_node__(node_yaml_config, env):
+        node_yaml_config = Helper.__load_node_yaml_config__(node_yaml_config, env)
+
+        # get existing ivs version
+        node_yaml_config['old_ivs_version'] = None
+        if node_yaml_config.get('error'):
+            # hostname not resolved, nothing to discover
+            return Node(node_yaml_config, env)
+        Helper.open_ssh_session(node_yaml_config['hostname'],
+                                node_yaml_config['user'],
+                                node_yaml_config['passwd'])
+        facts, errors = Helper.get_node_facts(node_yaml_config['hostname'],
+                                              node_yaml_config['user'],
+                                              node_yaml_config['passwd'])
+        if errors or facts.get('ivs_error'):
+            node_yaml_config['skip'] = True
+            node_yaml_config['error'] = ("Fail to retrieve ivs version from %(hostname)s" %
+                                        {'hostname' : node_yaml_config['hostname']})
+        else:
+            node_yaml_config['old_ivs_version'] = facts.get('ivs_version')
+
+        return Node(node_yaml_config, env)
+
+
     @staticmethod
     def load_nodes_from_yaml(node_yaml_config_map, env):
         """
-        Parse yaml file and return a dictionary
+        Parse yaml file and return a dictionary.
+        Nodes are discovered by a pool of threads.
         """
         node_dic = {}
         if node_yaml_config_map == None:
             return node_dic
-        for hostname, node_yaml_config in node_yaml_config_map.iteritems():
-            node_yaml_config = Helper.__load_node_yaml_config__(node_yaml_config, env)
-
-            # get existing ivs version
-            node_yaml_config['old_ivs_version'] = None
-            output,errors = Helper.run_command_on_remote_with_passwd_without_timeout(
-                node_yaml_config['hostname'],
-                node_yaml_config['user'],
-                node_yaml_config['passwd'],
-                'ivs --version')
-            if errors or not output:
-                node_yaml_config['skip'] = True
-                node_yaml_config['error'] = ("Fail to retrieve ivs version from %(hostname)s" %
-                                            {'hostname' : node_yaml_config['hostname']})
-            if 'command not found' not in output:
-                node_yaml_config['old_ivs_version'] = output.split()[1]
-
-            node = Node(node_yaml_config, env)
-            node_dic[node.hostname] = node
+        with ThreadPoolExecutor(max_workers=const.MAX_DISCOVERY_WORKERS) as executor:
+            futures = [executor.submit(Helper.__load_yaml_node__, node_yaml_config, env)
+                       for node_yaml_config in node_yaml_config_map.itervalues()]
+            for future in futures:
+                node = future.result()
+                node_dic[node.hostname] = node
         return node_dic
 
 
@@ -489,63 +620,18 @@ class Helper(object):
 
 
     @staticmethod
-    def __load_fuel_node__(hostname, role, node_yaml_config, env):
-        node_config = {}
-        if node_yaml_config:
-            node_config = Helper.__load_node_yaml_config__(node_yaml_config, env)
-        else:
-            node_config = Helper.__load_node_yaml_config__(node_config, env)
-        node_config['hostname'] = hostname
-        node_config['role'] = role
-
-        # get node operating system information
-        os_info, errors = Helper.run_command_on_remote_with_key_without_timeout(node_config['hostname'],
-            'python -mplatform')
-        if errors or not os_info:
-            Helper.safe_print("Error retrieving operating system info from node %(hostname)s:\n%(errors)s\n"
-                              % {'hostname' : node_config['hostname'], 'errors' : errors})
-            return None
-        try:
-            os_and_version = os_info.split('with-')[1].split('-')
-            node_config['os'] = os_and_version[0]
-            node_config['os_version'] = os_and_version[1]
-        except Exception as e:
-            Helper.safe_print("Error parsing node %(hostname)s operating system info:\n%(e)s\n"
-                              % {'hostname' : node_config['hostname'], 'e' : e})
-            return None
-
-        # get node /etc/astute.yaml
-        node_yaml, errors = Helper.run_command_on_remote_with_key_without_timeout(node_config['hostname'],
-            'cat /etc/astute.yaml')
-        if errors or not node_yaml:
-            Helper.safe_print("Error retrieving config for node %(hostname)s:\n%(errors)s\n"
-                              % {'hostname' : node_config['hostname'], 'errors' : errors})
-            return None
-        try:
-            node_yaml_config = yaml.load(node_yaml)
-        except Exception as e:
-            Helper.safe_print("Error parsing node %(hostname)s yaml file:\n%(e)s\n"
-                              % {'hostname' : node_config['hostname'], 'e' : e})
-            return None
-
-        # get existing ivs version
-        node_config['old_ivs_version'] = None
-        output, errors = Helper.run_command_on_remote_with_key_without_timeout(node_config['hostname'],
-            'ivs --version')
-        if errors or not output:
-            Helper.safe_print("Error retrieving ivs version from node %(hostname)s:\n%(errors)s\n"
-                              % {'hostname' : node_config['hostname'], 'errors' : errors})
-            return None
-        if 'command not found' not in output:
-            node_config['old_ivs_version'] = output.split()[1]
-
+    def __parse_astute_config__(node_yaml_config, node_config):
+        """
+        Fill node_config with the physnet, uplink bond members and the bridges
+        built from fuel's astute.yaml of a node.
+        """
         # physnet and vlan range
         physnets = node_yaml_config['quantum_settings']['L2']['phys_nets']
         for physnet, physnet_detail in physnets.iteritems():
-            env.set_physnet(physnet)
             vlans = physnet_detail['vlan_range'].strip().split(':')
-            env.set_lower_vlan(vlans[0])
-            env.set_upper_vlan(vlans[1])
+            node_config['physnet'] = physnet
+            node_config['lower_vlan'] = vlans[0]
+            node_config['upper_vlan'] = vlans[1]
             # we deal with only the first physnet
             break
 
@@ -606,8 +692,59 @@ class Helper(object):
             bridges.append(bridge)
         node_config['bridges'] = bridges
 
-        node = Node(node_config, env)
-        return node
+
+    @staticmethod
+    def __load_fuel_node__(hostname, role, node_yaml_config, env):
+        node_config = {}
+        if node_yaml_config:
+            node_config = Helper.__load_node_yaml_config__(node_yaml_config, env)
+        else:
+            node_config = Helper.__load_node_yaml_config__(node_config, env)
+        node_config['hostname'] = hostname
+        node_config['role'] = role
+
+        # get node facts in one round trip
+        Helper.open_ssh_session(node_config['hostname'])
+        facts, errors = Helper.get_node_facts(node_config['hostname'])
+        if errors:
+            Helper.safe_print("Error retrieving facts from node %(hostname)s:\n%(errors)s\n"
+                              % {'hostname' : node_config['hostname'], 'errors' : errors})
+            return None
+
+        # operating system information
+        try:
+            os_and_version = facts['platform'].split('with-')[1].split('-')
+            node_config['os'] = os_and_version[0]
+            node_config['os_version'] = os_and_version[1]
+        except Exception as e:
+            Helper.safe_print("Error parsing node %(hostname)s operating system info:\n%(e)s\n"
+                              % {'hostname' : node_config['hostname'], 'e' : e})
+            return None
+
+        # node /etc/astute.yaml
+        if not facts.get('astute'):
+            Helper.safe_print("Error retrieving config for node %(hostname)s:\n%(errors)s\n"
+                              % {'hostname' : node_config['hostname'],
+                                 'errors'   : ('%(astute)s is missing' %
+                                               {'astute' : const.FUEL_ASTUTE_YAML})})
+            return None
+        try:
+            node_yaml_config = yaml.load(facts['astute'])
+        except Exception as e:
+            Helper.safe_print("Error parsing node %(hostname)s yaml file:\n%(e)s\n"
+                              % {'hostname' : node_config['hostname'], 'e' : e})
+            return None
+
+        # existing ivs version
+        if facts.get('ivs_error'):
+            Helper.safe_print("Error retrieving ivs version from node %(hostname)s:\n%(errors)s\n"
+                              % {'hostname' : node_config['hostname'], 'errors' : facts['ivs_error']})
+            return None
+        node_config['old_ivs_version'] = facts.get('ivs_version')
+
+        Helper.__parse_astute_config__(node_yaml_config, node_config)
+
+        return Node(node_config, env)
 
 
     @staticmethod
@@ -622,57 +759,187 @@ class Helper(object):
                             % {'fuel_cluster_id' : env.fuel_cluster_id,
                                'errors'          : errors})
 
-        node_dic = {}
-        membership_rules = {}
         try:
             lines = [l for l in node_list.splitlines()
                      if '----' not in l and 'pending_roles' not in l]
+            fuel_nodes = []
             for line in lines:
                 hostname = str(netaddr.IPAddress(line.split('|')[4].strip()))
                 role = str(line.split('|')[6].strip())
-                node_yaml_config = None
-                node_yaml_config = node_yaml_config_map.get(hostname)
-                node = Helper.__load_fuel_node__(hostname, role, node_yaml_config, env)
+                fuel_nodes.append((hostname, role))
+        except IndexError:
+            raise Exception("Could not parse node list:\n%(node_list)s\n"
+                            % {'node_list' : node_list})
+
+        # discover nodes with a pool of threads, results are
+        # collected by this thread only
+        node_dic = {}
+        membership_rules = {}
+        with ThreadPoolExecutor(max_workers=const.MAX_DISCOVERY_WORKERS) as executor:
+            futures = [executor.submit(Helper.__load_fuel_node__, hostname, role,
+                                       node_yaml_config_map.get(hostname), env)
+                       for hostname, role in fuel_nodes]
+            for future in futures:
+                node = future.result()
                 if (not node) or (not node.hostname):
                     continue
                 node_dic[node.hostname] = node
-                
+
                 # get node bridges
                 for br in node.bridges:
                     rule = MembershipRule(br.br_key, br.br_vlan)
                     membership_rules[rule.br_key] = rule
-
-        except IndexError:
-            raise Exception("Could not parse node list:\n%(node_list)s\n"
-                            % {'node_list' : node_list})
         return node_dic, membership_rules
 
 
+    @staticmethod
+    def __resolve_hostname__(hostname, started):
+        started[hostname] = time.time()
+        return socket.gethostbyname(hostname)
+
+
+    @staticmethod
+    def resolve_hostnames(hostnames):
+        """
+        Resolve hostnames concurrently, return {hostname : (ip, error)}.
+        A lookup which takes longer than RESOLVE_TIMEOUT is given up,
+        its thread is left to the resolver.
+        """
+        results = {}
+        pending = []
+        with Helper.__resolved_lock:
+            for hostname in set(hostnames):
+                if hostname in Helper.__resolved:
+                    results[hostname] = Helper.__resolved[hostname]
+                elif netaddr.valid_ipv4(hostname):
+                    results[hostname] = (hostname, None)
+                else:
+                    pending.append(hostname)
+
+        if pending:
+            started = {}
+            executor = ThreadPoolExecutor(
+                max_workers=min(len(pending), const.MAX_RESOLVE_WORKERS))
+            futures = dict([(executor.submit(Helper.__resolve_hostname__, hostname, started),
+                             hostname) for hostname in pending])
+            not_done = set(futures)
+            while not_done:
+                deadlines = [started[futures[f]] + const.RESOLVE_TIMEOUT
+                             for f in not_done if futures[f] in started]
+                timeout = 1
+                if deadlines:
+                    timeout = min(max(min(deadlines) - time.time(), 0), timeout)
+                done, not_done = wait(not_done, timeout, FIRST_COMPLETED)
+                for future in done:
+                    hostname = futures[future]
+                    try:
+                        results[hostname] = (future.result(), None)
+                    except Exception as e:
+                        # socket.error, or UnicodeError for a malformed name
+                        results[hostname] = (None, ("Fail to resolve %(hostname)s: %(e)s" %
+                                                    {'hostname' : hostname, 'e' : e}))
+                now = time.time()
+                for future in list(not_done):
+                    hostname = futures[future]
+                    if hostname in started and now - started[hostname] >= const.RESOLVE_TIMEOUT:
+                        not_done.remove(future)
+                        results[hostname] = (None, ("Fail to resolve %(hostname)s in %(timeout)d seconds" %
+                                                    {'hostname' : hostname,
+                                                     'timeout'  : const.RESOLVE_TIMEOUT}))
+            executor.shutdown(wait=False)
+
+        with Helper.__resolved_lock:
+            for hostname in pending:
+                Helper.__resolved[hostname] = results[hostname]
+        return results
+
+
+    @staticmethod
+    def __program_membership_rules__(env, rules):
+        """
+        Program rules to the elected controller. If that fails,
+        the cached election is dropped and rules are programmed
+        once more to the controller elected again, e.g. after a
+        failover or when the cookie was rejected. env is left as
+        it is, the controller used is returned with the results.
+        """
+        master, cookie = env.bcf_master, env.bcf_cookie
+        for attempt in range(2):
+            try:
+                created, skipped, failed = RestLib.program_membership_rules(
+                    master, cookie, rules)
+            except Exception as e:
+                created, skipped, failed = [], [], [(rule.br_key, e) for rule in rules]
+            if not failed:
+                break
+            RestLib.invalidate_active_bcf_controller(env.bcf_controller_ips,
+                                                     env.bcf_controller_user)
+            if attempt:
+                break
+            new_master, new_cookie = RestLib.get_active_bcf_controller(env.bcf_controller_ips,
+                env.bcf_controller_user, env.bcf_controller_passwd)
+            if not new_master:
+                break
+            Helper.safe_print("Programming membership rules to %(old)s failed, "
+                              "retry on active controller %(master)s\n" %
+                             {'old' : master, 'master' : new_master})
+            master, cookie = new_master, new_cookie
+        return master, created, skipped, failed
+
+
     @staticmethod
     def load_nodes(nodes_yaml_config, env):
         node_yaml_config_map = {}
         if nodes_yaml_config != None:
+            resolved = Helper.resolve_hostnames(
+                [node_yaml_config['hostname'] for node_yaml_config in nodes_yaml_config])
             for node_yaml_config in nodes_yaml_config:
-                # we always use ip address as the hostname
-                node_yaml_config['hostname'] = socket.gethostbyname(node_yaml_config['hostname'])
+                # we always use ip address as the hostname, a node
+                # which can't be resolved is skipped
+                ip, error = resolved[node_yaml_config['hostname']]
+                if error:
+                    node_yaml_config['skip'] = True
+                    node_yaml_config['error'] = error
+                else:
+                    node_yaml_config['hostname'] = ip
                 node_yaml_config_map[node_yaml_config['hostname']] = node_yaml_config
         if env.fuel_cluster_id == None:
             return Helper.load_nodes_from_yaml(node_yaml_config_map, env)
         else:
+            # fuel nodes are listed by ip, settings of a node which
+            # can't be resolved match none of them
+            for hostname, node_yaml_config in node_yaml_config_map.iteritems():
+                if node_yaml_config.get('error'):
+                    Helper.safe_print("Ignore settings of node %(hostname)s due to %(error)s\n" %
+                                     {'hostname' : hostname,
+                                      'error'    : node_yaml_config['error']})
             node_dic, membership_rules = Helper.load_nodes_from_fuel(node_yaml_config_map, env)
-            # program membership rules to controller
-            for br_key, rule in membership_rules.iteritems():
-                RestLib.program_segment_and_membership_rule(env.bcf_master, env.bcf_cookie, rule)
+            # program missing membership rules to controller
+            master, created, skipped, failed = Helper.__program_membership_rules__(
+                env, membership_rules.values())
+            Helper.safe_print("Membership rules on %(master)s: %(created)d created, "
+                              "%(skipped)d already exist, %(failed)d segments failed\n" %
+                             {'master'  : master,
+                              'created' : len(created),
+                              'skipped' : len(skipped),
+                              'failed'  : len(failed)})
+            for br_key, error in failed:
+                Helper.safe_print("Failed to program segment %(br_key)s: %(error)s\n" %
+                                 {'br_key' : br_key, 'error' : error})
+            if failed:
+                raise Exception("Failed to program membership rules to %s" % master)
             return node_dic
 
 
     @staticmethod
-    def common_setup_node_preparation(env):
-        # clean up from previous installation
+    def common_setup_node_preparation(env, resume=False):
+        # clean up from previous installation, the log and
+        # generated scripts are kept to resume it
         setup_node_dir = os.getcwd()
         subprocess.call("rm -rf ~/.ssh/known_hosts", shell=True)
-        subprocess.call("rm -rf %(log)s" %
-                       {'log' : const.LOG_FILE}, shell=True)
+        if not resume:
+            subprocess.call("rm -rf %(log)s" %
+                           {'log' : const.LOG_FILE}, shell=True)
         subprocess.call("rm -rf %(setup_node_dir)s/*ivs*.rpm" %
                        {'setup_node_dir' : setup_node_dir}, shell=True)
         subprocess.call("rm -rf %(setup_node_dir)s/*ivs*.deb" %
@@ -682,18 +949,28 @@ class Helper(object):
         subprocess.call("mkdir -p %(setup_node_dir)s/%(generated_script)s" %
                        {'setup_node_dir'   : setup_node_dir,
                         'generated_script' : const.GENERATED_SCRIPT_DIR}, shell=True)
-        subprocess.call("rm -rf %(setup_node_dir)s/%(generated_script)s/*" %
-                       {'setup_node_dir'   : setup_node_dir,
-                        'generated_script' : const.GENERATED_SCRIPT_DIR}, shell=True)
+        if not resume:
+            subprocess.call("rm -rf %(setup_node_dir)s/%(generated_script)s/*" %
+                           {'setup_node_dir'   : setup_node_dir,
+                            'generated_script' : const.GENERATED_SCRIPT_DIR}, shell=True)
+
+        # fetch ivs packages and horizon patch through the
+        # artifact cache, all downloads run in parallel
+        urls = [url for url in env.ivs_url_map.itervalues()
+                if 'http://' in url or 'https://' in url]
+        horizon_url = env.horizon_patch_url
+        if 'http://' in horizon_url or 'https://' in horizon_url:
+            urls.append(horizon_url)
+        fetched = ArtifactCache.fetch_all(urls, setup_node_dir)
+        for url, (success, message) in fetched.iteritems():
+            if message:
+                Helper.safe_print(message + "\n")
 
-        # wget ivs packages
         code_web = 1
         code_local = 1
         for pkg_type, url in env.ivs_url_map.iteritems():
-            if 'http://' in url or 'https://' in url:
-                code_web = subprocess.call("wget --no-check-certificate %(url)s -P %(setup_node_dir)s" %
-                                          {'url' : url, 'setup_node_dir' : setup_node_dir},
-                                           shell=True)
+            if url in fetched:
+                code_web = 0 if fetched[url][0] else 1
         for pkg_type, url in env.ivs_url_map.iteritems():
             if os.path.isfile(url):
                 code_local = subprocess.call("cp %(url)s %(setup_node_dir)s" %
@@ -704,14 +981,12 @@ class Helper(object):
             exit(1)
         # TODO: deal with tarball
 
-        # wget horizon patch
+        # horizon patch
         code_web = 1
         code_local = 1
-        url = env.horizon_patch_url
-        if 'http://' in url or 'https://' in url:
-            code_web = subprocess.call("wget --no-check-certificate %(url)s -P %(setup_node_dir)s" %
-                                          {'url' : url, 'setup_node_dir' : setup_node_dir},
-                                           shell=True)
+        url = horizon_url
+        if url in fetched:
+            code_web = 0 if fetched[url][0] else 1
         if os.path.isfile(url):
             code_local = subprocess.call("cp %(url)s %(setup_node_dir)s" %
                                         {'url' : url, 'setup_node_dir' : setup_node_dir},
@@ -721,90 +996,236 @@ class Helper(object):
             exit(1)
 
 
+    @staticmethod
+    def get_remote_command(node, command):
+        """
+        Return the local command which runs command on node,
+        its output goes to the log.
+        """
+        if node.fuel_cluster_id:
+            return Helper.get_remote_command_with_key(node, command)
+        return Helper.get_remote_command_with_passwd(node, command)
+
+
+    @staticmethod
+    def get_remote_command_with_output(node, command):
+        """
+        Return the local command which runs command on node
+        and prints its output.
+        """
+        if node.fuel_cluster_id:
+            return Helper.get_remote_command_with_key_without_log(
+                node.hostname, command)
+        return Helper.get_remote_command_with_passwd_without_log(
+            node.hostname, node.user, node.passwd, command)
+
+
     @staticmethod
     def run_command_on_remote(node, command):
+        return Helper.run_command_on_local(Helper.get_remote_command(node, command))
+
+
+    @staticmethod
+    def run_command_on_remote_with_output(node, command, timeout=None):
+        """
+        Run cmd on remote node and return (output, errors).
+        """
+        return Helper.run_command_on_local_without_timeout(
+            Helper.get_remote_command_with_output(node, command), timeout)
+
+
+    @staticmethod
+    def get_copy_file_commands(node, src_file, dst_dir, dst_file, mode=777):
+        """
+        Return the local commands which copy a file to remote
+        node, create the remote directory if it doesn't exist
+        and change the file mode as well.
+        """
+        mkdir_cmd = (r'''mkdir -p %(dst_dir)s''' % {'dst_dir' : dst_dir})
+        chmod_cmd = (r'''chmod -R %(mode)d %(dst_dir)s/%(dst_file)s''' %
+                    {'mode'     : mode,
+                     'dst_dir'  : dst_dir,
+                     'dst_file' : dst_file
+                    })
         if node.fuel_cluster_id:
-            Helper.run_command_on_remote_with_key(node, command)
+            scp_cmd = Helper.get_scp_command_with_key(node, src_file, dst_dir, dst_file)
         else:
-            Helper.run_command_on_remote_with_passwd(node, command)
+            scp_cmd = Helper.get_scp_command_with_passwd(node, src_file, dst_dir, dst_file)
+        return [Helper.get_remote_command(node, mkdir_cmd),
+                scp_cmd,
+                Helper.get_remote_command(node, chmod_cmd)]
+
+
+    @staticmethod
+    def run_commands_on_local(commands):
+        """
+        Run all commands, return the first non-zero exit code.
+        """
+        code = 0
+        for command in commands:
+            code = Helper.run_command_on_local(command) or code
+        return code
 
 
     @staticmethod
     def copy_file_to_remote(node, src_file, dst_dir, dst_file, mode=777):
+        return Helper.run_commands_on_local(
+            Helper.get_copy_file_commands(node, src_file, dst_dir, dst_file, mode))
+
+
+    @staticmethod
+    def get_ssh_session_commands_of_node(node):
         if node.fuel_cluster_id:
-            Helper.copy_file_to_remote_with_key(node, src_file, dst_dir, dst_file, mode)
+            return Helper.get_ssh_session_commands(node.hostname)
+        return Helper.get_ssh_session_commands(node.hostname, node.user, node.passwd)
+
+
+    @staticmethod
+    def open_ssh_session_to_node(node):
+        if node.fuel_cluster_id:
+            Helper.open_ssh_session(node.hostname)
         else:
-            Helper.copy_file_to_remote_with_passwd(node, src_file, dst_dir, dst_file, mode)
+            Helper.open_ssh_session(node.hostname, node.user, node.passwd)
 
 
     @staticmethod
-    def copy_pkg_scripts_to_remote(node):
-        # copy ivs to node
+    def close_ssh_sessions():
+        """
+        Tear down the ssh master connections to all nodes one
+        was opened for.
+        """
+        with Helper.__ssh_sessions_lock:
+            sessions = list(Helper.__ssh_sessions)
+            Helper.__ssh_sessions.clear()
+        for hostname, user in sessions:
+            Helper.close_ssh_session(hostname, user)
+
+
+    @staticmethod
+    def get_bundle_copy_command(node, files, dst_dir, mode=777):
+        """
+        Return the local command which packs files into one tar
+        stream and unpacks it on remote node in a single ssh
+        session. Files are packed under their basename and get
+        the mode while being packed.
+        """
+        members = []
+        for src_file in files:
+            members.append(r'''-C %(src_dir)s %(src_name)s''' %
+                          {'src_dir'  : os.path.dirname(src_file),
+                           'src_name' : os.path.basename(src_file)})
+        tar_cmd = (r'''tar -ch --mode=%(mode)d -f - %(members)s''' %
+                  {'mode'    : mode,
+                   'members' : ' '.join(members)})
+        untar_cmd = (r'''mkdir -p %(dst_dir)s && tar -xpf - -C %(dst_dir)s''' %
+                    {'dst_dir' : dst_dir})
+        if node.fuel_cluster_id:
+            ssh_cmd = (r'''ssh -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(hostname)s "%(untar_cmd)s" >> %(log)s 2>&1''' %
+                      {'mux_opts'  : Helper.get_ssh_mux_options(),
+                       'hostname'  : node.hostname,
+                       'untar_cmd' : untar_cmd,
+                       'log'       : node.log})
+        else:
+            ssh_cmd = (r'''sshpass -p %(pwd)s ssh -oStrictHostKeyChecking=no -o LogLevel=quiet %(mux_opts)s %(user)s@%(hostname)s "%(untar_cmd)s" >> %(log)s 2>&1''' %
+                      {'mux_opts'  : Helper.get_ssh_mux_options(),
+                       'pwd'       : node.passwd,
+                       'user'      : node.user,
+                       'hostname'  : node.hostname,
+                       'untar_cmd' : untar_cmd,
+                       'log'       : node.log})
+        return (r'''%(tar_cmd)s | %(ssh_cmd)s''' %
+               {'tar_cmd' : tar_cmd, 'ssh_cmd' : ssh_cmd})
+
+
+    @staticmethod
+    def copy_files_to_remote_as_bundle(node, files, dst_dir, mode=777):
+        return Helper.run_command_on_local(
+            Helper.get_bundle_copy_command(node, files, dst_dir, mode))
+
+
+    @staticmethod
+    def get_pkg_scripts_of_node(node, with_fanout=False):
+        """
+        Return [(description, local path)] of all the packages and
+        scripts to be copied to node. The remote file name is the
+        basename of the local path. Packages fanned out to node
+        are left out, unless with_fanout is True.
+        """
+        artifacts = []
+        fanout_pkgs = [] if with_fanout else node.fanout_pkgs
+        # ivs pkg, unless node already got it by fan-out
         if node.deploy_mode == const.T6:
-            Helper.safe_print("Copy %(ivs_pkg)s to %(hostname)s\n" %
-                              {'ivs_pkg'  : node.ivs_pkg,
-                               'hostname' : node.hostname})
-            Helper.copy_file_to_remote(node,
-                (r'''%(src_dir)s/%(ivs_pkg)s''' %
-                {'src_dir' : node.setup_node_dir,
-                 'ivs_pkg' : node.ivs_pkg}),
-                node.dst_dir,
-                node.ivs_pkg)
-            if node.ivs_debug_pkg != None:
-                Helper.safe_print("Copy %(ivs_debug_pkg)s to %(hostname)s\n" %
-                                 {'ivs_debug_pkg'  : node.ivs_debug_pkg,
-                                  'hostname'       : node.hostname})
-                Helper.copy_file_to_remote(node,
+            if node.ivs_pkg not in fanout_pkgs:
+                artifacts.append((node.ivs_pkg,
+                    (r'''%(src_dir)s/%(ivs_pkg)s''' %
+                    {'src_dir' : node.setup_node_dir,
+                     'ivs_pkg' : node.ivs_pkg})))
+            if (node.ivs_debug_pkg != None
+                and node.ivs_debug_pkg not in fanout_pkgs):
+                artifacts.append((node.ivs_debug_pkg,
                     (r'''%(src_dir)s/%(ivs_debug_pkg)s''' %
                     {'src_dir'       : node.setup_node_dir,
-                     'ivs_debug_pkg' : node.ivs_debug_pkg}),
-                    node.dst_dir,
-                    node.ivs_debug_pkg)
-
-        # copy bash script to node
-        Helper.safe_print("Copy bash script to %(hostname)s\n" %
-                         {'hostname' : node.hostname})
-        Helper.copy_file_to_remote(node,
-           node.bash_script_path,
-           node.dst_dir,
-           "%(hostname)s.sh" % {'hostname' : node.hostname})
-
-        # copy puppet script to node
-        Helper.safe_print("Copy puppet script to %(hostname)s\n" %
-                         {'hostname' : node.hostname})
-        Helper.copy_file_to_remote(node,
-           node.puppet_script_path,
-           node.dst_dir,
-           "%(hostname)s.pp" % {'hostname' : node.hostname})
-
-        # copy selinux script to node
+                     'ivs_debug_pkg' : node.ivs_debug_pkg})))
+
+        # bash and puppet script
+        artifacts.append(('bash script', node.bash_script_path))
+        artifacts.append(('puppet script', node.puppet_script_path))
+
+        # selinux script
         if node.os in const.RPM_OS_SET:
-            Helper.safe_print("Copy bsn selinux policy to %(hostname)s\n" %
-                             {'hostname' : node.hostname})
-            Helper.copy_file_to_remote(node,
-               node.selinux_script_path,
-               node.dst_dir,
-               "%(hostname)s.te" % {'hostname' : node.hostname})
-
-        # copy ospurge script to node
+            artifacts.append(('bsn selinux policy', node.selinux_script_path))
+
+        # ospurge script
         if node.role == const.ROLE_NEUTRON_SERVER:
-            Helper.safe_print("Copy ospurge script to %(hostname)s\n" %
-                             {'hostname' : node.hostname})
-            Helper.copy_file_to_remote(node,
-               node.ospurge_script_path,
-               node.dst_dir,
-               "%(hostname)s_ospurge.sh" % {'hostname' : node.hostname})
-
-        # copy horizon patch to node
+            artifacts.append(('ospurge script', node.ospurge_script_path))
+
+        # horizon patch
         if node.role == const.ROLE_NEUTRON_SERVER and node.deploy_horizon_patch:
-            Helper.safe_print("Copy horizon patch to %(hostname)s\n" %
-                             {'hostname' : node.hostname})
-            Helper.copy_file_to_remote(node,
+            artifacts.append(('horizon patch',
                 (r'''%(src_dir)s/%(horizon_patch)s''' %
-                {'src_dir' : node.setup_node_dir,
-                 'horizon_patch' : node.horizon_patch}),
-                node.dst_dir,
-                node.horizon_patch)
+                {'src_dir'       : node.setup_node_dir,
+                 'horizon_patch' : node.horizon_patch})))
+        return artifacts
+
+
+    @staticmethod
+    def get_file_size(path):
+        if path and os.path.isfile(path):
+            return os.path.getsize(path)
+        return 0
+
 
+    @staticmethod
+    def get_pkg_scripts_copies(node):
+        """
+        Return [(description, bytes, local commands)], one entry
+        for each copy of packages and scripts to node.
+        """
+        artifacts = Helper.get_pkg_scripts_of_node(node)
+        if node.bundle_artifacts:
+            return [(', '.join([a[0] for a in artifacts]),
+                     sum([Helper.get_file_size(a[1]) for a in artifacts]),
+                     [Helper.get_bundle_copy_command(node,
+                        [a[1] for a in artifacts], node.dst_dir)])]
+        return [(description, Helper.get_file_size(src_file),
+                 Helper.get_copy_file_commands(node, src_file, node.dst_dir,
+                                               os.path.basename(src_file)))
+                for description, src_file in artifacts]
 
 
+    @staticmethod
+    def copy_pkg_scripts_to_remote(node):
+        """
+        Return True if all packages and scripts are copied.
+        """
+        ok = True
+        for description, size, commands in Helper.get_pkg_scripts_copies(node):
+            Helper.safe_print("Copy %(description)s to %(hostname)s\n" %
+                             {'description' : description,
+                              'hostname'    : node.hostname})
+            start = time.time()
+            code = Helper.run_commands_on_local(commands)
+            Telemetry.record(node.hostname, 'copy', start, code, size)
+            if code != 0:
+                ok = False
+        return ok
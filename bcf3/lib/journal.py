@@ -0,0 +1,136 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import constants as const
+from helper import Helper
+
+
+class Journal(object):
+    """
+    Progress of a deployment which survives the setup node.
+    Every phase a node completes is one json line in JOURNAL_FILE
+    with the fingerprint it was done for, and for copies the
+    sha256 of every artifact, so --resume can tell what is left.
+    """
+
+    # (hostname, phase) -> latest entry
+    __entries = {}
+    __lock = threading.Lock()
+    __file = None
+    # (path, size, mtime) -> sha256 of local artifacts
+    __hashes = {}
+
+    @staticmethod
+    def open(resume):
+        """
+        Start a new journal, or continue the one of an interrupted
+        run if resume is True.
+        """
+        with Journal.__lock:
+            Journal.__entries.clear()
+            if resume and os.path.isfile(const.JOURNAL_FILE):
+                with open(const.JOURNAL_FILE, 'r') as journal_file:
+                    for line in journal_file:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # last line of a run which died while writing
+                            continue
+                        Journal.__entries[(entry['node'], entry['phase'])] = entry
+            Journal.__file = open(const.JOURNAL_FILE, 'a' if resume else 'w')
+
+
+    @staticmethod
+    def record(node, phase, hashes=None):
+        """
+        Record that node completed phase.
+        """
+        entry = {'node'        : node.hostname,
+                 'phase'       : phase,
+                 'fingerprint' : node.fingerprint,
+                 'hashes'      : hashes,
+                 'time'        : time.time()}
+        with Journal.__lock:
+            Journal.__entries[(node.hostname, phase)] = entry
+            if Journal.__file:
+                Journal.__file.write(json.dumps(entry, sort_keys=True) + '\n')
+                Journal.__file.flush()
+                os.fsync(Journal.__file.fileno())
+
+
+    @staticmethod
+    def is_done(node, phase):
+        """
+        Return True if node completed phase for its current
+        fingerprint in this or an interrupted run.
+        """
+        with Journal.__lock:
+            entry = Journal.__entries.get((node.hostname, phase))
+        return bool(entry) and entry['fingerprint'] == node.fingerprint
+
+
+    @staticmethod
+    def __sha256__(path):
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime)
+        with Journal.__lock:
+            if key in Journal.__hashes:
+                return Journal.__hashes[key]
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        with Journal.__lock:
+            Journal.__hashes[key] = sha.hexdigest()
+        return sha.hexdigest()
+
+
+    @staticmethod
+    def hash_artifacts(node):
+        """
+        Return {remote file name : sha256} of all the packages and
+        scripts of node, including the ones fanned out to it.
+        """
+        return dict((os.path.basename(path), Journal.__sha256__(path))
+                    for description, path in Helper.get_pkg_scripts_of_node(node, True))
+
+
+    @staticmethod
+    def record_copy(node):
+        Journal.record(node, 'copy', Journal.hash_artifacts(node))
+
+
+    @staticmethod
+    def verify_copy(node):
+        """
+        Return True if the journal has a copy to node for its
+        current fingerprint, and the copies still in node.dst_dir
+        match the local artifacts.
+        """
+        with Journal.__lock:
+            entry = Journal.__entries.get((node.hostname, 'copy'))
+        if not entry or entry['fingerprint'] != node.fingerprint:
+            return False
+        hashes = Journal.hash_artifacts(node)
+        if entry['hashes'] != hashes:
+            return False
+        output, errors = Helper.run_command_on_remote_with_output(node,
+            (r'''sha256sum %(files)s''' %
+            {'files' : ' '.join([r'''%(dst_dir)s/%(name)s''' %
+                                 {'dst_dir' : node.dst_dir, 'name' : name}
+                                 for name in sorted(hashes)])}),
+            const.DISCOVERY_TIMEOUT)
+        found = dict((name, sha) for sha, name in
+                     re.findall(r'([0-9a-f]{64})\s+\S*/(\S+)', output or ''))
+        return all(found.get(name) == sha for name, sha in hashes.iteritems())
+
+
+    @staticmethod
+    def close():
+        with Journal.__lock:
+            if Journal.__file:
+                Journal.__file.close()
+                Journal.__file = None
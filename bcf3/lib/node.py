@@ -1,14 +1,54 @@
 import re
+import json
 import constants as const
 
+def env_property(name):
+    """
+    Read only attribute taken from the shared environment view.
+    """
+    return property(lambda self: getattr(self.env, name))
+
+
 class Node(object):
+    # per node state only, everything shared by all nodes is
+    # read from env, which is one NodeEnv for the whole run
+    __slots__ = ('env', 'bash_script_path', 'puppet_script_path',
+                 'selinux_script_path', 'ospurge_script_path', 'fingerprint',
+                 'hostname', 'role', 'skip', 'deploy_mode', 'os', 'os_version',
+                 'user', 'passwd', 'uplink_interfaces', 'install_ivs',
+                 'install_bsnstacklib', 'install_all', 'bridges', 'br_bond',
+                 'physnet', 'lower_vlan', 'upper_vlan', 'ivs_pkg', 'ivs_debug_pkg',
+                 'ivs_version', 'fanout_pkgs', 'old_ivs_version', 'error')
+
+    dst_dir               = env_property('dst_dir')
+    log                   = env_property('log')
+    openstack_release     = env_property('openstack_release')
+    bsnstacklib_version   = env_property('bsnstacklib_version')
+    bcf_controllers       = env_property('bcf_controllers')
+    bcf_controller_ips    = env_property('bcf_controller_ips')
+    bcf_controller_user   = env_property('bcf_controller_user')
+    bcf_controller_passwd = env_property('bcf_controller_passwd')
+    bcf_master            = env_property('bcf_master')
+    setup_node_ip         = env_property('setup_node_ip')
+    setup_node_dir        = env_property('setup_node_dir')
+    selinux_mode          = env_property('selinux_mode')
+    fuel_cluster_id       = env_property('fuel_cluster_id')
+    deploy_horizon_patch  = env_property('deploy_horizon_patch')
+    horizon_patch_url     = env_property('horizon_patch_url')
+    horizon_patch         = env_property('horizon_patch')
+    horizon_patch_dir     = env_property('horizon_patch_dir')
+    horizon_base_dir      = env_property('horizon_base_dir')
+    ivs_pkg_map           = env_property('ivs_pkg_map')
+    bundle_artifacts      = env_property('bundle_artifacts')
+
     def __init__(self, node_config, env):
-        self.dst_dir               = const.DST_DIR
+        self.env                   = env.get_node_env()
         self.bash_script_path      = None
         self.puppet_script_path    = None
         self.selinux_script_path   = None
         self.ospurge_script_path   = None
-        self.log                   = const.LOG_FILE
+        # digest of the rendered scripts and key fields
+        self.fingerprint           = None
         self.hostname              = node_config['hostname']
         self.role                  = node_config['role'].lower()
         self.skip                  = node_config['skip']
@@ -23,37 +63,23 @@ class Node(object):
         self.install_all           = node_config['install_all']
         self.bridges               = node_config.get('bridges')
         self.br_bond               = node_config.get('br_bond')
-
-        self.openstack_release     = env.openstack_release
-        self.bsnstacklib_version   = env.bsnstacklib_version
-        self.bcf_controllers       = env.bcf_controllers
-        self.bcf_controller_ips    = env.bcf_controller_ips
-        self.bcf_controller_user   = env.bcf_controller_user
-        self.bcf_controller_passwd = env.bcf_controller_passwd
-        self.bcf_master            = env.bcf_master
-        self.physnet               = env.physnet
-        self.lower_vlan            = env.lower_vlan
-        self.upper_vlan            = env.upper_vlan
-        self.setup_node_ip         = env.setup_node_ip
-        self.setup_node_dir        = env.setup_node_dir
-        self.selinux_mode          = env.selinux_mode
-        self.fuel_cluster_id       = env.fuel_cluster_id
-        self.deploy_horizon_patch  = env.deploy_horizon_patch
-        self.horizon_patch_url     = env.horizon_patch_url
-        self.horizon_patch         = env.horizon_patch
-        self.horizon_patch_dir     = env.horizon_patch_dir
-        self.horizon_base_dir      = env.horizon_base_dir
-        self.ivs_pkg_map           = env.ivs_pkg_map
+        self.physnet               = node_config['physnet']
+        self.lower_vlan            = node_config['lower_vlan']
+        self.upper_vlan            = node_config['upper_vlan']
         self.ivs_pkg               = None
         self.ivs_debug_pkg         = None
         self.ivs_version           = None
+        # ivs packages the node already got by fan-out
+        self.fanout_pkgs           = []
         self.old_ivs_version       = node_config.get('old_ivs_version')
+        # the shared map is a tuple of (kind, pkg) pairs
+        ivs_pkg_map                = dict(self.ivs_pkg_map)
         if self.os in const.RPM_OS_SET:
-            self.ivs_pkg           = self.ivs_pkg_map['rpm']
-            self.ivs_debug_pkg     = self.ivs_pkg_map['debug_rpm']
+            self.ivs_pkg           = ivs_pkg_map['rpm']
+            self.ivs_debug_pkg     = ivs_pkg_map['debug_rpm']
         elif self.os in const.DEB_OS_SET:
-            self.ivs_pkg           = self.ivs_pkg_map['deb']
-            self.ivs_debug_pkg     = self.ivs_pkg_map['debug_deb']
+            self.ivs_pkg           = ivs_pkg_map['deb']
+            self.ivs_debug_pkg     = ivs_pkg_map['debug_deb']
         self.error                 = node_config.get('error')
 
         # check os compatability
@@ -84,12 +110,12 @@ class Node(object):
             if self.ivs_version < self.old_ivs_version:
                 self.skip = True
                 self.error = (r'''Existing ivs %(old_ivs_version)s is newer than %(ivs_version)s''' %
-                              {'old_ivs_version' : self.old_ivs_version, 'ivs_version' : ivs_version})
+                              {'old_ivs_version' : self.old_ivs_version, 'ivs_version' : self.ivs_version})
             elif diff > 1:
                 self.skip = True
                 self.error = (r'''Existing ivs %(old_ivs_version)s is %(diff)d version behind %(ivs_version)s''' %
                              {'old_ivs_version' : self.old_ivs_version, 'diff' : diff,
-                              'ivs_version' : ivs_version})
+                              'ivs_version' : self.ivs_version})
 
 
     def set_bash_script_path(self, bash_script_path):
@@ -108,6 +134,10 @@ class Node(object):
         self.ospurge_script_path = ospurge_script_path
 
 
+    def set_fingerprint(self, fingerprint):
+        self.fingerprint = fingerprint
+
+
     def get_network_vlan_ranges(self):
         return (r'''%(physnet)s:%(lower_vlan)s:%(upper_vlan)s''' %
                {'physnet'    : self.physnet,
@@ -158,102 +188,18 @@ class Node(object):
         return ','.join(self.bcf_controllers)
 
 
+    def to_dict(self):
+        """
+        Per node fields, the shared ones are logged once with env.
+        """
+        fields = dict((name, getattr(self, name)) for name in Node.__slots__
+                      if name not in ['env', 'passwd'])
+        fields['bridges'] = str(self.bridges)
+        return fields
+
+
     def __str__(self):
-        return (r'''
-dst_dir                : %(dst_dir)s,
-bash_script_path       : %(bash_script_path)s,
-puppet_script_path     : %(puppet_script_path)s,
-selinux_script_path    : %(selinux_script_path)s,
-ospurge_script_path    : %(ospurge_script_path)s,
-log                    : %(log)s,
-hostname               : %(hostname)s,
-role                   : %(role)s,
-skip                   : %(skip)s,
-deploy_mode            : %(deploy_mode)s,
-os                     : %(os)s,
-os_version             : %(os_version)s,
-user                   : %(user)s,
-passwd                 : %(passwd)s,
-uplink_interfaces      : %(uplink_interfaces)s,
-install_ivs            : %(install_ivs)s,
-install_bsnstacklib    : %(install_bsnstacklib)s,
-install_all            : %(install_all)s,
-bridges                : %(bridges)s,
-br_bond                : %(br_bond)s,
-openstack_release      : %(openstack_release)s,
-bsnstacklib_version    : %(bsnstacklib_version)s,
-bcf_controllers        : %(bcf_controllers)s,
-bcf_controller_ips     : %(bcf_controller_ips)s,
-bcf_controller_user    : %(bcf_controller_user)s,
-bcf_controller_passwd  : %(bcf_controller_passwd)s,
-bcf_master             : %(bcf_master)s,
-physnet                : %(physnet)s,
-lower_vlan             : %(lower_vlan)s,
-upper_vlan             : %(upper_vlan)s,
-setup_node_ip          : %(setup_node_ip)s,
-setup_node_dir         : %(setup_node_dir)s,
-selinux_mode           : %(selinux_mode)s,
-fuel_cluster_id        : %(fuel_cluster_id)s,
-deploy_horizon_patch   : %(deploy_horizon_patch)s,
-horizon_patch_url      : %(horizon_patch_url)s,
-horizon_patch          : %(horizon_patch)s,
-horizon_patch_dir      : %(horizon_patch_dir)s,
-horizon_base_dir       : %(horizon_base_dir)s,
-ivs_pkg                : %(ivs_pkg)s,
-ivs_debug_pkg          : %(ivs_debug_pkg)s,
-ivs_version            : %(ivs_version)s,
-old_ivs_version        : %(old_ivs_version)s,
-error                  : %(error)s,
-''' %
-{
-'dst_dir'               : self.dst_dir,
-'bash_script_path'      : self.bash_script_path,
-'puppet_script_path'    : self.puppet_script_path,
-'selinux_script_path'   : self.selinux_script_path,
-'ospurge_script_path'   : self.ospurge_script_path,
-'log'                   : self.log,
-'hostname'              : self.hostname,
-'role'                  : self.role,
-'skip'                  : self.skip,
-'deploy_mode'           : self.deploy_mode,
-'os'                    : self.os,
-'os_version'            : self.os_version,
-'user'                  : self.user,
-'passwd'                : self.passwd,
-'uplink_interfaces'     : self.uplink_interfaces,
-'install_ivs'           : self.install_ivs,
-'install_bsnstacklib'   : self.install_bsnstacklib,
-'install_all'           : self.install_all,
-'bridges'               : str(self.bridges),
-'br_bond'               : self.br_bond,
-'openstack_release'     : self.openstack_release,
-'bsnstacklib_version'   : self.bsnstacklib_version,
-'bcf_controllers'       : self.bcf_controllers,
-'bcf_controller_ips'    : self.bcf_controller_ips,
-'bcf_controller_user'   : self.bcf_controller_user,
-'bcf_controller_passwd' : self.bcf_controller_passwd,
-'bcf_master'            : self.bcf_master,
-'physnet'               : self.physnet,
-'lower_vlan'            : self.lower_vlan,
-'upper_vlan'            : self.upper_vlan,
-'setup_node_ip'         : self.setup_node_ip,
-'setup_node_dir'        : self.setup_node_dir,
-'selinux_mode'          : self.selinux_mode,
-'fuel_cluster_id'       : self.fuel_cluster_id,
-'deploy_horizon_patch'  : self.deploy_horizon_patch,
-'horizon_patch_url'     : self.horizon_patch_url,
-'horizon_patch'         : self.horizon_patch,
-'horizon_patch_dir'     : self.horizon_patch_dir,
-'horizon_base_dir'      : self.horizon_base_dir,
-'ivs_pkg'               : self.ivs_pkg,
-'ivs_debug_pkg'         : self.ivs_debug_pkg,
-'ivs_version'           : self.ivs_version,
-'old_ivs_version'       : self.old_ivs_version,
-'error'                 : self.error,
-})
+        return json.dumps(self.to_dict(), sort_keys=True)
 
     def __repr__(self):
         return self.__str__()
-
-
-
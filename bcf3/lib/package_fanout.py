@@ -0,0 +1,194 @@
+import re
+import time
+import hashlib
+import collections
+import constants as const
+from helper import Helper
+from telemetry import Telemetry
+from process_supervisor import ProcessSupervisor
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PackageFanout(object):
+    """
+    Distribute ivs packages as a fan-out tree. The setup node
+    seeds FANOUT_DEGREE nodes, then every node holding a verified
+    copy serves it over http to FANOUT_DEGREE more nodes in the
+    next wave. Each hop is verified by sha256. Nodes which fail
+    keep the packages out of node.fanout_pkgs and get them from
+    the setup node as usual.
+    """
+
+    @staticmethod
+    def __sha256__(path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+
+    @staticmethod
+    def __verify__(node, pkgs, hashes, output):
+        """
+        Check sha256sum output of the copies in node.dst_dir.
+        """
+        found = dict((name, sha) for sha, name in
+                     re.findall(r'([0-9a-f]{64})\s+\S*/(\S+)', output))
+        for pkg in pkgs:
+            if found.get(pkg) != hashes[pkg]:
+                Helper.safe_print("Checksum of %(pkg)s on %(hostname)s does not match\n" %
+                                 {'pkg' : pkg, 'hostname' : node.hostname})
+                return False
+        return True
+
+
+    @staticmethod
+    def __run__(node, command, timeout):
+        """
+        Run command on node, return (succeeded, output). Success
+        is decided by the exit code, sudo prompts and harmless
+        warnings on stderr don't fail it.
+        """
+        code, output, errors, timed_out = ProcessSupervisor.run(
+            Helper.get_remote_command_with_output(node, command), timeout)
+        return code == 0 and not timed_out, output + errors
+
+
+    @staticmethod
+    def __copy_from_source__(source, node, pkgs, hashes):
+        """
+        Get pkgs to node from source, which is None for the setup
+        node, then install them to node.dst_dir and verify them.
+        """
+        start = time.time()
+        cmds = [r'''mkdir -p %(fanout_dir)s''' % {'fanout_dir' : const.FANOUT_DIR},
+                r'''cd %(fanout_dir)s''' % {'fanout_dir' : const.FANOUT_DIR}]
+        if source is None:
+            code = Helper.copy_files_to_remote_as_bundle(node,
+                [r'''%(src_dir)s/%(pkg)s''' % {'src_dir' : node.setup_node_dir, 'pkg' : pkg}
+                 for pkg in pkgs],
+                const.FANOUT_DIR)
+            if code != 0:
+                Telemetry.record(node.hostname, 'fanout', start, 1)
+                return False
+        else:
+            for pkg in pkgs:
+                cmds.append(r'''wget -q --tries=3 --waitretry=1 --retry-connrefused -O %(pkg)s http://%(source)s:%(port)d/%(pkg)s''' %
+                           {'pkg'    : pkg,
+                            'source' : source.hostname,
+                            'port'   : const.FANOUT_PORT})
+        for pkg in pkgs:
+            cmds.append(r'''cp -f %(pkg)s %(dst_dir)s/%(pkg)s''' %
+                       {'pkg' : pkg, 'dst_dir' : node.dst_dir})
+            cmds.append(r'''chmod 777 %(dst_dir)s/%(pkg)s''' %
+                       {'pkg' : pkg, 'dst_dir' : node.dst_dir})
+        cmds.append(r'''sha256sum %(files)s''' %
+                   {'files' : ' '.join([r'''%(dst_dir)s/%(pkg)s''' %
+                                        {'dst_dir' : node.dst_dir, 'pkg' : pkg}
+                                        for pkg in pkgs])})
+        ok, output = PackageFanout.__run__(node,
+            r'''bash -c '%(cmds)s' ''' % {'cmds' : ' && '.join(cmds)},
+            const.FANOUT_TIMEOUT)
+        ok = ok and PackageFanout.__verify__(node, pkgs, hashes, output)
+        Telemetry.record(node.hostname, 'fanout', start, int(not ok))
+        return ok
+
+
+    @staticmethod
+    def __start_serving__(node, pkgs):
+        """
+        Serve the verified copies on node to the next wave.
+        Return True once the server answers for all pkgs.
+        """
+        cmds = [r'''cd %(fanout_dir)s''' % {'fanout_dir' : const.FANOUT_DIR},
+                (r'''{ setsid nohup python -m SimpleHTTPServer %(port)d < /dev/null > /dev/null 2>&1 & echo \$! > %(pid_file)s; }''' %
+                {'port' : const.FANOUT_PORT, 'pid_file' : const.FANOUT_PID_FILE})]
+        for pkg in pkgs:
+            cmds.append(r'''wget -q --tries=5 --waitretry=1 --retry-connrefused -O /dev/null http://127.0.0.1:%(port)d/%(pkg)s''' %
+                       {'port' : const.FANOUT_PORT, 'pkg' : pkg})
+        ok, output = PackageFanout.__run__(node,
+            r'''bash -c '%(cmds)s' ''' % {'cmds' : ' && '.join(cmds)},
+            const.DISCOVERY_TIMEOUT)
+        if not ok:
+            Helper.safe_print("Fan out server on %(hostname)s did not come up, "
+                              "it won't serve the next wave\n" %
+                             {'hostname' : node.hostname})
+        return ok
+
+
+    @staticmethod
+    def __stop_serving__(node):
+        # only kill the pid recorded by __start_serving__, and only
+        # if it is still the http server
+        PackageFanout.__run__(node,
+            (r'''bash -c 'pid=\$(cat %(pid_file)s 2>/dev/null) && grep -q SimpleHTTPServer /proc/\$pid/cmdline && kill \$pid; rm -f %(pid_file)s' ''' %
+            {'pid_file' : const.FANOUT_PID_FILE}),
+            const.DISCOVERY_TIMEOUT)
+
+
+    @staticmethod
+    def __distribute_group__(pkgs, nodes):
+        hashes = {}
+        for pkg in pkgs:
+            hashes[pkg] = PackageFanout.__sha256__(
+                r'''%(src_dir)s/%(pkg)s''' % {'src_dir' : nodes[0].setup_node_dir, 'pkg' : pkg})
+
+        pending = collections.deque(nodes)
+        holders = []
+        # holders whose http server came up
+        servers = []
+        # None stands for the setup node, which only seeds the first wave
+        sources = [None]
+        wave = 0
+        try:
+            while pending and sources:
+                jobs = []
+                for source in sources:
+                    for i in range(const.FANOUT_DEGREE):
+                        if not pending:
+                            break
+                        jobs.append((source, pending.popleft()))
+                Helper.safe_print("Fan out %(pkgs)s to %(count)d nodes, wave %(wave)d\n" %
+                                 {'pkgs'  : ', '.join(pkgs),
+                                  'count' : len(jobs),
+                                  'wave'  : wave})
+                with ThreadPoolExecutor(max_workers=const.MAX_WORKERS) as executor:
+                    futures = [(node, executor.submit(PackageFanout.__copy_from_source__,
+                                                      source, node, pkgs, hashes))
+                               for source, node in jobs]
+                    copied = []
+                    for node, future in futures:
+                        if future.result():
+                            node.fanout_pkgs = list(pkgs)
+                            holders.append(node)
+                            copied.append(node)
+                    futures = [(node, executor.submit(PackageFanout.__start_serving__,
+                                                      node, pkgs))
+                               for node in copied]
+                    for node, future in futures:
+                        if future.result():
+                            servers.append(node)
+                sources = list(servers)
+                wave += 1
+        finally:
+            with ThreadPoolExecutor(max_workers=const.MAX_WORKERS) as executor:
+                list(executor.map(PackageFanout.__stop_serving__, holders))
+
+
+    @staticmethod
+    def distribute(nodes):
+        """
+        Fan out the ivs packages of the given t6 nodes. Nodes
+        with the same packages form one tree.
+        """
+        groups = collections.OrderedDict()
+        for node in nodes:
+            if node.deploy_mode != const.T6:
+                continue
+            pkgs = [node.ivs_pkg]
+            if node.ivs_debug_pkg != None:
+                pkgs.append(node.ivs_debug_pkg)
+            groups.setdefault(tuple(pkgs), []).append(node)
+        for pkgs, group in groups.iteritems():
+            PackageFanout.__distribute_group__(list(pkgs), group)
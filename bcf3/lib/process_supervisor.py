@@ -0,0 +1,252 @@
+import os
+import time
+import heapq
+import errno
+import select
+import signal
+import itertools
+import threading
+import traceback
+import subprocess32 as subprocess
+
+
+class Job(object):
+    """
+    One child process owned by the supervisor.
+    """
+    def __init__(self, command, timeout, on_line, callback):
+        self.command   = command
+        self.on_line   = on_line
+        self.callback  = callback
+        self.deadline  = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        self.proc      = None
+        # fd -> list of chunks read so far
+        self.buffers   = {}
+        self.output    = ''
+        self.error     = ''
+        self.timed_out = False
+        self.done      = threading.Event()
+
+
+class ProcessSupervisor(object):
+    """
+    One thread owns all child processes started through it. It
+    polls their pipes, kills the process group of a child whose
+    deadline passed, and reaps it. Callers block on their job,
+    so the number of threads does not grow with concurrency.
+    """
+
+    __lock = threading.Lock()
+    __thread = None
+    __wakeup = None
+    # jobs submitted but not registered by the loop yet
+    __pending = []
+    # interval to check children which closed their pipes
+    __reap_interval = 0.1
+
+    @staticmethod
+    def __start__():
+        # called with __lock held
+        if ProcessSupervisor.__thread:
+            return
+        if not ProcessSupervisor.__wakeup:
+            ProcessSupervisor.__wakeup = os.pipe()
+        t = threading.Thread(target=ProcessSupervisor.__run__)
+        t.daemon = True
+        t.start()
+        ProcessSupervisor.__thread = t
+
+
+    @staticmethod
+    def __run__():
+        # jobs registered by the loop which are not done yet
+        jobs = set()
+        try:
+            ProcessSupervisor.__loop__(jobs)
+        except BaseException as e:
+            ProcessSupervisor.__fail__(jobs, e)
+
+
+    @staticmethod
+    def __fail__(jobs, e):
+        """
+        The loop died, kill and finish all its jobs so no caller
+        waits forever. The next submit starts a new loop.
+        """
+        traceback.print_exc()
+        with ProcessSupervisor.__lock:
+            ProcessSupervisor.__thread = None
+            jobs = list(jobs) + ProcessSupervisor.__pending[:]
+            del ProcessSupervisor.__pending[:]
+        for job in jobs:
+            ProcessSupervisor.cancel(job)
+            job.error = ('Process supervisor failed while running %(command)s: %(e)s' %
+                        {'command' : job.command, 'e' : e})
+            ProcessSupervisor.__finish__(job)
+
+
+    @staticmethod
+    def __call_quietly__(function, arg):
+        # a failing on_line or callback must not stop the loop
+        try:
+            function(arg)
+        except Exception:
+            traceback.print_exc()
+
+
+    @staticmethod
+    def __finish__(job):
+        job.done.set()
+        if job.callback:
+            ProcessSupervisor.__call_quietly__(job.callback, job)
+
+
+    @staticmethod
+    def __loop__(jobs):
+        poller = select.poll()
+        wakeup_fd = ProcessSupervisor.__wakeup[0]
+        poller.register(wakeup_fd, select.POLLIN)
+        # fd -> (job, is stdout)
+        fds = {}
+        # jobs whose pipes are closed but did not exit yet
+        exiting = []
+        deadlines = []
+        seq = itertools.count()
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(deadlines[0][0] - time.time(), 0)
+            if exiting and (timeout is None or timeout > ProcessSupervisor.__reap_interval):
+                timeout = ProcessSupervisor.__reap_interval
+            if timeout is not None:
+                # poll takes milliseconds
+                timeout = int(timeout * 1000)
+            try:
+                events = poller.poll(timeout)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == wakeup_fd:
+                    os.read(wakeup_fd, 4096)
+                    with ProcessSupervisor.__lock:
+                        new_jobs = ProcessSupervisor.__pending[:]
+                        del ProcessSupervisor.__pending[:]
+                    for job in new_jobs:
+                        jobs.add(job)
+                        for pipe, is_stdout in [(job.proc.stdout, True),
+                                                (job.proc.stderr, False)]:
+                            fds[pipe.fileno()] = (job, is_stdout)
+                            job.buffers[pipe.fileno()] = []
+                            poller.register(pipe.fileno(), select.POLLIN)
+                        if job.deadline is not None:
+                            heapq.heappush(deadlines, (job.deadline, next(seq), job))
+                    continue
+
+                job, is_stdout = fds[fd]
+                try:
+                    data = os.read(fd, 65536)
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    # treat a broken pipe as its end
+                    data = ''
+                if data:
+                    ProcessSupervisor.__consume__(job, fd, data)
+                    continue
+                # end of file
+                poller.unregister(fd)
+                del fds[fd]
+                ProcessSupervisor.__flush__(job, fd, is_stdout)
+                if not job.buffers:
+                    exiting.append(job)
+
+            now = time.time()
+            while deadlines and deadlines[0][0] <= now:
+                deadline, i, job = heapq.heappop(deadlines)
+                # the shell may have exited while something it started
+                # still holds the pipes open, so kill the group anyway
+                if job.done.is_set():
+                    continue
+                job.timed_out = True
+                ProcessSupervisor.cancel(job)
+
+            for job in exiting[:]:
+                if job.proc.poll() is not None:
+                    exiting.remove(job)
+                    jobs.discard(job)
+                    ProcessSupervisor.__finish__(job)
+
+
+    @staticmethod
+    def __consume__(job, fd, data):
+        if not job.on_line:
+            job.buffers[fd].append(data)
+            return
+        # hand out complete lines only
+        lines = (''.join(job.buffers[fd]) + data).split('\n')
+        job.buffers[fd] = [lines.pop()]
+        for line in lines:
+            ProcessSupervisor.__call_quietly__(job.on_line, line)
+
+
+    @staticmethod
+    def __flush__(job, fd, is_stdout):
+        rest = ''.join(job.buffers.pop(fd))
+        if job.on_line:
+            if rest:
+                ProcessSupervisor.__call_quietly__(job.on_line, rest)
+        elif is_stdout:
+            job.output = rest
+        else:
+            job.error = rest
+
+
+    @staticmethod
+    def submit(command, timeout=None, on_line=None, callback=None):
+        """
+        Start shell command in its own process group and return
+        its job without waiting. Lines of stdout and stderr go to
+        on_line, or are kept in job.output and job.error if it is
+        None. callback(job) is called from the supervisor thread
+        once the command exits. The process group is killed when
+        timeout expires.
+        """
+        job = Job(command, timeout, on_line, callback)
+        job.proc = subprocess.Popen(command, shell=True,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    close_fds=True, start_new_session=True)
+        # starting the loop and queueing the job under one lock
+        # makes sure a loop which dies meanwhile fails the job
+        with ProcessSupervisor.__lock:
+            ProcessSupervisor.__start__()
+            ProcessSupervisor.__pending.append(job)
+        os.write(ProcessSupervisor.__wakeup[1], 'x')
+        return job
+
+
+    @staticmethod
+    def cancel(job):
+        """
+        Kill the process group of job, the job finishes as usual.
+        """
+        try:
+            os.killpg(job.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+    @staticmethod
+    def run(command, timeout=None, on_line=None):
+        """
+        Run shell command and wait for it, see submit.
+        Return (returncode, output, error, timed_out).
+        """
+        job = ProcessSupervisor.submit(command, timeout, on_line)
+        job.done.wait()
+        return job.proc.returncode, job.output, job.error, job.timed_out
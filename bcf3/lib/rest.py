@@ -1,13 +1,88 @@
 import json
+import time
+import socket
 import httplib
+import logging
+import threading
+import logging.handlers
 import constants as const
 from membership_rule import MembershipRule
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 class RestLib(object):
+
+    # idle keep-alive connections, keyed by controller host
+    __connection_pool = {}
+    __pool_lock = threading.Lock()
+
+    # requests which are safe to resend on a stale connection
+    __idempotent_methods = ['GET', 'PUT', 'DELETE']
+
+    # elected (server, cookie, expiry), keyed by (servers, username, port)
+    __elections = {}
+    __election_lock = threading.Lock()
+
+    # one buffered log shared by all requests
+    __logger = None
+    __logger_lock = threading.Lock()
+
+    @staticmethod
+    def __get_logger__():
+        if RestLib.__logger:
+            return RestLib.__logger
+        with RestLib.__logger_lock:
+            if not RestLib.__logger:
+                # WatchedFileHandler reopens the log only if it is
+                # removed or rotated, e.g. by common_setup_node_preparation
+                file_handler = logging.handlers.WatchedFileHandler(const.LOG_FILE)
+                file_handler.setFormatter(logging.Formatter('%(message)s'))
+                handler = logging.handlers.MemoryHandler(const.REST_LOG_BUFFER,
+                                                         target=file_handler)
+                logger = logging.getLogger('bcf_rest')
+                logger.propagate = False
+                logger.setLevel(logging.INFO)
+                logger.addHandler(handler)
+                RestLib.__logger = logger
+        return RestLib.__logger
+
+
+    @staticmethod
+    def __get_connection__(host, reuse, timeout):
+        if reuse:
+            with RestLib.__pool_lock:
+                idle = RestLib.__connection_pool.get(host)
+                if idle:
+                    return idle.pop(), True
+        if timeout:
+            return httplib.HTTPSConnection(host, timeout=timeout), False
+        return httplib.HTTPSConnection(host), False
+
+
+    @staticmethod
+    def __release_connection__(host, connection):
+        with RestLib.__pool_lock:
+            RestLib.__connection_pool.setdefault(host, []).append(connection)
+
+
+    @staticmethod
+    def close_connections():
+        """
+        Close all idle connections and flush the log.
+        """
+        with RestLib.__pool_lock:
+            for host, idle in RestLib.__connection_pool.iteritems():
+                for connection in idle:
+                    connection.close()
+            RestLib.__connection_pool.clear()
+        if RestLib.__logger:
+            for handler in RestLib.__logger.handlers:
+                handler.flush()
+
+
     @staticmethod
     def request(url, prefix="/api/v1/data/controller/", method='GET',
-                data='', hashPath=None, host="127.0.0.1:8443", cookie=None):
+                data='', hashPath=None, host="127.0.0.1:8443", cookie=None, timeout=None):
         headers = {'Content-type': 'application/json'}
 
         if cookie:
@@ -16,27 +91,49 @@ class RestLib(object):
         if hashPath:
             headers[const.HASH_HEADER] = hashPath
 
-        connection = httplib.HTTPSConnection(host)
+        # only idempotent requests go over a pooled connection,
+        # which may have been closed by the controller meanwhile,
+        # and are resent once on a fresh connection if it was.
+        # requests with their own timeout keep their connection
+        # out of the pool.
+        pooled = timeout is None
+        reuse = pooled and method in RestLib.__idempotent_methods
+        while True:
+            connection, reused = RestLib.__get_connection__(host, reuse, timeout)
+            try:
+                connection.request(method, prefix + url, data, headers)
+                response = connection.getresponse()
+                ret = (response.status, response.reason, response.read(),
+                       response.getheader(const.HASH_HEADER))
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused:
+                    # the retry never takes a pooled connection
+                    reuse = False
+                    continue
+                raise Exception("Controller REQUEST exception: %s" % e)
+            except Exception as e:
+                connection.close()
+                raise Exception("Controller REQUEST exception: %s" % e)
+            break
 
-        try:
-            connection.request(method, prefix + url, data, headers)
-            response = connection.getresponse()
-            ret = (response.status, response.reason, response.read(),
-                   response.getheader(const.HASH_HEADER))
-            with open(const.LOG_FILE, "a") as log_file:
-                log_file.write('Controller REQUEST: %s %s:body=%r' %
-                              (method, host + prefix + url, data))
-                log_file.write('Controller RESPONSE: status=%d reason=%r, data=%r,'
-                               'hash=%r' % ret)
-            return ret
-        except Exception as e:
-            raise Exception("Controller REQUEST exception: %s" % e)
+        if response.will_close or not pooled:
+            connection.close()
+        else:
+            RestLib.__release_connection__(host, connection)
+        logger = RestLib.__get_logger__()
+        logger.info('Controller REQUEST: %s %s:body=%r' %
+                    (method, host + prefix + url, data))
+        logger.info('Controller RESPONSE: status=%d reason=%r, data=%r,'
+                    'hash=%r' % ret)
+        return ret
 
 
     @staticmethod
-    def get(cookie, url, server, port, hashPath=None):
+    def get(cookie, url, server, port, hashPath=None, timeout=None):
         host = "%s:%d" % (server, port)
-        return RestLib.request(url, hashPath=hashPath, host=host, cookie=cookie)
+        return RestLib.request(url, hashPath=hashPath, host=host, cookie=cookie,
+                               timeout=timeout)
 
 
     @staticmethod
@@ -61,19 +158,19 @@ class RestLib(object):
 
 
     @staticmethod
-    def delete(cookie, url, server, port, hashPath=None):
+    def delete(cookie, url, server, port, hashPath=None, timeout=None):
         host = "%s:%d" % (server, port)
         return RestLib.request(url, method='DELETE', hashPath=hashPath, host=host,
-                               cookie=cookie)
+                               cookie=cookie, timeout=timeout)
 
 
     @staticmethod
-    def auth_bcf(server, username, password, port=const.BCF_CONTROLLER_PORT):
+    def auth_bcf(server, username, password, port=const.BCF_CONTROLLER_PORT, timeout=None):
         login = {"user": username, "password": password}
         host = "%s:%d" % (server, port)
         ret = RestLib.request("/api/v1/auth/login", prefix='',
                                method='POST', data=json.dumps(login),
-                               host=host)
+                               host=host, timeout=timeout)
         session = json.loads(ret[2])
         if ret[0] != 200:
             raise Exception(ret)
@@ -82,24 +179,94 @@ class RestLib(object):
         return session["session_cookie"]
 
     @staticmethod
-    def logout_bcf(cookie, server, port=const.BCF_CONTROLLER_PORT):
+    def logout_bcf(cookie, server, port=const.BCF_CONTROLLER_PORT, timeout=None):
         url = "core/aaa/session[auth-token=\"%s\"]" % cookie
-        ret = RestLib.delete(cookie, url, server, port)
+        ret = RestLib.delete(cookie, url, server, port, timeout=timeout)
         return ret
 
 
+    @staticmethod
+    def __probe_bcf_controller__(server, username, password, port):
+        """
+        Return the cookie if server is the active controller.
+        Sessions on other controllers are logged out.
+        """
+        try:
+            cookie = RestLib.auth_bcf(server, username, password, port,
+                                      const.BCF_PROBE_TIMEOUT)
+        except Exception as e:
+            return None
+        try:
+            url = 'core/controller/role'
+            res = RestLib.get(cookie, url, server, port,
+                              timeout=const.BCF_PROBE_TIMEOUT)[2]
+            if 'active' in res:
+                return cookie
+        except Exception as e:
+            pass
+        RestLib.__logout_quietly__(server, cookie, port)
+        return None
+
+
+    @staticmethod
+    def __logout_quietly__(server, cookie, port):
+        try:
+            RestLib.logout_bcf(cookie, server, port, const.BCF_PROBE_TIMEOUT)
+        except Exception as e:
+            pass
+
+
+    @staticmethod
+    def __logout_loser__(server, port):
+        def logout(future):
+            cookie = future.result()
+            if cookie:
+                RestLib.__logout_quietly__(server, cookie, port)
+        return logout
+
+
     @staticmethod
     def get_active_bcf_controller(servers, username, password, port=const.BCF_CONTROLLER_PORT):
-        for server in servers:
-            try:
-                cookie = RestLib.auth_bcf(server, username, password, port)
-                url = 'core/controller/role'
-                res = RestLib.get(cookie, url, server, port)[2]
-                if 'active' in res:
-                    return server, cookie
-            except Exception as e:
-                continue
-        return None, None
+        """
+        Probe all controllers concurrently, the first active one
+        wins. The result is cached for BCF_ELECTION_TTL seconds.
+        """
+        key = (tuple(servers), username, port)
+        with RestLib.__election_lock:
+            election = RestLib.__elections.get(key)
+            if election and election[2] > time.time():
+                return election[0], election[1]
+
+            master, master_cookie = None, None
+            executor = ThreadPoolExecutor(max_workers=max(len(servers), 1))
+            futures = dict((executor.submit(RestLib.__probe_bcf_controller__,
+                                            server, username, password, port), server)
+                           for server in servers)
+            for future in as_completed(futures):
+                cookie = future.result()
+                if cookie:
+                    master, master_cookie = futures[future], cookie
+                    break
+            # do not wait for slower controllers,
+            # log out their sessions once they answer
+            for future, server in futures.iteritems():
+                if server != master:
+                    future.add_done_callback(RestLib.__logout_loser__(server, port))
+            executor.shutdown(wait=False)
+
+            if master:
+                RestLib.__elections[key] = (master, master_cookie,
+                                            time.time() + const.BCF_ELECTION_TTL)
+            return master, master_cookie
+
+
+    @staticmethod
+    def invalidate_active_bcf_controller(servers, username, port=const.BCF_CONTROLLER_PORT):
+        """
+        Drop the cached election, e.g. when its cookie is rejected.
+        """
+        with RestLib.__election_lock:
+            RestLib.__elections.pop((tuple(servers), username, port), None)
 
 
     @staticmethod
@@ -118,39 +285,63 @@ class RestLib(object):
 
 
     @staticmethod
-    def program_segment_and_membership_rule(server, cookie, rule, port=const.BCF_CONTROLLER_PORT):
-        segment_url = (r'''applications/bcf/tenant[name="%(tenant)s"]/segment[name="%(segment)s"]''' %
-                      {'tenant' : const.OS_MGMT_TENANT, 'segment' : rule.br_key})
-        segment_data = {"name": rule.br_key}
-        ret = RestLib.put(cookie, segment_url, server, port, json.dumps(segment_data))
-        if ret[0] != 204:
+    def get_os_mgmt_membership_rules(server, cookie, port=const.BCF_CONTROLLER_PORT):
+        """
+        Read the os-mgmt tenant config once and return the keys,
+        as built by __membership_requests__, of its segments and
+        membership rules. A tenant which doesn't exist yet has
+        none, all of them are programmed then.
+        """
+        url = (r'''applications/bcf/tenant[name="%(tenant)s"]''' %
+              {'tenant' : const.OS_MGMT_TENANT})
+        ret = RestLib.get(cookie, url, server, port)
+        existing = set()
+        if ret[0] == 404:
+            return existing
+        if ret[0] != 200:
             raise Exception(ret)
+        for tenant in json.loads(ret[2]):
+            for segment in tenant.get('segment', []):
+                existing.add(('segment', segment['name']))
+                for rule in segment.get('switch-port-membership-rule', []):
+                    existing.add(('switch-port-membership-rule', segment['name'],
+                                  rule.get('interface'), rule.get('switch'),
+                                  rule.get('vlan')))
+                for rule in segment.get('port-group-membership-rule', []):
+                    existing.add(('port-group-membership-rule', segment['name'],
+                                  rule.get('port-group'), rule.get('vlan')))
+        return existing
+
 
+    @staticmethod
+    def __membership_requests__(rule):
+        """
+        Return [(key, url, data)] of the segment and membership
+        rules of one MembershipRule, segment first.
+        """
         if rule.br_vlan:
             vlan = int(rule.br_vlan)
         else:
             vlan = -1
 
+        segment_url = (r'''applications/bcf/tenant[name="%(tenant)s"]/segment[name="%(segment)s"]''' %
+                      {'tenant' : const.OS_MGMT_TENANT, 'segment' : rule.br_key})
+        segment_data = {"name": rule.br_key}
+
         intf_rule_url = (r'''applications/bcf/tenant[name="%(tenant)s"]/segment[name="%(segment)s"]/switch-port-membership-rule[interface="%(interface)s"][switch="%(switch)s"][vlan=%(vlan)d]''' %
                        {'tenant'    : const.OS_MGMT_TENANT,
                         'segment'   : rule.br_key,
                         'interface' : const.ANY,
                         'switch'    : const.ANY,
                         'vlan'      : vlan})
-        rule_data = {"interface" : const.ANY, "switch" : const.ANY, "vlan" : vlan}
-        ret = RestLib.put(cookie, intf_rule_url, server, port, json.dumps(rule_data))
-        if ret[0] != 204:
-            raise Exception(ret)
+        intf_rule_data = {"interface" : const.ANY, "switch" : const.ANY, "vlan" : vlan}
 
         pg_rule_url = (r'''applications/bcf/tenant[name="%(tenant)s"]/segment[name="%(segment)s"]/port-group-membership-rule[port-group="%(pg)s"][vlan=%(vlan)d]''' %
                        {'tenant'    : const.OS_MGMT_TENANT,
                         'segment'   : rule.br_key,
                         'pg'        : const.ANY,
                         'vlan'      : vlan})
-        rule_data = {"port-group" : const.ANY, "vlan" : vlan}
-        ret = RestLib.put(cookie, pg_rule_url, server, port, json.dumps(rule_data))
-        if ret[0] != 204:
-            raise Exception(ret)
+        pg_rule_data = {"port-group" : const.ANY, "vlan" : vlan}
 
         specific_rule_url = (r'''applications/bcf/tenant[name="%(tenant)s"]/segment[name="%(segment)s"]/switch-port-membership-rule[interface="%(interface)s"][switch="%(switch)s"][vlan=%(vlan)d]''' %
                        {'tenant'    : const.OS_MGMT_TENANT,
@@ -158,10 +349,61 @@ class RestLib(object):
                         'interface' : rule.br_key,
                         'switch'    : const.ANY,
                         'vlan'      : -1})
-        rule_data = {"interface" : rule.br_key, "switch" : const.ANY, "vlan" : -1}
-        ret = RestLib.put(cookie, specific_rule_url, server, port, json.dumps(rule_data))
-        if ret[0] != 204:
-            raise Exception(ret)
+        specific_rule_data = {"interface" : rule.br_key, "switch" : const.ANY, "vlan" : -1}
+
+        return [(('segment', rule.br_key),
+                 segment_url, segment_data),
+                (('switch-port-membership-rule', rule.br_key, const.ANY, const.ANY, vlan),
+                 intf_rule_url, intf_rule_data),
+                (('port-group-membership-rule', rule.br_key, const.ANY, vlan),
+                 pg_rule_url, pg_rule_data),
+                (('switch-port-membership-rule', rule.br_key, rule.br_key, const.ANY, -1),
+                 specific_rule_url, specific_rule_data)]
+
 
+    @staticmethod
+    def program_segment_and_membership_rule(server, cookie, rule, port=const.BCF_CONTROLLER_PORT,
+                                            existing=None):
+        """
+        PUT the segment and membership rules of rule which are not
+        in existing. Return lists of created and skipped keys.
+        """
+        created = []
+        skipped = []
+        for key, url, data in RestLib.__membership_requests__(rule):
+            if existing and key in existing:
+                skipped.append(key)
+                continue
+            ret = RestLib.put(cookie, url, server, port, json.dumps(data))
+            if ret[0] != 204:
+                raise Exception(ret)
+            created.append(key)
+        return created, skipped
 
 
+    @staticmethod
+    def program_membership_rules(server, cookie, rules, port=const.BCF_CONTROLLER_PORT):
+        """
+        Reconcile the os-mgmt tenant with rules. The tenant config
+        is read once, then only missing segments and membership rules
+        are programmed, MAX_REST_WORKERS segments at a time. Return
+        lists of created and skipped keys and of (br_key, error) for
+        the rules which failed.
+        """
+        existing = RestLib.get_os_mgmt_membership_rules(server, cookie, port)
+        created = []
+        skipped = []
+        failed = []
+        with ThreadPoolExecutor(max_workers=const.MAX_REST_WORKERS) as executor:
+            futures = [(rule, executor.submit(RestLib.program_segment_and_membership_rule,
+                                              server, cookie, rule, port, existing))
+                       for rule in rules]
+            for rule, future in futures:
+                try:
+                    rule_created, rule_skipped = future.result()
+                    created.extend(rule_created)
+                    skipped.extend(rule_skipped)
+                except Exception as e:
+                    failed.append((rule.br_key, e))
+        return created, skipped, failed
+
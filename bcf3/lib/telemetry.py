@@ -0,0 +1,98 @@
+import json
+import time
+import threading
+import constants as const
+
+
+class Telemetry(object):
+    """
+    Timing events of a deployment. Every event is one json line
+    in TELEMETRY_FILE with node, phase, start, duration, exit
+    code and bytes transferred.
+    """
+
+    __events = []
+    __lock = threading.Lock()
+    __file = None
+
+    @staticmethod
+    def open(resume):
+        """
+        Start a new timing file, or append to the one of an
+        interrupted run if resume is True.
+        """
+        with Telemetry.__lock:
+            if Telemetry.__file:
+                Telemetry.__file.close()
+            Telemetry.__file = open(const.TELEMETRY_FILE, 'a' if resume else 'w')
+
+
+    @staticmethod
+    def record(hostname, phase, start, exit_code=0, nbytes=0):
+        """
+        Record that phase of hostname ran from start till now.
+        """
+        event = {'node'      : hostname,
+                 'phase'     : phase,
+                 'start'     : start,
+                 'duration'  : time.time() - start,
+                 'exit_code' : exit_code,
+                 'bytes'     : nbytes}
+        with Telemetry.__lock:
+            if not Telemetry.__file:
+                Telemetry.__file = open(const.TELEMETRY_FILE, "w")
+            Telemetry.__file.write(json.dumps(event, sort_keys=True) + '\n')
+            Telemetry.__file.flush()
+            Telemetry.__events.append(event)
+
+
+    @staticmethod
+    def __percentile__(durations, percent):
+        index = int(round(percent / 100.0 * (len(durations) - 1)))
+        return durations[index]
+
+
+    @staticmethod
+    def summary(slowest=const.TELEMETRY_SLOWEST_NODES):
+        """
+        Return p50/p95/max duration per phase and the nodes
+        which spent the most time in all phases.
+        """
+        with Telemetry.__lock:
+            events = list(Telemetry.__events)
+        if not events:
+            return ''
+
+        phases = {}
+        nodes = {}
+        failures = {}
+        for event in events:
+            phases.setdefault(event['phase'], []).append(event['duration'])
+            nodes[event['node']] = nodes.get(event['node'], 0) + event['duration']
+            if event['exit_code']:
+                failures[event['phase']] = failures.get(event['phase'], 0) + 1
+
+        lines = ['%-12s %7s %9s %9s %9s %7s' %
+                 ('phase', 'count', 'p50(s)', 'p95(s)', 'max(s)', 'failed')]
+        for phase, durations in sorted(phases.iteritems()):
+            durations.sort()
+            lines.append('%-12s %7d %9.1f %9.1f %9.1f %7d' %
+                         (phase, len(durations),
+                          Telemetry.__percentile__(durations, 50),
+                          Telemetry.__percentile__(durations, 95),
+                          durations[-1],
+                          failures.get(phase, 0)))
+        lines.append('slowest nodes:')
+        for hostname, duration in sorted(nodes.iteritems(),
+                                         key=lambda item: item[1],
+                                         reverse=True)[:slowest]:
+            lines.append('  %-40s %9.1f' % (hostname, duration))
+        return '\n'.join(lines) + '\n'
+
+
+    @staticmethod
+    def close():
+        with Telemetry.__lock:
+            if Telemetry.__file:
+                Telemetry.__file.close()
+                Telemetry.__file = None
@@ -0,0 +1,58 @@
+import re
+import threading
+
+
+class TemplateRegistry(object):
+    """
+    Templates are read from disk once and shared by all nodes.
+    A template path is unique per deploy_mode, os, os_version
+    and role, so the path is used as the key.
+    """
+
+    # path -> (content, set of placeholders)
+    __templates = {}
+    __lock = threading.Lock()
+
+    __placeholder = re.compile(r'%\(([^)]+)\)')
+
+    @staticmethod
+    def __load__(path):
+        with open(path, "r") as template_file:
+            content = template_file.read()
+        placeholders = set(TemplateRegistry.__placeholder.findall(content.replace('%%', '')))
+        # make sure the template renders at all, e.g. no stray '%'
+        try:
+            content % dict((name, '') for name in placeholders)
+        except (KeyError, TypeError, ValueError) as e:
+            raise Exception("Invalid template %(path)s: %(error)s" %
+                           {'path' : path, 'error' : e})
+        return content, placeholders
+
+
+    @staticmethod
+    def get(path):
+        """
+        Return (content, placeholders) of the template at path.
+        """
+        template = TemplateRegistry.__templates.get(path)
+        if template:
+            return template
+        with TemplateRegistry.__lock:
+            if path not in TemplateRegistry.__templates:
+                TemplateRegistry.__templates[path] = TemplateRegistry.__load__(path)
+            return TemplateRegistry.__templates[path]
+
+
+    @staticmethod
+    def render(path, values):
+        """
+        Render the template at path with values, which must
+        provide every placeholder of the template.
+        """
+        content, placeholders = TemplateRegistry.get(path)
+        missing = placeholders.difference(values)
+        if missing:
+            raise Exception("Template %(path)s misses values for %(missing)s" %
+                           {'path' : path, 'missing' : ', '.join(sorted(missing))})
+        return content % values
+
@@ -1,48 +1,227 @@
+import time
 import yaml
 import Queue
 import argparse
 import threading
 import lib.constants as const
 import subprocess32 as subprocess
+from concurrent.futures import ThreadPoolExecutor
 from lib.node import Node
+from lib.rest import RestLib
 from lib.helper import Helper
 from lib.environment import Environment
+from lib.telemetry import Telemetry
+from lib.adaptive_limit import AdaptiveLimit
+from lib.package_fanout import PackageFanout
+from lib.event_engine import EventEngine, Slots, Command
+from lib.journal import Journal
 
 
-# queue to store all nodes
-node_q = Queue.Queue()
+# nodes waiting for their packages and scripts
+transfer_q = Queue.Queue()
+# nodes waiting to run their scripts
+execute_q = Queue.Queue()
 
+# concurrency limits of the two stages, set up by deploy_bcf
+transfer_limit = None
+execute_limit = None
 
-def worker_setup_node():
+
+def worker_transfer_node():
     while True:
-        node = node_q.get()
+        node = transfer_q.get()
+        start = transfer_limit.acquire()
+        # one ssh master connection serves all commands to node
+        Helper.open_ssh_session_to_node(node)
+
         # copy ivs pkg to node
-        Helper.copy_pkg_scripts_to_remote(node)
+        size = sum([Helper.get_file_size(src_file) for description, src_file
+                    in Helper.get_pkg_scripts_of_node(node)])
+        ok = Helper.copy_pkg_scripts_to_remote(node)
+        transfer_limit.release(start, ok, size)
+        if ok:
+            Journal.record_copy(node)
+            execute_q.put(node)
+        else:
+            Helper.safe_print("Failed to copy packages and scripts to %(hostname)s, skip deploying it\n" %
+                             {'hostname' : node.hostname})
+        transfer_q.task_done()
+
+
+def get_ospurge_command(node):
+    return (r'''/bin/bash %(dst_dir)s/%(hostname)s_ospurge.sh >> %(log)s 2>&1''' %
+           {'dst_dir'  : node.dst_dir,
+            'hostname' : node.hostname,
+            'log'      : node.log})
+
+
+def get_deploy_command(node):
+    # the fingerprint is only stored if the deployment succeeds
+    return (r'''bash -c 'rm -f %(fingerprint_file)s && /bin/bash %(dst_dir)s/%(hostname)s.sh >> %(log)s 2>&1 && echo %(fingerprint)s > %(fingerprint_file)s' ''' %
+           {'dst_dir'          : node.dst_dir,
+            'hostname'         : node.hostname,
+            'log'              : node.log,
+            'fingerprint'      : node.fingerprint,
+            'fingerprint_file' : const.DEPLOY_FINGERPRINT_FILE})
+
+
+def get_execute_phases(node):
+    """
+    Return [(phase, remote command)] to run on node. ospurge
+    is not repeated if the journal has it done already.
+    """
+    phases = []
+    if node.role == const.ROLE_NEUTRON_SERVER and not Journal.is_done(node, 'ospurge'):
+        phases.append(('ospurge', get_ospurge_command(node)))
+    phases.append(('deploy', get_deploy_command(node)))
+    return phases
+
+
+def worker_execute_node():
+    while True:
+        node = execute_q.get()
+        start = execute_limit.acquire()
 
         # deploy node
         Helper.safe_print("Start to deploy %(hostname)s\n" %
                          {'hostname' : node.hostname})
-        if node.role == const.ROLE_NEUTRON_SERVER:
-            Helper.run_command_on_remote(node,
-                (r'''/bin/bash %(dst_dir)s/%(hostname)s_ospurge.sh >> %(log)s 2>&1''' %
-                {'dst_dir'  : node.dst_dir,
-                 'hostname' : node.hostname,
-                 'log'      : node.log}))
-        Helper.run_command_on_remote(node,
-            (r'''/bin/bash %(dst_dir)s/%(hostname)s.sh >> %(log)s 2>&1''' %
-            {'dst_dir'  : node.dst_dir,
-             'hostname' : node.hostname,
-             'log'      : node.log}))
+        ok = True
+        for phase, command in get_execute_phases(node):
+            phase_start = time.time()
+            code = Helper.run_command_on_remote(node, command)
+            Telemetry.record(node.hostname, phase, phase_start, code)
+            if code == 0:
+                Journal.record(node, phase)
+            ok = code == 0 and ok
+        execute_limit.release(start, ok)
         Helper.safe_print("Finish deploying %(hostname)s\n" %
                          {'hostname' : node.hostname})
-        node_q.task_done()
+        execute_q.task_done()
+
+
+def task_check_node(node, slots, unchanged):
+    """
+    Event engine task, add node to unchanged if it was deployed
+    with the same fingerprint before.
+    """
+    yield slots.acquire()
+    code, output, errors, timed_out = yield Command(
+        Helper.get_remote_command_with_output(node, Helper.get_fingerprint_check_command(node)),
+        const.DISCOVERY_TIMEOUT)
+    yield slots.release()
+    if Helper.has_fingerprint(node, output):
+        unchanged.add(node.hostname)
+
+
+def task_deploy_node(node, transfer_slots, execute_slots, copied):
+    """
+    Event engine task, copy packages and scripts to node unless
+    they are copied already, and run them. Each stage holds a
+    slot of its own.
+    """
+    yield transfer_slots.acquire()
+    # one ssh master connection serves all commands to node
+    check_cmd, master_cmd = Helper.get_ssh_session_commands_of_node(node)
+    code, output, errors, timed_out = yield Command(check_cmd)
+    if code != 0:
+        yield Command(master_cmd)
+
+    ok = True
+    copies = []
+    if not copied:
+        copies = Helper.get_pkg_scripts_copies(node)
+    for description, size, commands in copies:
+        Helper.safe_print("Copy %(description)s to %(hostname)s\n" %
+                         {'description' : description,
+                          'hostname'    : node.hostname})
+        phase_start = time.time()
+        copy_code = 0
+        for command in commands:
+            code, output, errors, timed_out = yield Command(command,
+                const.EVENT_COMMAND_TIMEOUT, Helper.print_output_line)
+            copy_code = code or copy_code
+        Telemetry.record(node.hostname, 'copy', phase_start, copy_code, size)
+        ok = ok and copy_code == 0
+    if copies and ok:
+        Journal.record_copy(node)
+    yield transfer_slots.release()
+    if not ok:
+        Helper.safe_print("Failed to copy packages and scripts to %(hostname)s, skip deploying it\n" %
+                         {'hostname' : node.hostname})
+        return
+
+    yield execute_slots.acquire()
+    Helper.safe_print("Start to deploy %(hostname)s\n" %
+                     {'hostname' : node.hostname})
+    for phase, command in get_execute_phases(node):
+        phase_start = time.time()
+        code, output, errors, timed_out = yield Command(
+            Helper.get_remote_command(node, command),
+            const.EVENT_COMMAND_TIMEOUT, Helper.print_output_line)
+        Telemetry.record(node.hostname, phase, phase_start, code)
+        if code == 0:
+            Journal.record(node, phase)
+    yield execute_slots.release()
+    Helper.safe_print("Finish deploying %(hostname)s\n" %
+                     {'hostname' : node.hostname})
+
+
+def run_tasks(tasks):
+    """
+    Run event engine tasks, quit deployment on Ctrl-C.
+    """
+    engine = EventEngine(lambda e: Helper.safe_print("Task failed: %(e)s\n" % {'e' : e}))
+    for task in tasks:
+        engine.spawn(task)
+    if engine.run():
+        return
+    Helper.safe_print("Deployment cancelled, commands in progress are killed. "
+                      "Run again with --resume to continue it\n")
+    Telemetry.close()
+    Journal.close()
+    Helper.close_ssh_sessions()
+    RestLib.close_connections()
+    Helper.close_console()
+    exit(1)
+
+
+def deploy_nodes_by_threads(nodes_to_deploy, env, copied):
+    # Transfers for later nodes overlap script runs on earlier
+    # ones, each stage adapts its own concurrency limit
+    global transfer_limit, execute_limit
+    bandwidth = None
+    if env.setup_node_bandwidth:
+        bandwidth = env.setup_node_bandwidth * 1024 * 1024
+    transfer_limit = AdaptiveLimit('transfer', const.TRANSFER_WORKERS,
+        const.MIN_STAGE_WORKERS, const.MAX_TRANSFER_WORKERS, bandwidth)
+    execute_limit = AdaptiveLimit('execute', const.MAX_WORKERS,
+        const.MIN_STAGE_WORKERS, const.MAX_EXECUTE_WORKERS)
+    for node in nodes_to_deploy:
+        if node.hostname in copied:
+            execute_q.put(node)
+        else:
+            transfer_q.put(node)
 
+    for target, count in [(worker_transfer_node, const.MAX_TRANSFER_WORKERS),
+                          (worker_execute_node, const.MAX_EXECUTE_WORKERS)]:
+        for i in range(min(count, max(len(nodes_to_deploy), 1))):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+    transfer_q.join()
+    execute_q.join()
+    Helper.safe_print("%(transfer)s; %(execute)s\n" %
+                     {'transfer' : transfer_limit, 'execute' : execute_limit})
 
-def deploy_bcf(config, fuel_cluster_id):
+
+def deploy_bcf(config, fuel_cluster_id, force=False, engine=const.ENGINE_THREAD,
+               resume=False):
     # Deploy setup node
     Helper.safe_print("Start to prepare setup node\n")
     env = Environment(config, fuel_cluster_id)
-    Helper.common_setup_node_preparation(env)
+    Helper.common_setup_node_preparation(env, resume)
+    Journal.open(resume)
+    Telemetry.open(resume)
 
     # Generate detailed node information
     Helper.safe_print("Start to setup Big Cloud Fabric\n")
@@ -51,27 +230,77 @@ def deploy_bcf(config, fuel_cluster_id):
         nodes_yaml_config = config['nodes']
     node_dic = Helper.load_nodes(nodes_yaml_config, env)
 
-    # Generate scripts for each node
+    # Generate scripts for each node, templates are loaded once
+    Helper.load_templates(node_dic.values())
+    with ThreadPoolExecutor(max_workers=const.MAX_WORKERS) as executor:
+        list(executor.map(Helper.generate_scripts, node_dic.values()))
+        list(executor.map(Helper.compute_fingerprint, node_dic.values()))
+
+    # Log shared settings once and one json line per node
+    nodes_to_deploy = []
+    with open(const.LOG_FILE, "a") as log_file:
+        log_file.write("environment: %(env)s\n" % {'env' : env.get_node_env_log()})
+        for node in node_dic.itervalues():
+            log_file.write("node: %(node)s\n" % {'node' : node})
     for hostname, node in node_dic.iteritems():
-        if node.os == const.CENTOS:
-            Helper.generate_scripts_for_centos(node)
-        elif node.os == const.UBUNTU:
-            Helper.generate_scripts_for_ubuntu(node)
-        with open(const.LOG_FILE, "a") as log_file:
-            log_file.write(str(node))
         if node.skip:
             Helper.safe_print("skip node %(hostname)s due to %(error)s\n" %
                              {'hostname' : hostname,
                               'error'    : node.error})
             continue
-        node_q.put(node)
-
-    # Use multiple threads to setup nodes
-    for i in range(const.MAX_WORKERS):
-        t = threading.Thread(target=worker_setup_node)
-        t.daemon = True
-        t.start()
-    node_q.join()
+        nodes_to_deploy.append(node)
+
+    # Skip nodes which are deployed with the same scripts already
+    if not force:
+        if engine == const.ENGINE_EVENT:
+            slots = Slots('check', const.MAX_DISCOVERY_WORKERS)
+            hostnames = set()
+            run_tasks([task_check_node(node, slots, hostnames)
+                       for node in nodes_to_deploy])
+            unchanged = [node.hostname in hostnames for node in nodes_to_deploy]
+        else:
+            with ThreadPoolExecutor(max_workers=const.MAX_DISCOVERY_WORKERS) as executor:
+                unchanged = list(executor.map(Helper.is_node_unchanged, nodes_to_deploy))
+        for node, is_unchanged in zip(list(nodes_to_deploy), unchanged):
+            if is_unchanged:
+                Helper.safe_print("skip node %(hostname)s, it is unchanged since last deployment\n" %
+                                 {'hostname' : node.hostname})
+                nodes_to_deploy.remove(node)
+
+    # Nodes which got all their packages and scripts before the
+    # last run was interrupted only run them, if the copies match
+    copied = set()
+    if resume:
+        with ThreadPoolExecutor(max_workers=const.MAX_DISCOVERY_WORKERS) as executor:
+            verified = list(executor.map(Journal.verify_copy, nodes_to_deploy))
+        for node, is_verified in zip(nodes_to_deploy, verified):
+            if is_verified:
+                Helper.safe_print("Resume %(hostname)s, packages and scripts are copied already\n" %
+                                 {'hostname' : node.hostname})
+                copied.add(node.hostname)
+
+    # Let nodes serve ivs packages to each other
+    if env.deploy_mode == const.T6 and env.ivs_fanout:
+        PackageFanout.distribute([node for node in nodes_to_deploy
+                                  if node.hostname not in copied])
+
+    if engine == const.ENGINE_EVENT:
+        transfer_slots = Slots('transfer', const.EVENT_TRANSFER_SLOTS)
+        execute_slots = Slots('execute', const.EVENT_EXECUTE_SLOTS)
+        run_tasks([task_deploy_node(node, transfer_slots, execute_slots,
+                                    node.hostname in copied)
+                   for node in nodes_to_deploy])
+    else:
+        deploy_nodes_by_threads(nodes_to_deploy, env, copied)
+    Helper.safe_print("Deployment timing, events are in %(telemetry)s:\n%(summary)s" %
+                     {'telemetry' : const.TELEMETRY_FILE,
+                      'summary'   : Telemetry.summary()})
+    Telemetry.close()
+    Journal.close()
+
+    # tear down ssh master and controller connections
+    Helper.close_ssh_sessions()
+    RestLib.close_connections()
     Helper.safe_print("Big Cloud Fabric deployment finished! Check %(log)s on each node for details.\n" %
                      {'log' : const.LOG_FILE})
 
@@ -90,8 +319,15 @@ if __name__=='__main__':
                         help="BCF YAML configuration file")
     parser.add_argument('-f', "--fuel-cluster-id", required=False,
                         help="Fuel cluster ID. Fuel settings may override YAML configuration. Please refer to example.yaml")
+    parser.add_argument("--force", action='store_true', default=False,
+                        help="Deploy all nodes, including the ones unchanged since last deployment")
+    parser.add_argument("--engine", choices=[const.ENGINE_THREAD, const.ENGINE_EVENT],
+                        default=const.ENGINE_THREAD,
+                        help="Deploy nodes by a pool of threads per stage, or by one event loop which can drive thousands of nodes")
+    parser.add_argument("--resume", action='store_true', default=False,
+                        help="Continue an interrupted deployment, the log and the journal of completed work are kept")
     args = parser.parse_args()
     with open(args.config_file, 'r') as config_file:
         config = yaml.load(config_file)
-    deploy_bcf(config, args.fuel_cluster_id)
+    deploy_bcf(config, args.fuel_cluster_id, args.force, args.engine, args.resume)
 
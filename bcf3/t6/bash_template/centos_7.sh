@@ -13,6 +13,18 @@ ivs_version=%(ivs_version)s
 is_controller=%(is_controller)s
 deploy_horizon_patch=%(deploy_horizon_patch)s
 
+# steps which must succeed run through step, the script exits
+# non-zero at the end if any of them failed, so the deployment
+# is not recorded as done
+deploy_failed=false
+step() {
+    "$@"
+    if [[ $? != 0 ]]; then
+        echo "Failed: $*"
+        deploy_failed=true
+    fi
+}
+
 # prepare dependencies
 set +e
 rpm -iUvh http://dl.fedoraproject.org/pub/epel/7/x86_64/e/epel-release-7-5.noarch.rpm
@@ -22,7 +34,7 @@ yum install -y python-devel puppet python-pip wget libffi-devel openssl-devel
 
 # install bsnstacklib
 if [[ $install_bsnstacklib == true ]]; then
-    pip install --upgrade "bsnstacklib<%(bsnstacklib_version)s"
+    step pip install --upgrade "bsnstacklib<%(bsnstacklib_version)s"
 fi
 
 # install ivs
@@ -42,9 +54,9 @@ if [[ $install_ivs == true ]]; then
     fi
 
     if [[ $pass == true ]]; then
-        rpm -ivh --force %(dst_dir)s/%(ivs_pkg)s
+        step rpm -ivh --force %(dst_dir)s/%(ivs_pkg)s
         if [[ -f %(dst_dir)s/%(ivs_debug_pkg)s ]]; then
-            rpm -ivh --force %(dst_dir)s/%(ivs_debug_pkg)s
+            step rpm -ivh --force %(dst_dir)s/%(ivs_debug_pkg)s
         fi
     else
         echo "ivs upgrade fails version validation"
@@ -77,7 +89,14 @@ if [[ $install_all == true ]]; then
     done
 
     # deploy bcf
-    puppet apply --modulepath /etc/puppet/modules %(dst_dir)s/%(hostname)s.pp
+    # with detailed exit codes 2 means changes were applied,
+    # 4 and 6 mean some resources failed
+    puppet apply --detailed-exitcodes --modulepath /etc/puppet/modules %(dst_dir)s/%(hostname)s.pp
+    puppet_code=$?
+    if [[ $puppet_code != 0 && $puppet_code != 2 ]]; then
+        echo "Failed: puppet apply"
+        deploy_failed=true
+    fi
 
     # assign ip to ivs internal ports
     bash /etc/rc.d/rc.local
@@ -86,11 +105,11 @@ if [[ $install_all == true ]]; then
     if [[ $is_controller == true && $deploy_horizon_patch == true ]]; then
         if [[ -f %(dst_dir)s/%(horizon_patch)s ]]; then
             chmod -R 777 '/etc/neutron/'
-            tar -xzf %(dst_dir)s/%(horizon_patch)s -C %(dst_dir)s
+            step tar -xzf %(dst_dir)s/%(horizon_patch)s -C %(dst_dir)s
             fs=('openstack_dashboard/dashboards/admin/dashboard.py' 'openstack_dashboard/dashboards/project/dashboard.py' 'openstack_dashboard/dashboards/admin/connections' 'openstack_dashboard/dashboards/project/connections')
             for f in "${fs[@]}"
             do
-                yes | cp -rfp %(dst_dir)s/%(horizon_patch_dir)s/$f %(horizon_base_dir)s/$f
+                step cp -rfp %(dst_dir)s/%(horizon_patch_dir)s/$f %(horizon_base_dir)s/$f
             done
             find "%(horizon_base_dir)s" -name "*.pyc" -exec rm -rf {} \;
         fi
@@ -100,16 +119,18 @@ fi
 # restart libvirtd and nova compute on compute node
 if [[ $is_controller == false ]]; then
     echo 'Restart libvirtd and openstack-nova-compute'
-    systemctl restart libvirtd
-    systemctl restart openstack-nova-compute
+    step systemctl restart libvirtd
+    step systemctl restart openstack-nova-compute
 fi
 
 # restart neutron-server on controller node
 if [[ $is_controller == true ]]; then
     echo 'Restart neutron-server'
     rm -rf /etc/neutron/plugins/ml2/host_certs/*
-    systemctl restart neutron-server
+    step systemctl restart neutron-server
 fi
 
-set -e
+if [[ $deploy_failed == true ]]; then
+    exit 1
+fi
 
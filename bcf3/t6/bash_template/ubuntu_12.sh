@@ -13,6 +13,18 @@ ivs_version=%(ivs_version)s
 is_controller=%(is_controller)s
 deploy_horizon_patch=%(deploy_horizon_patch)s
 
+# steps which must succeed run through step, the script exits
+# non-zero at the end if any of them failed, so the deployment
+# is not recorded as done
+deploy_failed=false
+step() {
+    "$@"
+    if [[ $? != 0 ]]; then
+        echo "Failed: $*"
+        deploy_failed=true
+    fi
+}
+
 # prepare dependencies
 set +e
 cat /etc/apt/sources.list | grep "http://archive.ubuntu.com/ubuntu"
@@ -29,7 +41,7 @@ easy_install pip
 
 # install bsnstacklib
 if [[ $install_bsnstacklib == true ]]; then
-    pip install --upgrade "bsnstacklib<%(bsnstacklib_version)s"
+    step pip install --upgrade "bsnstacklib<%(bsnstacklib_version)s"
 fi
 
 # install ivs
@@ -49,9 +61,9 @@ if [[ $install_ivs == true ]]; then
     fi
 
     if [[ $pass == true ]]; then
-        dpkg --force-all -i %(dst_dir)s/%(ivs_pkg)s
+        step dpkg --force-all -i %(dst_dir)s/%(ivs_pkg)s
         if [[ -f %(dst_dir)s/%(ivs_debug_pkg)s ]]; then
-            dpkg --force-all -i %(dst_dir)s/%(ivs_debug_pkg)s
+            step dpkg --force-all -i %(dst_dir)s/%(ivs_debug_pkg)s
         fi
     else
         echo "ivs upgrade fails version validation"
@@ -82,7 +94,14 @@ if [[ $install_all == true ]]; then
     done
 
     # deploy bcf
-    puppet apply --modulepath /etc/puppet/modules %(dst_dir)s/%(hostname)s.pp
+    # with detailed exit codes 2 means changes were applied,
+    # 4 and 6 mean some resources failed
+    puppet apply --detailed-exitcodes --modulepath /etc/puppet/modules %(dst_dir)s/%(hostname)s.pp
+    puppet_code=$?
+    if [[ $puppet_code != 0 && $puppet_code != 2 ]]; then
+        echo "Failed: puppet apply"
+        deploy_failed=true
+    fi
 
     # assign ip to ivs internal ports
     bash /etc/rc.local
@@ -91,11 +110,11 @@ if [[ $install_all == true ]]; then
     if [[ $is_controller == true && $deploy_horizon_patch == true ]]; then
         if [[ -f %(dst_dir)s/%(horizon_patch)s ]]; then
             chmod -R 777 '/etc/neutron/'
-            tar -xzf %(dst_dir)s/%(horizon_patch)s -C %(dst_dir)s
+            step tar -xzf %(dst_dir)s/%(horizon_patch)s -C %(dst_dir)s
             fs=('openstack_dashboard/dashboards/admin/dashboard.py' 'openstack_dashboard/dashboards/project/dashboard.py' 'openstack_dashboard/dashboards/admin/connections' 'openstack_dashboard/dashboards/project/connections')
             for f in "${fs[@]}"
             do
-                yes | cp -rfp %(dst_dir)s/%(horizon_patch_dir)s/$f %(horizon_base_dir)s/$f
+                step cp -rfp %(dst_dir)s/%(horizon_patch_dir)s/$f %(horizon_base_dir)s/$f
             done
             find "%(horizon_base_dir)s" -name "*.pyc" -exec rm -rf {} \;
         fi
@@ -105,16 +124,18 @@ fi
 # restart libvirtd and nova compute on compute node
 if [[ $is_controller == false ]]; then
     echo 'Restart libvirtd and openstack-nova-compute'
-    service libvirt-bin restart 
-    service nova-compute restart
+    step service libvirt-bin restart
+    step service nova-compute restart
 fi
 
 # restart neutron-server on controller node
 if [[ $is_controller == true ]]; then
     echo 'Restart neutron-server'
     rm -rf /etc/neutron/plugins/ml2/host_certs/*
-    service neutron-server restart
+    step service neutron-server restart
 fi
 
-set -e
+if [[ $deploy_failed == true ]]; then
+    exit 1
+fi
 
@@ -3,16 +3,25 @@
 #
 # @author: Kevin Benton
 import argparse
-import collections
+import base64
+import hashlib
 import json
 import netaddr
 import os
+import Queue
 import tempfile
 import re
+import shutil
 import subprocess
 import time
 import threading
 import urllib2
+try:
+    # only needed for --ssh-transport paramiko, the script also
+    # runs on its own with the default subprocess transport
+    from ssh_transport import ParamikoTransport
+except ImportError:
+    ParamikoTransport = None
 try:
     import yaml
 except:
@@ -25,6 +34,21 @@ SCRIPT_VERSION = '1.1.14'
 # Maximum number of threads to deploy to nodes concurrently
 MAX_THREADS = 20
 
+# Seconds each node took to deploy in earlier runs, the slowest nodes
+# are started first so they do not finish last
+TIMINGS_FILE = os.path.expanduser('~/.big_patch_timings.json')
+
+# Seconds a successful SSH connectivity check of a node is trusted
+CONNECTIVITY_TTL = 300
+
+# SSH calls to a node share one master connection, which stays up
+# for a while after the last call so the next one skips the handshake.
+# The master is opened detached by SSHEnvironment.open_master, calls
+# never become the master themselves.
+SSH_CONTROL_PATH = '/tmp/big_patch-%r@%h:%p'
+SSH_MULTIPLEX_OPTS = ['-o ControlMaster=no',
+                      '-o ControlPath=%s' % SSH_CONTROL_PATH]
+
 # path to neutron tar.gz URL and local filename for offline use
 HORIZON_TGZ_PATH = {
     'icehouse': ('https://github.com/bigswitch/horizon/archive/'
@@ -52,6 +76,68 @@ HORIZON_PATHS_TO_COPY = (
     'openstack_dashboard/dashboards/admin/connections',
     'openstack_dashboard/dashboards/project/connections')
 
+# Gathers the facts of the post deployment sanity checks on a node and
+# prints them as json, so all checks take a single remote execution.
+# Section names must not match the processes grepped for below.
+HEALTH_PROBE = r'''
+import json
+import subprocess
+import sys
+
+
+def run(command):
+    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return out.decode('utf-8', 'replace'), err.decode('utf-8', 'replace')
+
+
+def main():
+    sections = sys.argv[1].split(',')
+    bond_interfaces = []
+    if len(sys.argv) > 2:
+        bond_interfaces = [i for i in sys.argv[2].split(',') if i]
+    facts = {}
+    if 'bond_health' in sections:
+        facts['bond_health'] = dict((i, run('ifconfig %s' % i))
+                                    for i in bond_interfaces)
+    if 'rabbit' in sections:
+        partitions = (r"rabbitmqctl cluster_status | grep partitions | "
+                      r"grep -v '\[\]'")
+        run('service rabbitmq-server start')
+        resp = run(partitions)[0]
+        if 'partitions' in resp:
+            run('rabbitmqctl stop_app')
+            run('rabbitmqctl start_app')
+            resp = run(partitions)[0]
+        facts['rabbit_partitions'] = resp
+    if 'certs' in sections:
+        certs = []
+        resp = run("cat /etc/keystone/keystone.conf | grep -e '^ca_certs' "
+                   "| awk -F '=' '{ print $2 }'")[0]
+        certs += resp.split(',') if resp else ['/etc/keystone/ssl/certs/ca.pem']
+        resp = run("cat /etc/keystone/keystone.conf | grep -e '^certfile' "
+                   "| awk -F '=' '{ print $2 }'")[0]
+        certs.append(
+            resp if resp else '/etc/keystone/ssl/certs/signing_cert.pem')
+        facts['certs'] = [(c.strip(), run('openssl verify %s' % c.strip())[0])
+                          for c in certs]
+    if 'lldp' in sections:
+        facts['lldpd'] = run('ps -ef | grep lldpd | grep -v grep')[0]
+    if 'speeds' in sections:
+        facts['speeds'] = dict((i, run('ethtool %s | grep Speed' % i)[0])
+                               for i in bond_interfaces)
+    if 'neutron_connection' in sections:
+        facts['neutron_connection'] = ''
+        if run('ps -ef | grep neutron-server | grep -v grep')[0].strip():
+            facts['neutron_connection'] = run(
+                "grep -R -e '^connection' /etc/neutron/neutron.conf")[0]
+    sys.stdout.write(json.dumps(facts))
+
+
+main()
+'''
+
 
 class TimedCommand(object):
     def __init__(self, cmd):
@@ -123,6 +209,9 @@ class Environment(object):
     def get_node_bridge_mappings(self, node):
         raise NotImplementedError()
 
+    def is_neutron_server(self, node):
+        return False
+
     def set_neutron_id(self, neutron_id):
         if not neutron_id:
             raise Exception("A non-empty cluster-id must be specified.")
@@ -170,24 +259,38 @@ class SSHEnvironment(Environment):
         self.ssh_user = 'root'
         self.ssh_password = None
         self.sshpass_detected = False
+        # node -> time of its last successful connectivity check
+        self.connectivity_checked = {}
+        # ParamikoTransport used instead of forking ssh and scp if set
+        self.transport = None
         super(SSHEnvironment, self).__init__(*args, **kwargs)
 
     def copy_file_to_node(self, node, local_path, remote_path):
-        sshcomm = ["scp", '-o LogLevel=quiet', local_path,
-                   "%s@%s:%s" % (self.ssh_user, node, remote_path)]
+        if self.transport:
+            return self.transport.copy_file(node, local_path, remote_path)
+        sshcomm = ["scp", '-o LogLevel=quiet'] + SSH_MULTIPLEX_OPTS + [
+                   local_path, "%s@%s:%s" % (self.ssh_user, node, remote_path)]
         if self.ssh_password:
             sshcomm = ['sshpass', '-p', self.ssh_password] + sshcomm
-        resp, errors = TimedCommand(sshcomm).run(timeout=180)
+        self.ensure_connectivity(node)
+        command = TimedCommand(sshcomm)
+        resp, errors = command.run(timeout=180)
+        self.check_transport(node, command)
         return resp, errors
 
     def run_command_on_node(self, node, command, timeout=60, retries=0,
                             shell=False):
         if self.debug:
             print "[Node %s] Running command: %s" % (node, command)
+        if self.transport:
+            resp, errors = self.transport.run_command(node, command, timeout,
+                                                      retries, shell)
+            return resp, errors.replace(
+                "Error: NetworkManager is not running.", "")
         sshcomm = [
             "ssh", '-oStrictHostKeyChecking=no',
-            '-o LogLevel=quiet', "%s@%s" % (self.ssh_user, node),
-            command
+            '-o LogLevel=quiet'] + SSH_MULTIPLEX_OPTS + [
+            "%s@%s" % (self.ssh_user, node), command
         ]
         if self.ssh_password:
             sshcomm = ['sshpass', '-p', self.ssh_password] + sshcomm
@@ -202,19 +305,58 @@ class SSHEnvironment(Environment):
         if shell:
             sshcomm = ' '.join(sshcomm)
         self.ensure_connectivity(node)
-        resp, errors = TimedCommand(sshcomm).run(timeout, retries, shell=shell)
+        timed_command = TimedCommand(sshcomm)
+        resp, errors = timed_command.run(timeout, retries, shell=shell)
+        self.check_transport(node, timed_command)
         return resp, errors.replace("Error: NetworkManager is not running.", "")
 
+    def check_transport(self, node, command):
+        # ssh exits with 255 on connection errors and a command which
+        # timed out was terminated, check connectivity again next time
+        if not command.process or command.process.returncode in (255, -15):
+            self.connectivity_checked.pop(node, None)
+
+    def open_master(self, node):
+        # A master forked by a command would inherit the pipes of that
+        # command and keep communicate() waiting until ControlPersist
+        # expires, so it is started on its own, detached from stdio.
+        target = "%s@%s" % (self.ssh_user, node)
+        with open(os.devnull, 'r+') as devnull:
+            if subprocess.call(
+                    ["ssh", '-o ControlPath=%s' % SSH_CONTROL_PATH,
+                     "-O", "check", target],
+                    stdin=devnull, stdout=devnull, stderr=devnull) == 0:
+                return
+            sshcomm = [
+                "ssh", '-oStrictHostKeyChecking=no', '-o ConnectTimeout=60',
+                '-o ControlMaster=yes',
+                '-o ControlPath=%s' % SSH_CONTROL_PATH,
+                '-o ControlPersist=%s' % CONNECTIVITY_TTL, "-fN", target
+            ]
+            if self.ssh_password:
+                sshcomm = ['sshpass', '-p', self.ssh_password] + sshcomm
+            subprocess.call(sshcomm, stdin=devnull, stdout=devnull,
+                            stderr=devnull)
+
     def ensure_connectivity(self, node):
-        # This might be worth caching if many SSH calls are made to each node.
+        # Opens the master connection the following commands share and
+        # checks it, which is only repeated after a transport error or
+        # once CONNECTIVITY_TTL has passed. Without a master the
+        # commands connect on their own.
+        checked = self.connectivity_checked.get(node)
+        if checked and time.time() - checked < CONNECTIVITY_TTL:
+            return
+        self.open_master(node)
         sshcomm = [
-            "ssh", '-oStrictHostKeyChecking=no',
+            "ssh", '-oStrictHostKeyChecking=no'] + SSH_MULTIPLEX_OPTS + [
             "%s@%s" % (self.ssh_user, node),
             "echo hello"
         ]
         if self.ssh_password:
             sshcomm = ['sshpass', '-p', self.ssh_password] + sshcomm
         resp, errors = TimedCommand(sshcomm).run(60, 4)
+        if (resp or '').strip() == 'hello':
+            self.connectivity_checked[node] = time.time()
         if "Permission denied, please try again." in errors:
             raise Exception(
                 "Error: Received permission error on node %s. Verify that "
@@ -250,6 +392,12 @@ class ConfigEnvironment(SSHEnvironment):
             raise Exception('missing hostname in nodes %s'
                             % self.settings['nodes'])
 
+    def is_neutron_server(self, node):
+        for n in self.settings['nodes']:
+            if n['hostname'] == node:
+                return n.get('role') == 'controller'
+        return False
+
     def get_node_bond_interfaces(self, node):
         for n in self.settings['nodes']:
             if n['hostname'] == node:
@@ -351,6 +499,9 @@ class FuelEnvironment(SSHEnvironment):
                             % (e, resp))
         return conf
 
+    def is_neutron_server(self, node):
+        return 'controller' in self.node_settings[node].get('role', '')
+
     @property
     def network_vlan_ranges(self):
         net_vlans = []
@@ -456,13 +607,37 @@ class StandaloneEnvironment(Environment):
         return resp, errors
 
 
+class DeployResults(object):
+    # collects what the deployment workers report about their nodes
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.errors = []
+        self.nodes_information = []
+        self.timings = {}
+
+    def add_error(self, node, error):
+        with self.lock:
+            self.errors.append((node, error))
+
+    def add_information(self, node, info):
+        with self.lock:
+            self.nodes_information.append((node, info))
+
+    def add_timing(self, node, seconds):
+        with self.lock:
+            self.timings[node] = seconds
+
+
 class ConfigDeployer(object):
     def __init__(self, environment, openstack_release,
                  patch_python_files=True):
         self.env = environment
         self.os_release = openstack_release.lower()
         self.patch_python_files = patch_python_files
-        self.patch_file_cache = {}
+        # patch archives spooled to disk once, url -> (path, sha256)
+        self.patch_files = {}
+        self.spool_dir = None
         if any([not self.env.bigswitch_auth,
                 not self.env.bigswitch_servers,
                 not self.env.nodes]):
@@ -484,7 +659,7 @@ class ConfigDeployer(object):
                                         "\nPlease download the archive and "
                                         "save it as %s.\nDetails: %s" %
                                         (patch[0], patch[1], str(e)))
-                    self.patch_file_cache[patch[0]] = contents
+                    self.spool_patch_file(patch[0], contents)
             else:
                 print 'Downloading patch files...'
                 for lib in (NEUTRON_TGZ_PATH[self.os_release],
@@ -498,22 +673,56 @@ class ConfigDeployer(object):
                         raise Exception("Error encountered while trying to "
                                         "download patch file at %s.\n%s"
                                         % (url, e))
-                    self.patch_file_cache[url] = body
+                    self.spool_patch_file(url, body)
+
+    def spool_patch_file(self, url, contents):
+        # files are named by their hash so identical archives are the
+        # same file on the setup node and on the nodes
+        if not self.spool_dir:
+            self.spool_dir = tempfile.mkdtemp(prefix='big_patch-')
+        sha = hashlib.sha256(contents).hexdigest()
+        path = os.path.join(self.spool_dir, '%s.tar.gz' % sha)
+        with open(path, 'wb') as fh:
+            fh.write(contents)
+        self.patch_files[url] = (path, sha)
+
+    def push_patch_file(self, node, url, remote_path):
+        # the archive is only sent if the node does not have it already
+        path, sha = self.patch_files[url]
+        resp, errors = self.env.run_command_on_node(
+            node, "sha256sum %s 2>/dev/null" % remote_path)
+        if resp and resp.split()[0] == sha:
+            return '', ''
+        return self.env.copy_file_to_node(node, path, remote_path)
 
     def deploy_to_all(self):
-        thread_list = collections.deque()
-        errors = []
-        nodes_information = []
-        for node in self.env.nodes:
-            t = threading.Thread(target=self.deploy_to_node_catch_errors,
-                                 args=(node, errors, nodes_information))
-            thread_list.append(t)
+        try:
+            self.deploy_to_all_nodes()
+        finally:
+            if self.spool_dir:
+                shutil.rmtree(self.spool_dir, ignore_errors=True)
+                self.spool_dir = None
+
+    def deploy_to_all_nodes(self):
+        results = DeployResults()
+        timings = self.load_timings()
+        work = Queue.PriorityQueue()
+        for index, node in enumerate(self.env.nodes):
+            # neutron servers first, then the nodes which took longest
+            # in earlier runs so they do not finish last
+            work.put(((not self.env.is_neutron_server(node),
+                       -timings.get(node, 0), index), node))
+        workers = [threading.Thread(target=self.deploy_worker,
+                                    args=(work, results))
+                   for i in range(min(MAX_THREADS, len(self.env.nodes)))]
+        for t in workers:
             t.start()
-            if len(thread_list) >= MAX_THREADS:
-                top = thread_list.popleft()
-                top.join()
-        for thread in thread_list:
-            thread.join()
+        for t in workers:
+            t.join()
+        timings.update(results.timings)
+        self.save_timings(timings)
+        errors = results.errors
+        nodes_information = results.nodes_information
         # sanity checks across collected info
         # make sure neutron servers are all pointing to the same DB
         conn_strings = [info['neutron_connection']
@@ -546,11 +755,38 @@ class ConfigDeployer(object):
         else:
             print "Deployment Complete!"
 
-    def deploy_to_node_catch_errors(self, node, error_log, nodes_information):
+    def deploy_worker(self, work, results):
+        # any free worker takes the next node, so a slow node only
+        # holds up its own worker
+        while True:
+            try:
+                priority, node = work.get_nowait()
+            except Queue.Empty:
+                return
+            self.deploy_to_node_catch_errors(node, results)
+
+    def deploy_to_node_catch_errors(self, node, results):
+        start = time.time()
         try:
-            self.deploy_to_node(node, nodes_information)
+            self.deploy_to_node(node, results)
         except Exception as e:
-            error_log.append((node, str(e)))
+            results.add_error(node, str(e))
+            return
+        results.add_timing(node, time.time() - start)
+
+    def load_timings(self):
+        try:
+            with open(TIMINGS_FILE, 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def save_timings(self, timings):
+        try:
+            with open(TIMINGS_FILE, 'w') as f:
+                f.write(json.dumps(timings))
+        except IOError as e:
+            print "Warning: could not save deployment timings: %s" % e
 
     def get_lldp_advertisement_hostname(self, node):
         # Determine what name lldpd should advertise for the hostname.
@@ -578,7 +814,7 @@ class ConfigDeployer(object):
             return names[0]
         return '`uname -n`'
 
-    def deploy_to_node(self, node, nodes_information):
+    def deploy_to_node(self, node, results):
         print "Applying configuration to %s..." % node
         bond_interfaces = self.env.get_node_bond_interfaces(node)
         puppet_settings = {
@@ -643,21 +879,25 @@ class ConfigDeployer(object):
                             % (node, errors))
 
         # run a few last sanity checks
-        self.check_rabbit_cluster_partition_free(node)
-        self.cert_validity_check(node)
-        self.check_lldpd_running(node)
-        self.check_bond_int_speeds_match(node, bond_interfaces)
+        sections = ['rabbit', 'certs', 'lldp', 'neutron_connection']
+        if bond_interfaces and self.env.check_interface_errors:
+            sections.append('speeds')
+        facts = self.run_health_probe(node, sections, bond_interfaces)
+        self.check_rabbit_cluster_partition_free(node, facts)
+        self.cert_validity_check(node, facts)
+        self.check_lldpd_running(node, facts)
+        self.check_bond_int_speeds_match(node, bond_interfaces, facts)
 
         # aggregate node information to compare across other nodes
         node_info = {}
         # collect connection string for comparison with other neutron servers
-        connection_string = self.get_neutron_connection_string(node)
+        connection_string = self.get_neutron_connection_string(node, facts)
         if connection_string:
             node_info['neutron_connection'] = connection_string
         # collect static lldpd names to make sure they are all unique
         if ptemplate.settings['lldp_advertised_name'] != '`uname -n`':
             node_info['lldp_name'] = ptemplate.settings['lldp_advertised_name']
-        nodes_information.append((node, node_info))
+        results.add_information(node, node_info)
         print "Configuration applied to %s." % node
 
     def push_manifest_to_node(self, node, pbody):
@@ -703,38 +943,41 @@ class ConfigDeployer(object):
             actual_errors.append(e)
         return '\n'.join(actual_errors)
 
-    def check_rabbit_cluster_partition_free(self, node):
-        self.env.run_command_on_node(node, "service rabbitmq-server start")
-        resp, errors = self.env.run_command_on_node(
-            node, ("rabbitmqctl cluster_status | grep partitions | " +
-                   r"""grep -v '\[\]'"""))
+    def run_health_probe(self, node, sections, bond_interfaces=()):
+        # runs HEALTH_PROBE on the node and returns the facts it gathered
+        command = ("echo %s | base64 -d | python - %s %s"
+                   % (base64.b64encode(HEALTH_PROBE), ','.join(sections),
+                      ','.join(bond_interfaces)))
+        resp, errors = self.env.run_command_on_node(node, command, 300)
+        try:
+            return json.loads(resp)
+        except (TypeError, ValueError):
+            # the checks are advisory, so a node without a usable python
+            # or with noisy login output just skips the ones it can't answer
+            print ("Warning: health probe failed on node %s:\n%s\n%s"
+                   % (node, errors, resp))
+            return {}
+
+    def check_rabbit_cluster_partition_free(self, node, facts):
+        # the probe already restarted the app once if it was partitioned
+        resp = facts.get('rabbit_partitions', '')
         if 'partitions' in resp:
-            self.env.run_command_on_node(node, "rabbitmqctl stop_app")
-            self.env.run_command_on_node(node, "rabbitmqctl start_app")
-            resp, errors = self.env.run_command_on_node(
-                node, ("rabbitmqctl cluster_status | grep partitions | " +
-                       r"""grep -v '\[\]'"""))
-            if 'partitions' in resp:
-                print ("Warning: RabbitMQ partition detected on node %s: %s "
-                       "Restart rabbitmq-server on each node in the parition."
-                       % (node, resp))
-
-    def check_lldpd_running(self, node):
+            print ("Warning: RabbitMQ partition detected on node %s: %s "
+                   "Restart rabbitmq-server on each node in the parition."
+                   % (node, resp))
+
+    def check_lldpd_running(self, node, facts):
         # check for lldpd
-        resp = self.env.run_command_on_node(
-            node, ('ps -ef | grep lldpd | grep -v grep'))[0]
-        if not resp.strip():
+        if 'lldpd' in facts and not facts['lldpd'].strip():
             print ("Warning: lldpd process not running on node %s. "
                    "Automatic port groups will not be formed." % node)
 
-    def check_bond_int_speeds_match(self, node, bond_interfaces):
+    def check_bond_int_speeds_match(self, node, bond_interfaces, facts):
         # check bond interface speeds match
         if bond_interfaces and self.env.check_interface_errors:
             speeds = {}
             for iface in bond_interfaces:
-                resp, errors = self.env.run_command_on_node(
-                    node, "ethtool %s | grep Speed" % iface)
-                resp = resp.strip()
+                resp = str(facts.get('speeds', {}).get(iface, '')).strip()
                 if resp:
                     speeds[iface] = resp
             if len(set(speeds.values())) > 1:
@@ -742,23 +985,10 @@ class ConfigDeployer(object):
                        "%s. Were the correct interfaces chosen?\nSpeeds: %s"
                        % (node, speeds))
 
-    def cert_validity_check(self, node):
+    def cert_validity_check(self, node, facts):
         # check for certificates generated in the future (due to clock change)
         # or expired certs
-        certs = []
-        resp, errors = self.env.run_command_on_node(
-            node, ("cat /etc/keystone/keystone.conf | grep -e '^ca_certs' "
-                   "| awk -F '=' '{ print $2 }'"))
-        certs += resp.split(',') if resp else ['/etc/keystone/ssl/certs/ca.pem']
-        resp, errors = self.env.run_command_on_node(
-            node, ("cat /etc/keystone/keystone.conf | grep -e '^certfile' "
-                   "| awk -F '=' '{ print $2 }'"))
-        certs.append(
-            resp if resp else '/etc/keystone/ssl/certs/signing_cert.pem')
-        for cert in certs:
-            cert = cert.strip()
-            resp, errors = self.env.run_command_on_node(
-                node, ("openssl verify %s" % cert))
+        for cert, resp in facts.get('certs', []):
             if 'expired' in resp or 'not yet valid' in resp:
                 print ("Warning: the certificate %s being used by keystone is "
                        "not valid for the current time. If the clocks on the "
@@ -768,9 +998,14 @@ class ConfigDeployer(object):
                        "Details: %s" % (cert, resp))
 
     def check_health_of_bond_interfaces(self, node, bond_interfaces):
+        facts = self.run_health_probe(node, ['bond_health'], bond_interfaces)
         for bondint in bond_interfaces:
-            resp, errors = self.env.run_command_on_node(
-                node, "ifconfig %s" % bondint)
+            if 'bond_health' in facts:
+                resp, errors = facts['bond_health'][bondint]
+            else:
+                # fall back to asking the node directly
+                resp, errors = self.env.run_command_on_node(
+                    node, 'ifconfig %s' % bondint)
             if not resp:
                 raise Exception("Error: bond member '%s' on node '%s' was "
                                 "not found.\n%s" % (bondint, node, errors))
@@ -804,11 +1039,8 @@ class ConfigDeployer(object):
         if NEUTRON_TGZ_PATH[self.os_release] and netaddr_path:
             python_lib_dir = "/".join(netaddr_path.split("/")[:-1]) + "/"
             target_neutron_path = python_lib_dir + 'neutron'
-            f = tempfile.NamedTemporaryFile(delete=True)
-            f.write(self.patch_file_cache[NEUTRON_TGZ_PATH[self.os_release][0]])
-            f.flush()
-            nfile = '~/neutron.tar.gz'
-            resp, errors = self.env.copy_file_to_node(node, f.name, nfile)
+            resp, errors = self.push_patch_file(
+                node, NEUTRON_TGZ_PATH[self.os_release][0], '~/neutron.tar.gz')
             if errors:
                 raise Exception("error pushing neutron to %s:\n%s"
                                 % (node, errors))
@@ -843,11 +1075,8 @@ class ConfigDeployer(object):
         if (HORIZON_TGZ_PATH[self.os_release] and not errors and resp.splitlines()
                 and 'openstack_dashboard/dashboards/admin/' in resp.splitlines()[0]):
             first = resp.splitlines()[0]
-            f = tempfile.NamedTemporaryFile(delete=True)
-            f.write(self.patch_file_cache[HORIZON_TGZ_PATH[self.os_release][0]])
-            f.flush()
-            nfile = '~/horizon.tar.gz'
-            resp, errors = self.env.copy_file_to_node(node, f.name, nfile)
+            resp, errors = self.push_patch_file(
+                node, HORIZON_TGZ_PATH[self.os_release][0], '~/horizon.tar.gz')
             if errors:
                 raise Exception("error pushing horizon to %s:\n%s"
                                 % (node, errors))
@@ -886,15 +1115,10 @@ class ConfigDeployer(object):
             # the restarts into the background.
             self.env.run_command_on_node(node, "service httpd restart")
 
-    def get_neutron_connection_string(self, node):
-        neutron_running = self.env.run_command_on_node(
-            node, 'ps -ef | grep neutron-server | grep -v grep')[0].strip()
-        if neutron_running:
-            resp = self.env.run_command_on_node(
-                node, ("grep -R -e '^connection' /etc/neutron/neutron.conf")
-            )[0].strip()
-            if resp:
-                return resp.replace(' ', '')
+    def get_neutron_connection_string(self, node, facts):
+        resp = facts.get('neutron_connection', '').strip()
+        if resp:
+            return resp.replace(' ', '')
 
 
 class PuppetTemplate(object):
@@ -1665,6 +1889,12 @@ if __name__ == '__main__':
                         help="Password to use when connecting to remote nodes "
                              "via SSH. By default no password is used under "
                              "the assumption that SSH keys are setup.")
+    remote.add_argument('--ssh-transport', default='subprocess',
+                        choices=['subprocess', 'paramiko'],
+                        help="How to reach remote nodes. 'subprocess' forks "
+                             "ssh and scp for every call, 'paramiko' keeps "
+                             "one connection per node and copies files over "
+                             "SFTP. Default is 'subprocess'.")
     local = parser.add_argument_group(
         'standalone-deployment', 'Arguments for standalone deployments')
     local.add_argument('--network-vlan-ranges',
@@ -1724,6 +1954,12 @@ if __name__ == '__main__':
     if not args.stand_alone:
         environment.ssh_user = args.ssh_user
         environment.ssh_password = args.ssh_password
+        if args.ssh_transport == 'paramiko':
+            if not ParamikoTransport:
+                parser.error('The paramiko SSH transport requires '
+                             'ssh_transport.py next to this script.')
+            environment.transport = ParamikoTransport(args.ssh_user,
+                                                      args.ssh_password)
     allowed_bond_modes = {'xor': 2, 'round-robin': 0}
     if args.bond_mode not in allowed_bond_modes:
         parser.error('Unsupported bond mode: "%s". Supported modes: "%s"'
@@ -1741,4 +1977,8 @@ if __name__ == '__main__':
     deployer = ConfigDeployer(environment,
                               patch_python_files=not args.skip_file_patching,
                               openstack_release=args.openstack_release)
-    deployer.deploy_to_all()
+    try:
+        deployer.deploy_to_all()
+    finally:
+        if getattr(environment, 'transport', None):
+            environment.transport.close()
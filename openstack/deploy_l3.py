@@ -3,13 +3,20 @@
 #
 # @author: Kanzhe Jiang
 import argparse
-import collections
 import json
 import netaddr
 import os
+import Queue
 import subprocess
 import threading
+import time
 import urllib2
+try:
+    # only needed for --ssh-transport paramiko, the script also
+    # runs on its own with the default subprocess transport
+    from ssh_transport import ParamikoTransport
+except ImportError:
+    ParamikoTransport = None
 try:
     import yaml
 except:
@@ -22,6 +29,10 @@ SCRIPT_VERSION = '1.0'
 # Maximum number of threads to deploy to nodes concurrently
 MAX_THREADS = 20
 
+# Seconds each node took to deploy in earlier runs, the slowest nodes
+# are started first so they do not finish last
+TIMINGS_FILE = os.path.expanduser('~/.deploy_l3_timings.json')
+
 CONF_DIR = "neutron-conf"
 
 
@@ -80,6 +91,9 @@ class Environment(object):
     def copy_file_to_node(self, node, local_path, remote_path):
         raise NotImplementedError()
 
+    def is_neutron_server(self, node):
+        return False
+
 
 class SSHEnvironment(Environment):
     # shared SSH stuff for config based deployments and fuel deployments
@@ -88,9 +102,13 @@ class SSHEnvironment(Environment):
         self.ssh_user = 'root'
         self.ssh_password = None
         self.sshpass_detected = False
+        # ParamikoTransport used instead of forking ssh and scp if set
+        self.transport = None
         super(SSHEnvironment, self).__init__(*args, **kwargs)
 
     def copy_file_to_node(self, node, local_path, remote_path):
+        if self.transport:
+            return self.transport.copy_file(node, local_path, remote_path)
         sshcomm = ["scp", '-o LogLevel=quiet', local_path,
                    "%s@%s:%s" % (self.ssh_user, node, remote_path)]
         if self.ssh_password:
@@ -102,6 +120,9 @@ class SSHEnvironment(Environment):
                             shell=False):
         if self.debug:
             print "[Node %s] Running command: %s" % (node, command)
+        if self.transport:
+            return self.transport.run_command(node, command, timeout,
+                                              retries, shell)
         sshcomm = [
             "ssh", '-oStrictHostKeyChecking=no',
             '-o LogLevel=quiet', "%s@%s" % (self.ssh_user, node),
@@ -165,6 +186,12 @@ class ConfigEnvironment(SSHEnvironment):
             raise Exception('missing hostname in nodes %s'
                             % self.settings['nodes'])
 
+    def is_neutron_server(self, node):
+        for n in self.settings['nodes']:
+            if n['hostname'] == node:
+                return n.get('role') == 'controller'
+        return False
+
 
 class FuelEnvironment(SSHEnvironment):
 
@@ -228,6 +255,9 @@ class FuelEnvironment(SSHEnvironment):
                             % (e, resp))
         return conf
 
+    def is_neutron_server(self, node):
+        return 'controller' in self.node_settings[node].get('role', '')
+
 
 class StandaloneEnvironment(Environment):
 
@@ -246,24 +276,52 @@ class StandaloneEnvironment(Environment):
         return resp, errors
 
 
+class DeployResults(object):
+    # collects what the deployment workers report about their nodes
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.errors = []
+        self.nodes_information = []
+        self.timings = {}
+
+    def add_error(self, node, error):
+        with self.lock:
+            self.errors.append((node, error))
+
+    def add_information(self, node, info):
+        with self.lock:
+            self.nodes_information.append((node, info))
+
+    def add_timing(self, node, seconds):
+        with self.lock:
+            self.timings[node] = seconds
+
+
 class ConfigDeployer(object):
     def __init__(self, environment):
         self.env = environment
 
     def deploy_to_all(self):
-        thread_list = collections.deque()
-        errors = []
-        nodes_information = []
-        for node in self.env.nodes:
-            t = threading.Thread(target=self.deploy_to_node_catch_errors,
-                                 args=(node, errors, nodes_information))
-            thread_list.append(t)
+        results = DeployResults()
+        timings = self.load_timings()
+        work = Queue.PriorityQueue()
+        for index, node in enumerate(self.env.nodes):
+            # neutron servers first, then the nodes which took longest
+            # in earlier runs so they do not finish last
+            work.put(((not self.env.is_neutron_server(node),
+                       -timings.get(node, 0), index), node))
+        workers = [threading.Thread(target=self.deploy_worker,
+                                    args=(work, results))
+                   for i in range(min(MAX_THREADS, len(self.env.nodes)))]
+        for t in workers:
             t.start()
-            if len(thread_list) >= MAX_THREADS:
-                top = thread_list.popleft()
-                top.join()
-        for thread in thread_list:
-            thread.join()
+        for t in workers:
+            t.join()
+        timings.update(results.timings)
+        self.save_timings(timings)
+        errors = results.errors
+        nodes_information = results.nodes_information
         # sanity checks across collected info
         # make sure neutron servers are all pointing to the same DB
         conn_strings = [info['neutron_connection']
@@ -284,14 +342,41 @@ class ConfigDeployer(object):
         else:
             print "Deployment Complete!"
 
-    def deploy_to_node_catch_errors(self, node, error_log, nodes_information):
+    def deploy_worker(self, work, results):
+        # any free worker takes the next node, so a slow node only
+        # holds up its own worker
+        while True:
+            try:
+                priority, node = work.get_nowait()
+            except Queue.Empty:
+                return
+            self.deploy_to_node_catch_errors(node, results)
+
+    def deploy_to_node_catch_errors(self, node, results):
+        start = time.time()
         try:
-            self.deploy_to_node(node, nodes_information)
+            self.deploy_to_node(node, results)
         except Exception as e:
-            error_log.append((node, str(e)))
+            results.add_error(node, str(e))
+            return
+        results.add_timing(node, time.time() - start)
+
+    def load_timings(self):
+        try:
+            with open(TIMINGS_FILE, 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def save_timings(self, timings):
+        try:
+            with open(TIMINGS_FILE, 'w') as f:
+                f.write(json.dumps(timings))
+        except IOError as e:
+            print "Warning: could not save deployment timings: %s" % e
 
 
-    def deploy_to_node(self, node, nodes_information):
+    def deploy_to_node(self, node, results):
         print "Applying configuration to %s..." % node
 
         self.push_conf_to_node(node)
@@ -305,7 +390,7 @@ class ConfigDeployer(object):
         connection_string = self.get_neutron_connection_string(node)
         if connection_string:
             node_info['neutron_connection'] = connection_string
-        nodes_information.append((node, node_info))
+        results.add_information(node, node_info)
         print "Configuration applied to %s." % node
 
     def push_conf_to_node(self, node):
@@ -375,6 +460,12 @@ if __name__ == '__main__':
                         help="Password to use when connecting to remote nodes "
                              "via SSH. By default no password is used under "
                              "the assumption that SSH keys are setup.")
+    remote.add_argument('--ssh-transport', default='subprocess',
+                        choices=['subprocess', 'paramiko'],
+                        help="How to reach remote nodes. 'subprocess' forks "
+                             "ssh and scp for every call, 'paramiko' keeps "
+                             "one connection per node and copies files over "
+                             "SFTP. Default is 'subprocess'.")
     args = parser.parse_args()
     if args.specific_nodes:
         specific_nodes = args.specific_nodes.split(',')
@@ -405,6 +496,16 @@ if __name__ == '__main__':
     if not args.stand_alone:
         environment.ssh_user = args.ssh_user
         environment.ssh_password = args.ssh_password
+        if args.ssh_transport == 'paramiko':
+            if not ParamikoTransport:
+                parser.error('The paramiko SSH transport requires '
+                             'ssh_transport.py next to this script.')
+            environment.transport = ParamikoTransport(args.ssh_user,
+                                                      args.ssh_password)
     environment.debug = args.debug
     deployer = ConfigDeployer(environment)
-    deployer.deploy_to_all()
+    try:
+        deployer.deploy_to_all()
+    finally:
+        if getattr(environment, 'transport', None):
+            environment.transport.close()
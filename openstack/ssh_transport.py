@@ -0,0 +1,119 @@
+# Copyright 2014 Big Switch Networks, Inc.
+# All Rights Reserved.
+#
+# SSH transport shared by big_patch.py and deploy_l3.py
+import collections
+import select
+import shlex
+import socket
+import threading
+import time
+try:
+    import paramiko
+except:
+    paramiko = None
+
+
+class ParamikoTransport(object):
+    # Holds one authenticated SSH connection per node. Commands run on
+    # channels of it and files are streamed over SFTP, so nothing is
+    # forked and the handshake is done once per node.
+
+    def __init__(self, user, password=None):
+        if not paramiko:
+            raise Exception("The 'paramiko' python package must be installed "
+                            "to use the paramiko SSH transport.")
+        self.user = user
+        self.password = password
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.node_locks = collections.defaultdict(threading.Lock)
+
+    def get_client(self, node):
+        with self.lock:
+            node_lock = self.node_locks[node]
+        with node_lock:
+            client = self.clients.get(node)
+            if client and client.get_transport() and \
+                    client.get_transport().is_active():
+                return client
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(node, username=self.user,
+                               password=self.password, timeout=60)
+            except paramiko.AuthenticationException:
+                raise Exception(
+                    "Error: Received permission error on node %s. Verify that "
+                    "the SSH password is correct or that the ssh key being "
+                    "used is authorized on that host." % node)
+            client.get_transport().set_keepalive(30)
+            self.clients[node] = client
+            return client
+
+    def drop_client(self, node):
+        client = self.clients.pop(node, None)
+        if client:
+            client.close()
+
+    def close(self):
+        # closes the connections to all nodes
+        with self.lock:
+            nodes = self.clients.keys()
+        for node in nodes:
+            self.drop_client(node)
+
+    def run_command(self, node, command, timeout=60, retries=0, shell=False):
+        if shell:
+            # the ssh command line would have been parsed by a local shell
+            command = ' '.join(shlex.split(command))
+        for attempt in range(retries + 1):
+            try:
+                channel = self.get_client(node).get_transport().open_session()
+                channel.exec_command(command)
+            except (paramiko.SSHException, socket.error) as e:
+                self.drop_client(node)
+                resp = ''
+                errors = 'Error connecting to node %s: %s' % (node, e)
+                continue
+            resp, errors = [], []
+            deadline = time.time() + timeout
+            while True:
+                while channel.recv_ready():
+                    resp.append(channel.recv(65536))
+                while channel.recv_stderr_ready():
+                    errors.append(channel.recv_stderr(65536))
+                if channel.exit_status_ready() and not channel.recv_ready() \
+                        and not channel.recv_stderr_ready():
+                    break
+                if time.time() > deadline:
+                    break
+                select.select([channel], [], [], 0.1)
+            timed_out = not channel.exit_status_ready()
+            channel.close()
+            resp = ''.join(resp)
+            if not timed_out:
+                return resp, ''.join(errors)
+            errors = ("Timed out waiting for command '%s' to finish."
+                      % command)
+        # like TimedCommand, hand back whatever output was read
+        return resp, errors
+
+    def copy_file(self, node, local_path, remote_path, timeout=180):
+        if remote_path.startswith('~/'):
+            # sftp paths are relative to the home directory
+            remote_path = remote_path[2:]
+        try:
+            sftp = self.get_client(node).open_sftp()
+        except (paramiko.SSHException, socket.error) as e:
+            self.drop_client(node)
+            return '', 'Error connecting to node %s: %s' % (node, e)
+        try:
+            sftp.get_channel().settimeout(timeout)
+            sftp.put(local_path, remote_path)
+        except (IOError, OSError, paramiko.SSHException, socket.error) as e:
+            return '', 'Error copying %s to %s:%s: %s' % (
+                local_path, node, remote_path, e)
+        finally:
+            sftp.close()
+        return '', ''